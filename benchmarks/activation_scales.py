@@ -0,0 +1,96 @@
+"""Activation quantization error with per tensor and per channel scales
+
+Captures the input of every predictive convolution in one forward pass on
+synthetic data, and prints the relative error (`|q(x) - x| / |x|`) of
+quantizing it at each bit width with one scale per tensor and one scale per
+input channel (`--per-channel-act`). Also times an eval forward pass of the
+model built both ways, which only reads the cached scales.
+
+    python -m benchmarks.activation_scales --arch cifar10_rnn_gate_38 --num-bits 4,5,6,8
+
+The accuracy of a trained checkpoint at lower bit widths is measured by
+`main_all.py test --resume ... --eval-num-bits 4,5,6`.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from benchmarks.common import build_model, synthetic_batch, time_steps
+from models.precision import predictive_layers
+from models.quantize import calculate_qparams, quantize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='activation scale benchmark')
+    parser.add_argument('--arch', default='cifar10_rnn_gate_38', type=str)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--num-bits', default='4,5,6,8', type=str)
+    parser.add_argument('--iters', default=10, type=int)
+    return parser.parse_args()
+
+
+def conv_inputs(model, input):
+    """(writer_prefix, input) of every predictive convolution"""
+    inputs, hooks = [], []
+    for name, m in predictive_layers(model):
+        if isinstance(m, nn.Conv2d):
+            hooks.append(m.register_forward_pre_hook(
+                lambda m, args, name=name: inputs.append((name, args[0].detach(), m.input_signed))))
+    with torch.no_grad():
+        model(input)
+    for h in hooks:
+        h.remove()
+    return inputs
+
+
+def relative_error(x, num_bits, signed, per_channel):
+    flatten_dims = (2, -1) if per_channel else (1, -1)
+    qparams = calculate_qparams(x, num_bits=num_bits, flatten_dims=flatten_dims,
+                                reduce_dim=0, keepdim=per_channel)
+    qparams.max_values.clamp_(min=1e-8)
+    q = quantize(x, qparams=qparams, signed=signed)
+    return ((q - x).norm() / x.norm().clamp(min=1e-12)).item()
+
+
+def main():
+    args = parse_args()
+    bits = [int(b) for b in args.num_bits.split(',')]
+    input, _ = synthetic_batch(args.batch_size)
+    model = build_model(args.arch).train()
+
+    print('{:<32s} '.format('layer') + ' '.join(
+        '{:>8s} {:>8s}'.format('{}b/t'.format(b), '{}b/ch'.format(b)) for b in bits))
+    errors = {b: ([], []) for b in bits}
+    for name, x, signed in conv_inputs(model, input):
+        row = []
+        for b in bits:
+            per_tensor = relative_error(x, b, signed, False)
+            per_channel = relative_error(x, b, signed, True)
+            errors[b][0].append(per_tensor)
+            errors[b][1].append(per_channel)
+            row += [per_tensor, per_channel]
+        print('{:<32s} '.format(name) + ' '.join('{:>8.4f}'.format(e) for e in row))
+    print('{:<32s} '.format('mean') + ' '.join(
+        '{:>8.4f} {:>8.4f}'.format(np.mean(errors[b][0]), np.mean(errors[b][1])) for b in bits))
+
+    print('\neval forward (ms)')
+    for per_channel in (False, True):
+        model = build_model(args.arch, per_channel_act=per_channel)
+        # fill the running scales, then freeze them
+        with torch.no_grad():
+            model.train()(input)
+        model.eval()
+
+        def step():
+            with torch.no_grad():
+                model(input)
+
+        print('{:<12s} {:>9.2f}'.format('per channel' if per_channel else 'per tensor',
+                                        1e3 * np.median(time_steps(step, args.iters))))
+
+
+if __name__ == '__main__':
+    main()
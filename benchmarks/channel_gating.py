@@ -0,0 +1,68 @@
+"""Time of one gated residual block against the fraction of active channel groups
+
+The first `k` of `--groups` channel groups are kept for every sample, so
+both convolutions of the block run on sliced weights. The ungated block
+(`group_mask=None`) is the reference.
+
+    python -m benchmarks.channel_gating --planes 32 --size 16 --groups 8
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import SIGNSGD_CONFIG, time_steps
+from models.efficient_resnet import BasicBlock
+from models.quantize import quant_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='channel group gating benchmark')
+    parser.add_argument('--planes', default=32, type=int)
+    parser.add_argument('--size', default=16, type=int, help='input height and width')
+    parser.add_argument('--groups', default=8, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    block = BasicBlock(args.planes, args.planes, config=quant_config(SIGNSGD_CONFIG)).to(device)
+    input = torch.rand(args.batch_size, args.planes, args.size, args.size, device=device)
+
+    def measure(group_mask, train):
+        block.train(train)
+
+        def step():
+            if train:
+                block.zero_grad()
+                block(input, group_mask=group_mask).sum().backward()
+            else:
+                with torch.no_grad():
+                    block(input, group_mask=group_mask)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        return 1e3 * np.median(time_steps(step, args.iters))
+
+    reference = {train: measure(None, train) for train in (False, True)}
+    print('{:>8s} | {:>10s} {:>8s} | {:>10s} {:>8s}'.format(
+        'active', 'eval ms', 'speedup', 'train ms', 'speedup'))
+    print('{:>8s} | {:>10.2f} {:>8s} | {:>10.2f} {:>8s}'.format(
+        'ungated', reference[False], '', reference[True], ''))
+    for active in range(args.groups, 0, -1):
+        group_mask = torch.zeros(args.batch_size, args.groups, 1, 1, device=device)
+        group_mask[:, :active] = 1
+        eval_ms, train_ms = measure(group_mask, False), measure(group_mask, True)
+        print('{:>8.3f} | {:>10.2f} {:>7.2f}x | {:>10.2f} {:>7.2f}x'.format(
+            active / args.groups, eval_ms, reference[False] / eval_ms,
+            train_ms, reference[True] / train_ms))
+
+
+if __name__ == '__main__':
+    main()
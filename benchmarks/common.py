@@ -0,0 +1,81 @@
+"""Shared helpers for the CPU benchmarks in this folder.
+
+Run the scripts from the repository root, e.g.
+    python -m benchmarks.compile_step
+"""
+
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import models
+
+
+# Same defaults as the command line of `main_all.py`
+SIGNSGD_CONFIG = {
+    'num_bits': 8,
+    'num_bits_weight': 8,
+    'num_bits_grad': 16,
+    'biprecision': False,
+    'predictive_forward': False,
+    'predictive_backward': True,
+    'msb_bits': 8,
+    'msb_bits_weight': 8,
+    'msb_bits_grad': 16,
+    'threshold': -0.05,
+    'sparsify': False,
+    'sign': True,
+    'sparse_backward': False,
+    'pack_saved': False,
+    'stochastic_grad': False,
+    'per_channel_act': False,
+}
+
+
+def build_model(arch, unroll_lstm=False, seed=0, **overrides):
+    """Build `arch` with the default predictive sign SGD config on the CPU"""
+    torch.manual_seed(seed)
+    config = dict(SIGNSGD_CONFIG, **overrides)
+    model = models.get_model(arch)(False, **config)
+    model.install_gate(unroll_lstm=unroll_lstm)
+    return model
+
+
+def synthetic_batch(batch_size, num_classes=10, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    input = torch.randn(batch_size, 3, 32, 32, generator=g)
+    target = torch.randint(0, num_classes, (batch_size,), generator=g)
+    return input, target
+
+
+def train_step(model, optimizer, criterion, input, target):
+    """One iteration of the inner loop of `run_training`"""
+    output, masks, _, has_ds = model(input)
+    loss = criterion(output, target)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return output, masks, has_ds
+
+
+def time_steps(fn, iters, warmup=3):
+    """Run `fn` `warmup + iters` times and return the timed durations (s)"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def make_optimizer(model, lr=0.1):
+    return torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()),
+                           lr, momentum=0.9, weight_decay=1e-4)
+
+
+def make_criterion():
+    return nn.CrossEntropyLoss()
@@ -0,0 +1,65 @@
+"""Training step time of the gated ResNet on CPU, eager vs. `torch.compile`
+
+    python -m benchmarks.compile_step --arch cifar10_rnn_gate_38 --batch-size 32
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import (build_model, synthetic_batch, train_step, time_steps,
+                               make_optimizer, make_criterion)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='torch.compile step time benchmark')
+    parser.add_argument('--arch', default='cifar10_rnn_gate_38', type=str)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch intra-op threads (default: 0, keep torch default)')
+    return parser.parse_args()
+
+
+def bench(model, input, target, args):
+    optimizer = make_optimizer(model)
+    criterion = make_criterion()
+    model.train()
+
+    def step():
+        train_step(model, optimizer, criterion, input, target)
+        model.control.repackage_hidden()
+
+    return time_steps(step, args.iters, warmup=args.warmup)
+
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    input, target = synthetic_batch(args.batch_size)
+
+    eager = build_model(args.arch, unroll_lstm=True)
+    eager_times = bench(eager, input, target, args)
+
+    compiled = build_model(args.arch, unroll_lstm=True)
+    explain = torch._dynamo.explain(compiled)(input)
+    print('graphs: {}, graph breaks: {}'.format(
+        explain.graph_count, explain.graph_break_count))
+    for reason in explain.break_reasons:
+        print('  break: {}'.format(reason.reason))
+    torch._dynamo.reset()
+    compiled.compile()
+    # the first steps include compilation time
+    compiled_times = bench(compiled, input, target, args)
+
+    for name, times in (('eager', eager_times), ('compiled', compiled_times)):
+        print('{:>9}: median {:.2f} ms, p90 {:.2f} ms, {:.1f} img/s'.format(
+            name, 1e3 * np.median(times), 1e3 * np.percentile(times, 90),
+            args.batch_size / np.median(times)))
+    print('speedup: {:.2f}x'.format(np.median(eager_times) / np.median(compiled_times)))
+
+if __name__ == '__main__':
+    main()
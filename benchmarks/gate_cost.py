@@ -0,0 +1,88 @@
+"""Cost of the gate embedding against the block it follows, per group
+
+For the first block of every group, times forward + backward of the block
+and of the gate embedding on its output: the former
+`Sequential(AvgPool2d, conv1x1)` head, and `GateHead` unquantized and
+quantized (`--predictive-gate`).
+
+    python -m benchmarks.gate_cost --arch cifar10_rnn_gate_38 --batch-size 64
+"""
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from benchmarks.common import SIGNSGD_CONFIG, build_model, synthetic_batch, time_steps
+from models.efficient_resnet import GateHead, conv1x1
+from models.quantize import quant_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='gate head cost benchmark')
+    parser.add_argument('--arch', default='cifar10_rnn_gate_38', type=str)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch intra-op threads (default: 0, keep torch default)')
+    return parser.parse_args()
+
+
+def block_inputs(model, input):
+    """Input of the first block of each group, captured in one forward pass"""
+    first = {}
+    for k, (group_id, _) in enumerate(model.block_ids):
+        first.setdefault(group_id, k)
+    inputs = {}
+    hooks = [model.layers[k].register_forward_pre_hook(
+        lambda m, args, g=g: inputs.setdefault(g, args[0].detach()))
+        for g, k in first.items()]
+    with torch.no_grad():
+        model(input)
+    for h in hooks:
+        h.remove()
+    return [(g, first[g], inputs[g]) for g in sorted(first)]
+
+
+def fwd_bwd_ms(module, x, iters):
+    x = x.clone().requires_grad_()
+
+    def step():
+        module.zero_grad()
+        module(x).sum().backward()
+
+    return 1e3 * np.median(time_steps(step, iters))
+
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    input, _ = synthetic_batch(args.batch_size)
+    model = build_model(args.arch)
+    model.train()
+    config = quant_config(SIGNSGD_CONFIG)
+
+    print('{:>5s} {:>6s} | {:>9s} | {:>9s} {:>9s} {:>9s} | {:>7s} {:>7s}'.format(
+        'group', 'shape', 'block ms', 'conv ms', 'head ms', 'q-head ms', 'conv/bl', 'head/bl'))
+    for group_id, k, x in block_inputs(model, input):
+        block = model.layers[k]
+        out = block(x).detach()
+        channels, size = out.size(1), out.size(2)
+        heads = [
+            nn.Sequential(nn.AvgPool2d(size),
+                          conv1x1(channels, model.embed_dim, input_signed=True,
+                                  predictive_forward=False, config=config)),
+            GateHead(channels, model.embed_dim),
+            GateHead(channels, model.embed_dim, config=config),
+        ]
+        block_ms = fwd_bwd_ms(block, x, args.iters)
+        head_ms = [fwd_bwd_ms(head.train(), out, args.iters) for head in heads]
+        print('{:>5d} {:>6s} | {:>9.2f} | {:>9.2f} {:>9.2f} {:>9.2f} | {:>6.1f}% {:>6.1f}%'.format(
+            group_id, '{}x{}'.format(channels, size), block_ms, *head_ms,
+            100 * head_ms[0] / block_ms, 100 * head_ms[1] / block_ms))
+
+
+if __name__ == '__main__':
+    main()
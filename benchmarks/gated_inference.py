@@ -0,0 +1,76 @@
+"""CPU inference throughput of the gated ResNet, full batch vs. regrouped
+
+`ResNetRecurrentGateSP.gated_inference` either runs every block on the
+whole batch, or only on the samples whose gate executes it. Pass a
+checkpoint of `main_all.py` to measure at the skip ratios of the learned
+gates; otherwise `--gate-bias` shifts the untrained gates (negative values
+skip more blocks).
+
+    python -m benchmarks.gated_inference --arch cifar10_rnn_gate_38 \\
+        --checkpoint save_checkpoints/cifar10_rnn_gate_38/model_best.pth.tar
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import build_model, synthetic_batch, time_steps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='regrouped gated inference benchmark')
+    parser.add_argument('--arch', default='cifar10_rnn_gate_38', type=str)
+    parser.add_argument('--checkpoint', default='', type=str,
+                        help='checkpoint of main_all.py to take the gates from')
+    parser.add_argument('--gate-bias', default='0', type=str,
+                        help='comma separated offsets of the gate logits, without a checkpoint')
+    parser.add_argument('--batch-size', default=256, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch intra-op threads (default: 0, keep torch default)')
+    return parser.parse_args()
+
+
+def load_checkpoint(model, path):
+    state_dict = torch.load(path, map_location='cpu')['state_dict']
+    # saved from the DataParallel wrapper
+    state_dict = {k[len('module.'):] if k.startswith('module.') else k: v
+                  for k, v in state_dict.items()}
+    model.load_state_dict(state_dict, strict=False)
+
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    input, _ = synthetic_batch(args.batch_size)
+
+    model = build_model(args.arch)
+    if args.checkpoint:
+        load_checkpoint(model, args.checkpoint)
+        offsets = [0.]
+    else:
+        offsets = [float(b) for b in args.gate_bias.split(',')]
+    model.eval()
+    bias = model.control.proj.bias.data.clone()
+
+    print('{:>8s} {:>8s} | {:>10s} {:>10s} {:>8s} | {:>10s}'.format(
+        'offset', 'skipped', 'full img/s', 'regr img/s', 'speedup', 'max diff'))
+    for offset in offsets:
+        model.control.proj.bias.data.copy_(bias + offset)
+        full, executed = model.gated_inference(input, regroup=False)
+        regrouped, _ = model.gated_inference(input, regroup=True)
+
+        t_full = np.median(time_steps(lambda: model.gated_inference(input, regroup=False),
+                                      args.iters))
+        t_regrouped = np.median(time_steps(lambda: model.gated_inference(input, regroup=True),
+                                           args.iters))
+        print('{:>8.2f} {:>8.3f} | {:>10.1f} {:>10.1f} {:>7.2f}x | {:>10.2e}'.format(
+            offset, 1 - np.mean(executed), args.batch_size / t_full,
+            args.batch_size / t_regrouped, t_full / t_regrouped,
+            (full - regrouped).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
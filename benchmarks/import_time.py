@@ -0,0 +1,83 @@
+"""Start-up cost of the entry points, measured in fresh interpreters
+
+    python -m benchmarks.import_time --repeat 5
+
+Only uses the standard library, so `main_all.py --help` can be checked in
+an environment without torch.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+CASES = [
+    ('import models', [sys.executable, '-c', 'import models']),
+    ('models.get_model', [sys.executable, '-c',
+                           'import models; models.get_model("cifar10_rnn_gate_74")']),
+    ('main_all.py --help', [sys.executable, 'main_all.py', '--help']),
+]
+
+# third party packages `main_all.py --help` should not import
+HEAVY_MODULES = ('numpy', 'torch', 'torchvision', 'tensorboardX', 'scipy')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='import time benchmark')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--top', default=10, type=int,
+                        help='print the slowest imports of `import models`')
+    return parser.parse_args()
+
+
+def wall_time(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def imports(args):
+    """(cumulative us, module) of every import of `python -X importtime args`"""
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), module.strip()))
+    return rows
+
+
+def slowest_imports(statement, top):
+    return sorted(imports(['-c', statement]), reverse=True)[:top]
+
+
+def main():
+    args = parse_args()
+    for name, cmd in CASES:
+        try:
+            times = wall_time(cmd, args.repeat)
+        except subprocess.CalledProcessError:
+            print('{:>22}: failed (missing dependencies?)'.format(name))
+            continue
+        print('{:>22}: median {:.3f} s, min {:.3f} s'.format(
+            name, statistics.median(times), min(times)))
+
+    heavy = sorted({module for _, module in imports(['main_all.py', '--help'])
+                    if module.split('.')[0] in HEAVY_MODULES})
+    print('heavy imports of `main_all.py --help`: {}'.format(', '.join(heavy) or 'none'))
+
+    print('slowest imports of `import models` (cumulative):')
+    for cumulative, module in slowest_imports('import models', args.top):
+        print('  {:>10.1f} ms  {}'.format(cumulative / 1e3, module))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Timings of the quantization and predictive kernels on CIFAR-sized tensors
+
+Every case is timed with `torch.utils.benchmark` on the CPU. The results go
+to a JSON file; given a baseline of an earlier run, cases that got slower
+than `--tolerance` are reported and the script exits with status 1.
+
+    python -m benchmarks.kernels --output kernels.json
+    python -m benchmarks.kernels --baseline kernels.json --tolerance 0.15
+"""
+
+import argparse
+import json
+import platform
+import re
+import sys
+
+import torch
+import torch.utils.benchmark as benchmark
+
+from benchmarks.common import SIGNSGD_CONFIG
+from models import conv, conv_efficient
+from models.efficient_resnet import RNNGate
+from models.predictive import quant_weight, efficient_quant_weight
+from models.quantize import quantize, efficient_quantize, calculate_qparams
+
+# (channels, height and width) of the three groups of the CIFAR ResNets
+CIFAR_SHAPES = [(16, 32), (32, 16), (64, 8)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='quantization kernel benchmarks')
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--min-run-time', default=0.5, type=float,
+                        help='seconds spent on each case (default: 0.5)')
+    parser.add_argument('--filter', default='', type=str,
+                        help='only run the cases whose name matches this regular expression')
+    parser.add_argument('--output', default='', type=str, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default='', type=str,
+                        help='JSON file of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative slowdown reported as a regression (default: 0.1)')
+    return parser.parse_args()
+
+
+def predictive_conv(module, channels):
+    return module.PredictiveConv2d(channels, channels, kernel_size=3, padding=1,
+                                   input_signed=False, **SIGNSGD_CONFIG)
+
+
+def cases(batch_size):
+    """(name, fn) of every benchmark case"""
+    torch.manual_seed(0)
+    for channels, size in CIFAR_SHAPES:
+        shape = '{}x{}x{}x{}'.format(batch_size, channels, size, size)
+        x = torch.rand(batch_size, channels, size, size)
+        weight = torch.randn(channels, channels, 3, 3)
+
+        yield 'quantize/' + shape, lambda x=x: quantize(x, num_bits=8, flatten_dims=(1, -1))
+        yield 'efficient_quantize/' + shape, \
+            lambda x=x: efficient_quantize(x, num_bits=8, msb_bits=4, flatten_dims=(1, -1))
+        yield 'calculate_qparams/' + shape, \
+            lambda x=x: calculate_qparams(x, num_bits=8, flatten_dims=(1, -1))
+        yield 'quant_weight/{}x{}x3x3'.format(channels, channels), \
+            lambda w=weight: quant_weight(w, num_bits_weight=8, msb_bits_weight=4)
+        yield 'efficient_quant_weight/{}x{}x3x3'.format(channels, channels), \
+            lambda w=weight: efficient_quant_weight(w, num_bits_weight=8, msb_bits_weight=4)
+
+        for module in (conv, conv_efficient):
+            layer = predictive_conv(module, channels).train()
+            name = module.__name__.split('.')[-1]
+            x_grad = x.clone().requires_grad_()
+            grad = torch.randn(batch_size, channels, size, size)
+
+            def forward(layer=layer, x=x):
+                with torch.no_grad():
+                    layer(x)
+
+            def forward_backward(layer=layer, x=x_grad, grad=grad):
+                layer.weight.grad = None
+                layer(x).backward(grad)
+
+            yield '{}.forward/{}'.format(name, shape), forward
+            yield '{}.forward_backward/{}'.format(name, shape), forward_backward
+
+    gate = RNNGate(10, 10)
+    embedding = torch.randn(batch_size, 10, requires_grad=True)
+
+    def gate_step():
+        gate.zero_grad()
+        gate.hidden = gate.init_hidden(batch_size)
+        _, prob = gate(embedding)
+        prob.sum().backward()
+
+    yield 'rnn_gate.forward_backward/{}x10'.format(batch_size), gate_step
+
+
+def run(args):
+    pattern = re.compile(args.filter)
+    results = {}
+    for name, fn in cases(args.batch_size):
+        if not pattern.search(name):
+            continue
+        kernel, shape = name.split('/')
+        timer = benchmark.Timer(stmt='fn()', globals={'fn': fn}, num_threads=args.threads,
+                                label=kernel, sub_label=shape)
+        m = timer.blocked_autorange(min_run_time=args.min_run_time)
+        results[name] = {'median_us': 1e6 * m.median, 'iqr_us': 1e6 * m.iqr,
+                         'runs': len(m.times)}
+        print('{:<52s} {:>12.1f} us  (iqr {:.1f})'.format(
+            name, results[name]['median_us'], results[name]['iqr_us']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every case against `baseline`, return the regressions"""
+    regressions = []
+    print('\n{:<52s} {:>12s} {:>12s} {:>8s}'.format('case', 'baseline us', 'now us', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before, now = baseline[name]['median_us'], result['median_us']
+        change = now / before - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<52s} {:>12.1f} {:>12.1f} {:>+7.1f}%{}'.format(
+            name, before, now, 100 * change, flag))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    report = {
+        'meta': {'torch': torch.__version__, 'python': platform.python_version(),
+                 'machine': platform.machine(), 'threads': args.threads,
+                 'batch_size': args.batch_size},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('threads') != args.threads or \
+                baseline['meta'].get('batch_size') != args.batch_size:
+            print('warning: baseline was run with {}'.format(baseline['meta']))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('{} regression(s) above {:.0f}%'.format(len(regressions), 100 * args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
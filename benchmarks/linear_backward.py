@@ -0,0 +1,101 @@
+"""Weight gradient of the predictive linear layers across batch sizes
+
+Compares the former `[batch, out, in]` bmm reduction of
+`PredictiveLinearFunction` with the single matmul it uses now, and the
+autograd `PredictiveLinear` with its fused sparse backward. Peak memory is
+measured on CUDA; on the CPU the size of the bmm intermediate is reported.
+
+    python -m benchmarks.linear_backward --in-features 512 --out-features 100
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import time_steps
+from models.new_linear import PredictiveLinear, PredictiveLinearFunction
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='predictive linear backward benchmark')
+    parser.add_argument('--in-features', default=512, type=int)
+    parser.add_argument('--out-features', default=100, type=int)
+    parser.add_argument('--batch-sizes', default='128,256,512,1024,2048,4096', type=str)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def bmm_weight_grad(grad_output, input):
+    """The weight gradient `PredictiveLinearFunction` used to compute"""
+    return torch.bmm(grad_output.unsqueeze(2), input.unsqueeze(1)).sum(dim=0).sign()
+
+
+def measure(fn, iters, device):
+    """Median time (ms) and peak memory above the baseline (MB, CUDA only)"""
+    peak = float('nan')
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+
+        def timed():
+            fn()
+            torch.cuda.synchronize()
+    else:
+        timed = fn
+    times = time_steps(timed, iters)
+    if device.type == 'cuda':
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20
+    return 1e3 * np.median(times), peak
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    weight = torch.randn(args.out_features, args.in_features, device=device, requires_grad=True)
+    bias = torch.zeros(args.out_features, device=device, requires_grad=True)
+    layers = {}
+    for sparse_backward in (False, True):
+        torch.manual_seed(0)
+        layers[sparse_backward] = PredictiveLinear(
+            args.in_features, args.out_features, num_bits=8, num_bits_weight=8,
+            num_bits_grad=16, biprecision=False, predictive_forward=False,
+            msb_bits=8, msb_bits_weight=8, msb_bits_grad=16, threshold=-0.05,
+            sign=True, sparse_backward=sparse_backward).to(device)
+
+    print('{:>6s} | {:>9s} {:>9s} {:>9s} | {:>9s} {:>9s} | {:>10s} {:>10s}'.format(
+        'batch', 'bmm MB', 'bmm ms', 'mm ms', 'layer ms', 'fused ms', 'mm peak', 'fused peak'))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        input = torch.rand(batch_size, args.in_features, device=device)
+        grad = torch.randn(batch_size, args.out_features, device=device)
+
+        bmm_ms, _ = measure(lambda: bmm_weight_grad(grad, input), args.iters, device)
+
+        def mm_step():
+            weight.grad = bias.grad = None
+            PredictiveLinearFunction.apply(input, weight, bias).backward(grad)
+
+        mm_ms, mm_peak = measure(mm_step, args.iters, device)
+        # same signs up to entries summing to ~0 in a different order
+        assert (weight.grad != bmm_weight_grad(grad, input)).float().mean() < 1e-3
+
+        results = []
+        for sparse_backward in (False, True):
+            layer = layers[sparse_backward]
+
+            def layer_step():
+                layer.zero_grad()
+                layer(input).backward(grad)
+
+            results.append(measure(layer_step, args.iters, device))
+
+        print('{:>6d} | {:>9.1f} {:>9.2f} {:>9.2f} | {:>9.2f} {:>9.2f} | {:>10.1f} {:>10.1f}'.format(
+            batch_size, batch_size * weight.numel() * 4 / 2 ** 20, bmm_ms, mm_ms,
+            results[0][0], results[1][0], mm_peak, results[1][1]))
+
+
+if __name__ == '__main__':
+    main()
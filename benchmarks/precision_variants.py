@@ -0,0 +1,63 @@
+"""Several differently quantized copies of one architecture in one process
+
+Each variant gets its own `QuantConfig`; the script checks that the layers
+really carry their variant's precision and reports the CPU step time of each.
+
+    python -m benchmarks.precision_variants --arch cifar10_rnn_gate_38
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import (build_model, synthetic_batch, train_step, time_steps,
+                               make_optimizer, make_criterion)
+from models.conv_efficient import PredictiveConv2d
+
+
+VARIANTS = [
+    {'num_bits': 8, 'num_bits_weight': 8, 'msb_bits': 8, 'msb_bits_weight': 8, 'msb_bits_grad': 16},
+    {'num_bits': 8, 'num_bits_weight': 8, 'msb_bits': 4, 'msb_bits_weight': 4, 'msb_bits_grad': 8},
+    {'num_bits': 6, 'num_bits_weight': 6, 'msb_bits': 4, 'msb_bits_weight': 4, 'msb_bits_grad': 8},
+    {'num_bits': 4, 'num_bits_weight': 4, 'msb_bits': 2, 'msb_bits_weight': 2, 'msb_bits_grad': 4},
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='precision variants benchmark')
+    parser.add_argument('--arch', default='cifar10_rnn_gate_38', type=str)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    input, target = synthetic_batch(args.batch_size)
+    criterion = make_criterion()
+
+    variants = [build_model(args.arch, **overrides) for overrides in VARIANTS]
+    for overrides, model in zip(VARIANTS, variants):
+        for m in model.modules():
+            if isinstance(m, PredictiveConv2d):
+                assert m.num_bits == overrides['num_bits'], m.writer_prefix
+                assert m.msb_bits_grad == overrides['msb_bits_grad'], m.writer_prefix
+
+    for overrides, model in zip(VARIANTS, variants):
+        optimizer = make_optimizer(model)
+        model.train()
+
+        def step():
+            train_step(model, optimizer, criterion, input, target)
+            model.control.repackage_hidden()
+
+        times = time_steps(step, args.iters)
+        print('bits {num_bits}/{num_bits_weight} msb {msb_bits}/{msb_bits_weight} '
+              'msb_grad {msb_bits_grad}: '.format(**overrides) +
+              'median {:.2f} ms, {:.1f} img/s'.format(
+                  1e3 * np.median(times), args.batch_size / np.median(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Forward + backward time of one predictive convolution, dense vs. sparse weight gradient
+
+The gradient is built so that a given fraction of the filters has MSB
+weight gradients above the threshold everywhere; the sparse backward skips
+their full precision weight gradient.
+
+    python -m benchmarks.sparse_backward --channels 64 --batch-size 64
+"""
+
+import argparse
+import copy
+
+import numpy as np
+import torch
+
+from benchmarks.common import time_steps
+from models.conv_efficient import PredictiveConv2d
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='sparse predictive backward benchmark')
+    parser.add_argument('--channels', default=64, type=int)
+    parser.add_argument('--size', default=32, type=int, help='input height and width')
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch intra-op threads (default: 0, keep torch default)')
+    return parser.parse_args()
+
+
+def build_layer(channels, sparse_backward):
+    torch.manual_seed(0)
+    return PredictiveConv2d(
+        channels, channels, kernel_size=3, padding=1,
+        num_bits=8, num_bits_weight=8, num_bits_grad=16, biprecision=False,
+        predictive_forward=False, predictive_backward=True,
+        msb_bits=8, msb_bits_weight=8, msb_bits_grad=16,
+        threshold=1.0, sparsify=False, sign=False, sparse_backward=sparse_backward)
+
+
+def make_grad(batch_size, channels, size, trusted):
+    """Large positive gradients for the first `trusted` filters, tiny ones
+    (quantized to zero in the MSB gradient) for the rest"""
+    g = torch.Generator().manual_seed(1)
+    grad = 1e-7 * torch.rand(batch_size, channels, size, size, generator=g)
+    grad[:, :trusted] = 1e2 * (1 + torch.rand(batch_size, trusted, size, size, generator=g))
+    return grad
+
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    dense = build_layer(args.channels, sparse_backward=False)
+    sparse = build_layer(args.channels, sparse_backward=True)
+    sparse.load_state_dict(copy.deepcopy(dense.state_dict()))
+    # post-ReLU activations, so that every weight gradient of a trusted filter is large
+    input = torch.rand(args.batch_size, args.channels, args.size, args.size)
+
+    print('{:>8s} {:>12s} {:>12s} {:>8s} {:>10s}'.format(
+        'trusted', 'dense (ms)', 'sparse (ms)', 'speedup', 'max diff'))
+    for fraction in (0., 0.25, 0.5, 0.75, 0.9, 1.):
+        trusted = int(round(fraction * args.channels))
+        grad = make_grad(args.batch_size, args.channels, args.size, trusted)
+
+        results = []
+        for layer in (dense, sparse):
+            x = input.clone().requires_grad_()
+
+            def step():
+                layer.weight.grad = None
+                layer(x).backward(grad)
+
+            times = time_steps(step, args.iters)
+            results.append((np.median(times), layer.weight.grad.clone()))
+
+        (t_dense, g_dense), (t_sparse, g_sparse) = results
+        print('{:>8.2f} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.2e}'.format(
+            fraction, 1e3 * t_dense, 1e3 * t_sparse, t_dense / t_sparse,
+            (g_dense - g_sparse).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Background, atomic checkpoint writing
+"""
+
+import os
+import random
+import shutil
+import threading
+import queue
+
+import numpy as np
+import torch
+
+from models.quantize import rounding_state, set_rounding_state
+
+
+def snapshot_state(obj):
+    """Copy every tensor in a (nested) state dict to CPU memory"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        copied = type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+        # keep the module versions recorded by `state_dict()`
+        if hasattr(obj, '_metadata'):
+            copied._metadata = obj._metadata
+        return copied
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    else:
+        return obj
+
+
+def get_rng_state():
+    """Python, NumPy, torch, (if present) CUDA and stochastic rounding
+    random generator states"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'rounding': rounding_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if 'rounding' in state:
+        set_rounding_state(state['rounding'])
+
+
+def atomic_save(state, filename):
+    """`torch.save` to a temporary file, then rename it over `filename`"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def atomic_link(src, dst):
+    """Point `dst` at the same file as `src` with a hardlink (copy if unsupported)"""
+    tmp_dst = dst + '.tmp'
+    if os.path.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+class CheckpointManager(object):
+    """Writes checkpoints from a background thread.
+
+    `save` snapshots the state to CPU on the calling thread and returns; the
+    thread serializes it to a temporary file and renames it into place, so a
+    crash never leaves a truncated checkpoint behind. `checkpoint_latest` and
+    `model_best_eic` are hardlinks to the numbered files instead of copies.
+    Only the last `keep` numbered checkpoints are kept (all if `keep` <= 0).
+    At most one checkpoint is in flight: `save` waits for the previous one
+    to be written before taking its snapshot, so there is never more than
+    one host copy of the state.
+    """
+
+    latest_name = 'checkpoint_latest.pth.tar'
+    best_name = 'model_best_eic.pth.tar'
+
+    def __init__(self, save_path, keep=0):
+        self.save_path = save_path
+        self.keep = keep
+        self.saved = []
+        self._error = None
+        self._queue = queue.Queue(1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, state, is_best, filename):
+        self._queue.join()
+        self._raise_error()
+        self._queue.put((snapshot_state(state), is_best, filename))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, is_best, filename):
+        atomic_save(state, filename)
+        atomic_link(filename, os.path.join(self.save_path, self.latest_name))
+        if is_best:
+            atomic_link(filename, os.path.join(self.save_path, self.best_name))
+
+        self.saved.append(filename)
+        while self.keep > 0 and len(self.saved) > self.keep:
+            os.remove(self.saved.pop(0))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Wait for the pending checkpoint to be written"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
@@ -4,6 +4,7 @@
 from __future__ import print_function
 
 import torch
+import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as transforms
 import numpy as np
@@ -11,10 +12,45 @@ import numpy as np
 
 crop_size = 32
 padding = 4
+cifar_mean = (0.4914, 0.4822, 0.4465)
+cifar_std = (0.2023, 0.1994, 0.2010)
+
+
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """Random sampler whose permutation only depends on `seed` and the epoch.
+
+    `set_state(epoch, start_index)` makes the next pass start in the middle
+    of that epoch's permutation, so a resumed run skips the samples it has
+    already seen without loading or decoding them.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_state(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator)
+        indices = indices[self.start_index:].tolist()
+        self.epoch += 1
+        self.start_index = 0
+        return iter(indices)
+
+    def __len__(self):
+        return len(self.data_source) - self.start_index
 
 
 def prepare_train_data(dataset='cifar10', batch_size=128,
-                       shuffle=True, num_workers=4):
+                       shuffle=True, num_workers=4, seed=None):
+    """When `shuffle` and `seed` is given, the loader uses a
+    `ResumableRandomSampler` seeded with `seed`"""
 
     if 'cifar' in dataset:
         transform_train = transforms.Compose([
@@ -27,9 +63,13 @@ def prepare_train_data(dataset='cifar10', batch_size=128,
 
         trainset = torchvision.datasets.__dict__[dataset.upper()](
             root='/tmp/data', train=True, download=True, transform=transform_train)
+        sampler = None
+        if shuffle and seed is not None:
+            sampler, shuffle = ResumableRandomSampler(trainset, seed), False
         train_loader = torch.utils.data.DataLoader(trainset,
                                                    batch_size=batch_size,
                                                    shuffle=shuffle,
+                                                   sampler=sampler,
                                                    num_workers=num_workers)
     elif 'svhn' in dataset:
         transform_train =transforms.Compose([
@@ -60,9 +100,13 @@ def prepare_train_data(dataset='cifar10', batch_size=128,
 
         total_data =  torch.utils.data.ConcatDataset([trainset, extraset])
 
+        sampler = None
+        if shuffle and seed is not None:
+            sampler, shuffle = ResumableRandomSampler(total_data, seed), False
         train_loader = torch.utils.data.DataLoader(total_data,
                                                    batch_size=batch_size,
                                                    shuffle=shuffle,
+                                                   sampler=sampler,
                                                    num_workers=num_workers)
     else:
         train_loader = None
@@ -106,3 +150,70 @@ def prepare_test_data(dataset='cifar10', batch_size=128,
     else:
         test_loader = None
     return test_loader
+
+
+def load_cifar_in_memory(dataset='cifar10', train=True):
+    """Decode a whole CIFAR split once: uint8 images [N, 3, 32, 32] and labels"""
+    data = torchvision.datasets.__dict__[dataset.upper()](
+        root='/tmp/data', train=train, download=True)
+    images = torch.from_numpy(data.data).permute(0, 3, 1, 2).contiguous()
+    labels = torch.tensor(data.targets, dtype=torch.long)
+    return images, labels
+
+
+def augment_batch(images, train=True, generator=None):
+    """Batched version of the CIFAR transforms of `prepare_train_data`.
+
+    Random crop with zero padding and horizontal flip (if `train`), then
+    normalization, all on the device of the uint8 `images`.
+    """
+    x = images.float().div_(255)
+    if train:
+        n, device = x.size(0), x.device
+        x = F.pad(x, (padding, padding, padding, padding))
+        offsets = torch.randint(0, 2 * padding + 1, (2, n), generator=generator).to(device)
+        grid = torch.arange(crop_size, device=device)
+        rows = (offsets[0].view(n, 1) + grid).view(n, 1, crop_size, 1)
+        cols = (offsets[1].view(n, 1) + grid).view(n, 1, 1, crop_size)
+        x = x[torch.arange(n, device=device).view(n, 1, 1, 1),
+              torch.arange(x.size(1), device=device).view(1, -1, 1, 1), rows, cols]
+        flip = (torch.rand(n, generator=generator) < 0.5).to(device)
+        x = torch.where(flip.view(n, 1, 1, 1), x.flip(3), x)
+    mean = x.new_tensor(cifar_mean).view(1, -1, 1, 1)
+    std = x.new_tensor(cifar_std).view(1, -1, 1, 1)
+    return (x - mean) / std
+
+
+class InMemoryTrainStream(object):
+    """Endless stream of augmented batches from a dataset kept on `device`.
+
+    Decoding happens once; every consumer of the stream (e.g. all runs of a
+    sweep) sees the same batches.
+    """
+
+    def __init__(self, images, labels, batch_size=128, device='cuda', seed=0):
+        self.images = images.to(device)
+        self.labels = labels.to(device)
+        self.batch_size = batch_size
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self._order = None
+        self._pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._order is None or self._pos >= len(self._order):
+            self._order = torch.randperm(len(self.images), generator=self.generator).to(self.images.device)
+            self._pos = 0
+        idx = self._order[self._pos:self._pos + self.batch_size]
+        self._pos += self.batch_size
+        return augment_batch(self.images[idx], train=True, generator=self.generator), self.labels[idx]
+
+
+def in_memory_test_batches(images, labels, batch_size=128, device='cuda'):
+    """The test split as a list of normalized (input, target) batches on `device`"""
+    images, labels = images.to(device), labels.to(device)
+    return [(augment_batch(images[i:i + batch_size], train=False), labels[i:i + batch_size])
+            for i in range(0, len(images), batch_size)]
@@ -1,35 +1,56 @@
 from __future__ import print_function
 
-import torch
-import torch.nn as nn
-import torch.backends.cudnn as cudnn
-from torch.autograd import Variable
-
 import os
-import shutil
+import copy
+import itertools
 import argparse
 import time
 import logging
 import models
 import random
-import numpy as np
-from data import *
-from functools import reduce
-from tensorboardX import SummaryWriter
-from meters import accuracy
+import json
+
+def import_dependencies():
+    """Import numpy, torch, the data pipeline and the model code for the
+    commands; deferred until the arguments are parsed, so that `--help`
+    doesn't pay for them"""
+    global np, torch, nn, cudnn, Variable
+    global prepare_train_data, prepare_test_data
+    global load_cifar_in_memory, in_memory_test_batches, InMemoryTrainStream
+    global AsyncScalarWriter, CheckpointManager, get_rng_state, set_rng_state
+    global grad_stats_snapshot, PrecisionSchedule, ThresholdController, gate_costs
+    global predictive_layers, set_precision, layer_macs, energy_report, log_energy_report
+    global profiling, phase, saved_tensor_report, set_rounding_seed
+
+    import numpy as np
+    import torch
+    import torch.nn as nn
+    import torch.backends.cudnn as cudnn
+    from torch.autograd import Variable
+
+    from data import prepare_train_data, prepare_test_data
+    from data import load_cifar_in_memory, in_memory_test_batches, InMemoryTrainStream
+    from meters import AsyncScalarWriter
+    from checkpoint import CheckpointManager, get_rng_state, set_rng_state
+    from models.predictive import grad_stats_snapshot
+    from models.precision import PrecisionSchedule, ThresholdController, predictive_layers, set_precision
+    from models.precision import layer_macs, energy_report, log_energy_report, gate_costs
+    from models import profiling
+    from models.memory import saved_tensor_report
+    from models.profiling import phase
+    from models.quantize import set_rounding_seed
+
 
 def str2bool(s):
     return s.lower() in ['yes', '1', 'true', 'y']
 
-model_names = sorted(name for name in models.__dict__
-                     if name.islower() and not name.startswith('__')
-                     and callable(models.__dict__[name]))
+model_names = models.model_names()
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description='PyTorch CIFAR10 training')
-    parser.add_argument('cmd', choices=['train', 'test'])
+    parser.add_argument('cmd', choices=['train', 'test', 'sweep', 'bench'])
     parser.add_argument('arch', metavar='ARCH',
                         default='cifar10_rnn_gate_74',
                         choices=model_names,
@@ -57,6 +78,9 @@ def parse_args():
                         help='print frequency (default: 10)')
     parser.add_argument('--resume', default='', type=str,
                         help='path to  latest checkpoint (default: None)')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='seed of the training data order (default: random, '
+                             'restored from the checkpoint on resume)')
     parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                         help='use pretrained model')
     parser.add_argument('--step-ratio', default=0.1, type=float,
@@ -69,6 +93,8 @@ def parse_args():
                         help='folder to save the checkpoints')
     parser.add_argument('--eval-every', default=1000, type=int,
                         help='evaluate model every (default: 1000) iterations')
+    parser.add_argument('--keep-checkpoints', default=0, type=int,
+                        help='number of numbered checkpoints to keep (default: 0, keep all)')
     parser.add_argument('--verbose', action="store_true",
                         help='print layer skipping ratio at training')
     parser.add_argument('--energy', default=1, type=int,
@@ -103,6 +129,61 @@ def parse_args():
                         help='sparsify the gradients using predictive net method')
     parser.add_argument('--sign', default=True, type=str2bool,
                         help='take sign before applying gradient')
+    parser.add_argument('--sparse-backward', default=False, type=str2bool,
+                        help='only compute the full precision weight gradient of the filters that need it')
+    parser.add_argument('--pack-saved', default=False, type=str2bool,
+                        help='keep quantized activations (8 bits or fewer) for backward as packed integer codes')
+    parser.add_argument('--stochastic-grad', default=False, type=str2bool,
+                        help='round the quantized gradients stochastically, for num-bits-grad of 8 or fewer '
+                             '(seeded by --seed)')
+    parser.add_argument('--per-channel-act', default=False, type=str2bool,
+                        help='one activation scale per input channel of the convolutions instead of per tensor')
+    parser.add_argument('--predictive-fc', default=False, type=str2bool,
+                        help='quantize the classifier like the convolutions')
+    parser.add_argument('--predictive-gate', default=False, type=str2bool,
+                        help='quantize the embedding and the projection of the recurrent gate like the convolutions')
+    parser.add_argument('--gate-groups', default=1, type=int,
+                        help='gate groups of output channels instead of whole blocks (default: 1, whole blocks)')
+    parser.add_argument('--compile', default=False, type=str2bool,
+                        help='compile the model forward with torch.compile')
+    parser.add_argument('--stats-every', default=200, type=int,
+                        help='log per-layer gradient statistics every (default: 200) iterations')
+    parser.add_argument('--precision-schedule', default='', type=str,
+                        help='JSON file with per-layer precision rules (see models/precision.py)')
+    parser.add_argument('--eval-num-bits', default='', type=str,
+                        help='test: also evaluate with the activations of every predictive layer '
+                             'at each of these comma separated bit widths, e.g. 4,5,6')
+    parser.add_argument('--target-full-precision', default=None, type=float,
+                        help='adapt per-layer thresholds so that this fraction of weight '
+                             'gradients is computed at full precision (default: fixed threshold)')
+    parser.add_argument('--threshold-every', default=50, type=int,
+                        help='update the adaptive thresholds every (default: 50) iterations')
+    parser.add_argument('--threshold-gain', default=0.5, type=float,
+                        help='step size of the adaptive threshold controller')
+    # `sweep`: comma separated values, every combination is trained in this process
+    parser.add_argument('--sweep-threshold', default='', type=str,
+                        help='values of --threshold to sweep')
+    parser.add_argument('--sweep-msb-bits-grad', default='', type=str,
+                        help='values of --msb_bits_grad to sweep')
+    parser.add_argument('--sweep-beta', default='', type=str,
+                        help='values of --beta to sweep')
+    parser.add_argument('--sweep-minimum', default='', type=str,
+                        help='values of --minimum to sweep')
+    parser.add_argument('--profile-every', default=0, type=int,
+                        help='profile the phases of the training step every (default: 0, never) '
+                             'iterations; tables go to the log, Chrome traces to SAVE_PATH/profile')
+    parser.add_argument('--profile-steps', default=5, type=int,
+                        help='iterations recorded per profile (default: 5)')
+    parser.add_argument('--mem-report', default=False, type=str2bool,
+                        help='log the activation memory saved for backward per layer and branch '
+                             'before training (also written to SAVE_PATH/mem_report.json)')
+    # `bench`: training steps on synthetic data
+    parser.add_argument('--bench-archs', default='', type=str,
+                        help='comma separated architectures to benchmark, or `all` (default: ARCH)')
+    parser.add_argument('--bench-iters', default=50, type=int,
+                        help='timed training steps per architecture (default: 50)')
+    parser.add_argument('--bench-warmup', default=5, type=int,
+                        help='untimed training steps per architecture (default: 5)')
     args = parser.parse_args()
     return args
 
@@ -136,6 +217,7 @@ def main():
                         format='%(asctime)s:%(message)s',
                         handlers=handlers)
 
+    import_dependencies()
     if args.cmd == 'train':
         logging.info('start training {}'.format(args.arch))
         run_training(args)
@@ -145,13 +227,16 @@ def main():
             args.arch, args.resume))
         test_model(args)
 
+    elif args.cmd == 'sweep':
+        logging.info('start sweeping {}'.format(args.arch))
+        run_sweep(args)
 
-def run_training(args):
+    elif args.cmd == 'bench':
+        run_bench(args)
 
-    writer_path = os.path.join('runs', args.exp_desc + '-' + time.strftime('%Y-%m-%d-%H:%M:%S', time.localtime()))
-    writer = SummaryWriter(writer_path)
 
-    signsgd_config = {
+def signsgd_config(args):
+    return {
         'num_bits': args.num_bits,
         'num_bits_weight': args.num_bits_weight,
         'num_bits_grad': args.num_bits_grad,
@@ -164,20 +249,52 @@ def run_training(args):
         'threshold': args.threshold,
         'sparsify': args.sparsify,
         'sign': args.sign,
-        'writer': writer,
+        'sparse_backward': args.sparse_backward,
+        'pack_saved': args.pack_saved,
+        'stochastic_grad': args.stochastic_grad,
+        'per_channel_act': args.per_channel_act,
+        'predictive_fc': args.predictive_fc,
+        'predictive_gate': args.predictive_gate,
+        'gate_groups': args.gate_groups,
     }
 
+
+def run_training(args):
+    global skip_count
+    global training_cost
+    # only needed for training, keep `--help` and `test` fast
+    from tensorboardX import SummaryWriter
+
+    writer_path = os.path.join('runs', args.exp_desc + '-' + time.strftime('%Y-%m-%d-%H:%M:%S', time.localtime()))
+    writer = SummaryWriter(writer_path)
+    scalar_writer = AsyncScalarWriter(writer)
+
     # create model
-    model = models.__dict__[args.arch](args.pretrained, **signsgd_config)
-    model.install_gate()
+    model = models.get_model(args.arch)(args.pretrained, **signsgd_config(args))
+    model.install_gate(unroll_lstm=args.compile)
+    # measured on the plain model, before it is compiled
+    gate_costs(model)
+    precision_schedule = threshold_controller = None
+    if args.precision_schedule or args.target_full_precision is not None:
+        macs = layer_macs(model)
+    if args.precision_schedule:
+        precision_schedule = PrecisionSchedule.from_file(args.precision_schedule)
+    if args.target_full_precision is not None:
+        threshold_controller = ThresholdController(
+            model, args.target_full_precision, macs=macs, gain=args.threshold_gain)
+    if args.compile:
+        model.compile()
     model = torch.nn.DataParallel(model).cuda()
+    if args.mem_report:
+        log_memory_report(args, model.module, torch.device('cuda'))
     best_prec1 = 0
 
     # optionally resume from a checkpoint
+    checkpoint = None
     if args.resume:
-        checkpoint = torch.load(args.resume)
         if os.path.isfile(args.resume):
             logging.info('=> loading checkpoint `{}`'.format(args.resume))
+            checkpoint = torch.load(args.resume, map_location='cpu')
 
             args.start_iter = 0
             best_prec1 = checkpoint['best_prec1']
@@ -189,11 +306,21 @@ def run_training(args):
         else:
             logging.info('=> no checkpoint found at `{}`'.format(args.resume))
 
+    # checkpoints written before the full training state was saved only
+    # restore the weights and restart the schedule
+    full_resume = checkpoint is not None and 'optimizer' in checkpoint
+    if full_resume:
+        args.seed = checkpoint['seed']
+    elif args.seed is None:
+        args.seed = random.randrange(2 ** 31)
+    set_rounding_seed(args.seed)
+
     cudnn.benchmark = True
     train_loader = prepare_train_data(dataset=args.dataset,
                                       batch_size=args.batch_size,
                                       shuffle=True,
-                                      num_workers=args.workers)
+                                      num_workers=args.workers,
+                                      seed=args.seed)
     test_loader = prepare_test_data(dataset=args.dataset,
                                     batch_size=args.batch_size,
                                     shuffle=False,
@@ -212,66 +339,74 @@ def run_training(args):
     top1 = AverageMeter()
     top5 = AverageMeter()
     cp_energy_record = AverageMeter()
+    full_precision_record = AverageMeter()
     skip_ratios = ListAverageMeter()
+    checkpoints = CheckpointManager(args.save_path, keep=args.keep_checkpoints)
+
+    if full_resume:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        set_rng_state(checkpoint['rng_state'])
+        skip_count = checkpoint['skip_count']
+        training_cost = checkpoint['training_cost']
+        args.start_iter = checkpoint['iter'] + 1
+        if threshold_controller is not None and checkpoint.get('thresholds'):
+            threshold_controller.load_state_dict(checkpoint['thresholds'])
+        # every iteration draws one batch, skipped or not; continue with the
+        # next batch of the same epoch without decoding the earlier ones
+        epoch_len = (len(train_loader.dataset) + args.batch_size - 1) // args.batch_size
+        epoch, batch_idx = divmod(args.start_iter, epoch_len)
+        train_loader.sampler.set_state(epoch, batch_idx * args.batch_size)
+        logging.info('=> resuming at iter {} (epoch {}, batch {})'.format(
+            args.start_iter, epoch, batch_idx))
+    del checkpoint
+
+    profiler = make_profiler(args)
 
     end = time.time()
     dataloader_iterator = iter(train_loader)
 
-    for i in range(0, args.iters):
+    for i in range(args.start_iter, args.iters):
+        if profiler is not None:
+            profiler.step()
 
         rand_flag = random.uniform(0, 1) > 0.5
         model.train()
         adjust_learning_rate(args, optimizer, i)
-
-        try:
-            input, target = next(dataloader_iterator)
-        except StopIteration:
-            dataloader_iterator = iter(train_loader)
-            input, target = next(dataloader_iterator)
+        if precision_schedule is not None and precision_schedule.update(model.module, i):
+            report = energy_report(model.module, macs)
+            logging.info('=> precision changed at iter {}'.format(i))
+            log_energy_report(report)
+            for name, _, cost in report:
+                scalar_writer.add_scalar(name + '/precision_cost', cost, i-skip_count)
+
+        with phase('data'):
+            try:
+                input, target = next(dataloader_iterator)
+            except StopIteration:
+                dataloader_iterator = iter(train_loader)
+                input, target = next(dataloader_iterator)
 
         # measuring data loading time
         data_time.update(time.time() - end)
 
-        target = target.cuda()
-        input_var = Variable(input, requires_grad=True).cuda()
-        target_var = Variable(target).cuda()
+        with phase('h2d'):
+            target = target.cuda()
+            input_var = Variable(input, requires_grad=True).cuda()
+            target_var = Variable(target).cuda()
 
         # compute output
         if rand_flag:
             optimizer.zero_grad()
             # optimizer.step()
-            global skip_count
             skip_count += 1
             continue
 
-        output, masks, _, has_ds = model(input_var)
-
-        # energy_parameter = np.ones(35,)
-        energy_parameter = np.ones(len(masks),)
-        for iii, flag in enumerate(has_ds):
-            if flag:
-                energy_parameter[iii] = 0.75
-        energy_parameter /= energy_parameter.max()
-
-        energy_cost = 0
-        energy_all = 0
-        for layer in range(len(energy_parameter)):
-            energy_cost += masks[layer].sum() * energy_parameter[layer]
-            energy_all += reduce((lambda x, y: x * y), masks[layer].shape) * energy_parameter[layer]
-
-        cp_energy = (energy_cost.item() / energy_all.item()) * 100
-        global training_cost
-        training_cost += (cp_energy / 100) * 0.51 * args.batch_size
-        energy_cost *= args.beta
-        if cp_energy <= args.minimum:
-        # if cp_energy > args.minimum:
-            reg = -1
-        else:
-            reg = 1
-        if args.energy:
-            loss = criterion(output, target_var) + energy_cost * reg
-        else:
-            loss = criterion(output, target_var)
+        output, masks, _, _ = model(input_var)
+
+        with phase('loss_energy'):
+            energy_cost, cp_energy = compute_energy(masks, gate_costs(model))
+            training_cost += (cp_energy / 100) * 0.51 * args.batch_size
+            loss = energy_loss(args, criterion(output, target_var), energy_cost, cp_energy)
 
         # collect skip ratio of each layer
         skips = [mask.data.le(0.5).float().mean() for mask in masks]
@@ -280,22 +415,36 @@ def run_training(args):
 
         # measure accuracy and record loss
         prec1, = accuracy(output.data, target, topk=(1,))
-        writer.add_scalar('data/train_error', 100 - prec1, i-skip_count)
-        writer.add_scalar('data/train_comp_using', cp_energy, i-skip_count)
-        writer.add_scalar('data/train_cost_Gops', training_cost, i-skip_count)
         losses.update(loss.data.item(), input.size(0))
         top1.update(prec1.item(), input.size(0))
+        scalar_writer.add_scalar('data/train_error', 100 - top1.val, i-skip_count)
+        scalar_writer.add_scalar('data/train_comp_using', cp_energy, i-skip_count)
+        scalar_writer.add_scalar('data/train_cost_Gops', training_cost, i-skip_count)
         cp_energy_record.update(cp_energy, 1)
         skip_ratios.update(skips, input.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        with phase('backward'):
+            loss.backward()
+        with phase('optimizer'):
+            optimizer.step()
 
         # repackage hidden units for RNN Gate
         model.module.control.repackage_hidden()
 
+        if i % args.stats_every == 0:
+            tags, values = grad_stats_snapshot(model)
+            scalar_writer.add_scalars(tags, values, i-skip_count)
+
+        if threshold_controller is not None and i % args.threshold_every == 0:
+            budget, _ = threshold_controller.step(model.module)
+            if budget is not None:
+                full_precision_record.update(budget)
+                scalar_writer.add_scalar('data/train_full_precision_grad', budget, i-skip_count)
+                for name, threshold in threshold_controller.state_dict().items():
+                    scalar_writer.add_scalar(name + '/threshold', abs(threshold), i-skip_count)
+
         batch_time.update(time.time() - end)
         end = time.time()
 
@@ -315,29 +464,388 @@ def run_training(args):
                             top1=top1,
                             cp_energy_record=cp_energy_record)
             )
+            if threshold_controller is not None:
+                logging.info('Full precision grad: {0.val:.3f} ({0.avg:.3f}), target {1:.3f}'.format(
+                    full_precision_record, args.target_full_precision))
 
         # evaluate every 1000 steps
         if (i % args.eval_every == 0 and i > 0) or (i == (args.iters-1)):
             prec1 = validate(args, test_loader, model, criterion)
-            writer.add_scalar('data/test_error', 100 - prec1, i-skip_count)
+            scalar_writer.add_scalar('data/test_error', 100 - prec1, i-skip_count)
             is_best = prec1 > best_prec1
             best_prec1 = max(prec1, best_prec1)
             checkpoint_path = os.path.join(args.save_path,
                                            'checkpoint_{:05d}.pth.tar'.format(
                                                i))
-            save_checkpoint({
+            checkpoints.save({
                 'iter': i,
                 'arch': args.arch,
                 'state_dict': model.state_dict(),
                 'best_prec1': best_prec1,
+                'optimizer': optimizer.state_dict(),
+                'rng_state': get_rng_state(),
+                'seed': args.seed,
+                'skip_count': skip_count,
+                'training_cost': training_cost,
+                'thresholds': threshold_controller.state_dict() if threshold_controller else None,
             },
                 is_best, filename=checkpoint_path)
-            shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
-                                                          'checkpoint_latest'
-                                                          '.pth.tar'))
 
+    if profiler is not None:
+        profiler.stop()
+    checkpoints.close()
+    scalar_writer.close()
+
+
+def log_memory_report(args, net, device, name='mem_report'):
+    """Log what one training forward of `net` keeps for backward, per layer"""
+    input = torch.randn(args.batch_size, 3, 32, 32, device=device)
+    report = saved_tensor_report(net, input)
+    logging.info('=> activation memory at batch size {}'.format(args.batch_size))
+    report.log()
+    path = os.path.join(args.save_path, name + '.json')
+    with open(path, 'w') as f:
+        json.dump({'batch_size': args.batch_size, 'bytes': report.as_dict()}, f, indent=2)
+
+
+def make_profiler(args):
+    """A started `torch.profiler` recording `--profile-steps` iterations out
+    of every `--profile-every`, or None"""
+    if args.profile_every <= 0:
+        return None
+    if args.profile_steps >= args.profile_every:
+        raise ValueError('--profile-steps must be smaller than --profile-every')
+    profiling.enable()
+    trace_dir = os.path.join(args.save_path, 'profile')
+    os.makedirs(trace_dir, exist_ok=True)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def on_trace_ready(prof):
+        logging.info('=> profile, {} steps into this run\n{}'.format(
+            prof.step_num, profiling.phase_table(prof)))
+        logging.info('\n' + prof.key_averages().table(
+            sort_by='self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total',
+            row_limit=15))
+        prof.export_chrome_trace(os.path.join(trace_dir, 'trace_{:06d}.json'.format(prof.step_num)))
+
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=args.profile_every - args.profile_steps - 1,
+                                         warmup=1, active=args.profile_steps),
+        on_trace_ready=on_trace_ready)
+    profiler.start()
+    return profiler
+
+
+def sweep_values(values, default, type=float):
+    if not values:
+        return [default]
+    return [type(v) for v in values.split(',')]
+
+
+class SweepRun(object):
+    """Model, optimizer, counters and logs of configuration `index` of a sweep"""
+
+    def __init__(self, args, writer_cls, index):
+        self.args = args
+        os.makedirs(args.save_path, exist_ok=True)
+        self.logger = logging.getLogger('sweep.' + args.exp_desc)
+        self.logger.propagate = False
+        handler = logging.FileHandler(os.path.join(args.save_path, 'log_train.txt'), mode='w')
+        handler.setFormatter(logging.Formatter('%(asctime)s:%(message)s', datefmt='%m-%d-%y %H:%M'))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.INFO)
+
+        self.writer = AsyncScalarWriter(writer_cls(os.path.join(
+            'runs', args.exp_desc + '-' + time.strftime('%Y-%m-%d-%H:%M:%S', time.localtime()))))
+        self.checkpoints = CheckpointManager(args.save_path, keep=args.keep_checkpoints)
+
+        model = models.get_model(args.arch)(args.pretrained, **signsgd_config(args))
+        model.install_gate(unroll_lstm=args.compile)
+        gate_costs(model)
+        if args.compile:
+            model.compile()
+        self.model = torch.nn.DataParallel(model).cuda()
+        self.optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad,
+                                                self.model.parameters()), args.lr,
+                                         momentum=args.momentum,
+                                         weight_decay=args.weight_decay)
+        # each run drops its own mini-batches, from a stream of its own
+        self.rng = random.Random('{}:{}'.format(args.seed, index))
+        self.skip_count = 0
+        self.training_cost = 0
+        self.best_prec1 = 0
+        self.losses = AverageMeter()
+        self.top1 = AverageMeter()
+        self.cp_energy_record = AverageMeter()
+
+
+def run_sweep(args):
+    """Train every combination of the `--sweep-*` values in this process.
+
+    The training set is decoded once and kept on the GPU; all runs see the
+    same stream of augmented batches. Each run logs to its own folder under
+    `save_folder/arch/sweep/`.
+    """
+    from tensorboardX import SummaryWriter
+
+    if args.dataset not in ('cifar10', 'cifar100'):
+        raise ValueError('sweep only supports cifar10 and cifar100, got {}'.format(args.dataset))
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 31)
+    set_rounding_seed(args.seed)
+    grid = itertools.product(sweep_values(args.sweep_threshold, args.threshold),
+                             sweep_values(args.sweep_msb_bits_grad, args.msb_bits_grad, int),
+                             sweep_values(args.sweep_beta, args.beta),
+                             sweep_values(args.sweep_minimum, args.minimum))
+    runs = []
+    for index, (threshold, msb_bits_grad, beta, minimum) in enumerate(grid):
+        run_args = copy.copy(args)
+        run_args.threshold = threshold
+        run_args.msb_bits_grad = msb_bits_grad
+        run_args.beta = beta
+        run_args.minimum = minimum
+        run_args.exp_desc = '-'.join([args.arch, 'mg:%d' % msb_bits_grad, 'th:%f' % threshold,
+                                      'beta:%g' % beta, 'minimum:%f' % minimum])
+        run_args.save_path = os.path.join(args.save_folder, args.arch, 'sweep', run_args.exp_desc)
+        runs.append(SweepRun(run_args, SummaryWriter, index))
+    logging.info('sweeping {} configurations'.format(len(runs)))
 
-def validate(args, test_loader, model, criterion):
+    cudnn.benchmark = True
+    train_stream = InMemoryTrainStream(*load_cifar_in_memory(args.dataset, train=True),
+                                       batch_size=args.batch_size, seed=args.seed)
+    test_batches = in_memory_test_batches(*load_cifar_in_memory(args.dataset, train=False),
+                                          batch_size=args.batch_size)
+    criterion = nn.CrossEntropyLoss().cuda()
+
+    data_time = AverageMeter()
+    images_trained = 0
+    # time spent in the training steps only, for the throughput
+    train_time = 0.
+    start = end = time.time()
+    for i in range(args.iters):
+        input, target = next(train_stream)
+        data_time.update(time.time() - end)
+        loaded = time.time()
+
+        for run in runs:
+            # stochastic mini-batch dropping
+            if run.rng.uniform(0, 1) > 0.5:
+                run.skip_count += 1
+                continue
+            run.model.train()
+            adjust_learning_rate(run.args, run.optimizer, i)
+
+            output, masks, _, _ = run.model(input)
+            energy_cost, cp_energy = compute_energy(masks, gate_costs(run.model))
+            run.training_cost += (cp_energy / 100) * 0.51 * args.batch_size
+            loss = energy_loss(run.args, criterion(output, target), energy_cost, cp_energy)
+
+            run.optimizer.zero_grad()
+            loss.backward()
+            run.optimizer.step()
+            run.model.module.control.repackage_hidden()
+            images_trained += input.size(0)
+
+            prec1, = accuracy(output.data, target, topk=(1,))
+            run.losses.update(loss.item(), input.size(0))
+            run.top1.update(prec1.item(), input.size(0))
+            run.cp_energy_record.update(cp_energy, 1)
+            step = i - run.skip_count
+            run.writer.add_scalar('data/train_error', 100 - run.top1.val, step)
+            run.writer.add_scalar('data/train_comp_using', cp_energy, step)
+            run.writer.add_scalar('data/train_cost_Gops', run.training_cost, step)
+            if i % args.stats_every == 0:
+                run.writer.add_scalars(*grad_stats_snapshot(run.model), step)
+
+        end = time.time()
+        train_time += end - loaded
+        if i % args.print_freq == 0 or i == (args.iters - 1):
+            for run in runs:
+                run.logger.info('Iter: [{0}/{1}]\t'
+                                'Loss {loss.val:.3f} ({loss.avg:.3f})\t'
+                                'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
+                                'Energy_ratio: {cp.val:.3f}({cp.avg:.3f})\t'.format(
+                                    i, args.iters, loss=run.losses, top1=run.top1,
+                                    cp=run.cp_energy_record))
+            logging.info('Iter: [{0}/{1}]\t'
+                         'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
+                         '{2:.1f} img/s over {3} runs'.format(
+                             i, args.iters, images_trained / max(train_time, 1e-6), len(runs),
+                             data_time=data_time))
+
+        if (i % args.eval_every == 0 and i > 0) or (i == (args.iters-1)):
+            for run in runs:
+                prec1 = validate(run.args, test_batches, run.model, criterion, logger=run.logger)
+                run.writer.add_scalar('data/test_error', 100 - prec1, i - run.skip_count)
+                is_best = prec1 > run.best_prec1
+                run.best_prec1 = max(prec1, run.best_prec1)
+                run.checkpoints.save({
+                    'iter': i,
+                    'arch': args.arch,
+                    'state_dict': run.model.state_dict(),
+                    'best_prec1': run.best_prec1,
+                }, is_best, filename=os.path.join(run.args.save_path,
+                                                  'checkpoint_{:05d}.pth.tar'.format(i)))
+            end = time.time()
+
+    for run in runs:
+        run.checkpoints.close()
+        run.writer.close()
+        logging.info('{}: best Prec@1 {:.3f}'.format(run.args.exp_desc, run.best_prec1))
+    logging.info('trained {} images in {:.1f} s, {:.1f} s of training steps '
+                 '({:.1f} img/s over {} runs)'.format(
+                     images_trained, time.time() - start, train_time,
+                     images_trained / max(train_time, 1e-6), len(runs)))
+
+
+def synthetic_batches(batch_size, num_classes, count=8, seed=0):
+    """A few fixed CIFAR-shaped batches in (pinned) host memory"""
+    g = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(count):
+        input = torch.randn(batch_size, 3, 32, 32, generator=g)
+        target = torch.randint(0, num_classes, (batch_size,), generator=g)
+        if torch.cuda.is_available():
+            input, target = input.pin_memory(), target.pin_memory()
+        batches.append((input, target))
+    return batches
+
+
+def bench_arch(args, arch):
+    """Time the training step of `run_training` for `arch` on synthetic data"""
+    cuda = torch.cuda.is_available()
+    device = torch.device('cuda' if cuda else 'cpu')
+    torch.manual_seed(0)
+    net = models.get_model(arch)(False, **signsgd_config(args))
+    net.install_gate(unroll_lstm=args.compile)
+    gate_costs(net)
+    if args.compile:
+        net.compile()
+    model = torch.nn.DataParallel(net).cuda() if cuda else net
+    if args.mem_report:
+        log_memory_report(args, net, device, name='mem_report_' + arch)
+    criterion = nn.CrossEntropyLoss().to(device)
+    optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), args.lr,
+                                momentum=args.momentum, weight_decay=args.weight_decay)
+    batches = synthetic_batches(args.batch_size, 100 if arch.startswith('cifar100') else 10)
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+
+    def sync():
+        if cuda:
+            torch.cuda.synchronize()
+
+    data_times, step_times, skips = [], [], []
+    model.train()
+    for i in range(args.bench_warmup + args.bench_iters):
+        start = time.perf_counter()
+        input, target = batches[i % len(batches)]
+        input = input.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        sync()
+        loaded = time.perf_counter()
+
+        output, masks, _, _ = model(input)
+        energy_cost, cp_energy = compute_energy(masks, gate_costs(net))
+        loss = energy_loss(args, criterion(output, target), energy_cost, cp_energy)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        net.control.repackage_hidden()
+        sync()
+        end = time.perf_counter()
+
+        if i >= args.bench_warmup:
+            data_times.append(loaded - start)
+            step_times.append(end - start)
+            skips.append(np.mean([mask.data.le(0.5).float().mean().item() for mask in masks]))
+
+    step_times = np.array(step_times)
+    if cuda:
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        import resource
+        # of the whole process so far, in KB on Linux
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return {
+        'arch': arch,
+        'device': device.type,
+        'batch_size': args.batch_size,
+        'images_per_sec': args.batch_size / step_times.mean(),
+        'step_ms_p50': 1e3 * np.percentile(step_times, 50),
+        'step_ms_p90': 1e3 * np.percentile(step_times, 90),
+        'step_ms_p99': 1e3 * np.percentile(step_times, 99),
+        'data_fraction': float(np.sum(data_times) / step_times.sum()),
+        'peak_memory_mb': peak_mb,
+        'skip_ratio': float(np.mean(skips)),
+    }
+
+
+def run_bench(args):
+    """Training throughput of one or more architectures on synthetic data.
+
+    Runs the inner loop of `run_training` (without mini-batch dropping,
+    logging and evaluation) on a few fixed random batches, so nothing is
+    downloaded. The data time is the host to device copy of the batch.
+    """
+    if args.bench_archs == 'all':
+        archs = model_names
+    else:
+        archs = args.bench_archs.split(',') if args.bench_archs else [args.arch]
+    cudnn.benchmark = True
+    results = []
+    logging.info('{:<32s} {:>9s} {:>9s} {:>9s} {:>9s} {:>7s} {:>9s} {:>7s}'.format(
+        'arch', 'img/s', 'p50 ms', 'p90 ms', 'p99 ms', 'data', 'peak MB', 'skip'))
+    for arch in archs:
+        r = bench_arch(args, arch)
+        results.append(r)
+        logging.info('{:<32s} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>6.1f}% {:>9.1f} {:>7.3f}'.format(
+            arch, r['images_per_sec'], r['step_ms_p50'], r['step_ms_p90'], r['step_ms_p99'],
+            100 * r['data_fraction'], r['peak_memory_mb'], r['skip_ratio']))
+    path = os.path.join(args.save_path, 'bench.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info('=> wrote {}'.format(path))
+
+
+def compute_energy(masks, costs):
+    """Energy of the executed layers (a tensor, for the regularizer) and the
+    percentage of the full network's energy it amounts to.
+
+    `costs` are the `(cost, always, groups)` of each mask, from
+    `models.precision.gate_costs`: the gated layers are weighted by their
+    MACs, and what runs for every sample (a downsample projection) is
+    counted in both.
+    """
+    energy_cost = 0
+    energy_all = 0
+    for mask, (cost, always, groups) in zip(masks, costs):
+        samples = mask.numel() // groups
+        energy_cost += mask.sum() * cost + samples * always
+        energy_all += mask.numel() * cost + samples * always
+
+    cp_energy = (energy_cost.item() / energy_all) * 100
+    return energy_cost, cp_energy
+
+
+def energy_loss(args, loss, energy_cost, cp_energy):
+    """Add the energy regularizer, pushing the usage towards `args.minimum`"""
+    energy_cost = energy_cost * args.beta
+    if cp_energy <= args.minimum:
+    # if cp_energy > args.minimum:
+        reg = -1
+    else:
+        reg = 1
+    if args.energy:
+        return loss + energy_cost * reg
+    else:
+        return loss
+
+
+def validate(args, test_loader, model, criterion, logger=logging):
     batch_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
@@ -356,21 +864,9 @@ def validate(args, test_loader, model, criterion):
             input_var = Variable(input).cuda()
             target_var = Variable(target).cuda()
             # compute output
-            output, masks, logprobs, has_ds = model(input_var)
-
-            # energy_parameter = np.ones(35, )
-            energy_parameter = np.ones(len(masks), )
-            for iii, flag in enumerate(has_ds):
-                if flag:
-                    energy_parameter[iii] = 0.75
-            energy_parameter /= energy_parameter.max()
-
-            energy_cost = 0
-            energy_all = 0
-            for layer in range(len(energy_parameter)):
-                energy_cost += masks[layer].sum() * energy_parameter[layer]
-                energy_all += reduce((lambda x, y: x * y), masks[layer].shape) * energy_parameter[layer]
-            cp_energy = (energy_cost.item() / energy_all.item()) * 100
+            output, masks, logprobs, _ = model(input_var)
+
+            _, cp_energy = compute_energy(masks, gate_costs(model))
 
             skips = [mask.data.le(0.5).float().mean().item() for mask in masks]
 
@@ -389,7 +885,7 @@ def validate(args, test_loader, model, criterion):
             end = time.time()
 
             if i % args.print_freq == 0 or (i == (len(test_loader) - 1)):
-                logging.info(
+                logger.info(
                     'Test: [{}/{}]\t'
                     'Time: {batch_time.val:.4f}({batch_time.avg:.4f})\t'
                     'Loss: {loss.val:.3f}({loss.avg:.3f})\t'
@@ -402,7 +898,7 @@ def validate(args, test_loader, model, criterion):
                         cp_energy_record=cp_energy_record,
                     )
                 )
-        logging.info(' * Prec@1 {top1.avg:.3f}, Loss {loss.avg:.3f}'.format(
+        logger.info(' * Prec@1 {top1.avg:.3f}, Loss {loss.avg:.3f}'.format(
             top1=top1, loss=losses))
 
         skip_summaries = []
@@ -410,31 +906,16 @@ def validate(args, test_loader, model, criterion):
             skip_summaries.append(1-skip_ratios.avg[idx])
         # compute `computational percentage`
         cp = ((sum(skip_summaries) + 1) / (len(skip_summaries) + 1)) * 100
-        logging.info('*** Computation Percentage: {:.3f} %'.format(cp))
+        logger.info('*** Computation Percentage: {:.3f} %'.format(cp))
 
     return top1.avg
 
 
 def test_model(args):
-    signsgd_config = {
-        'num_bits': args.num_bits,
-        'num_bits_weight': args.num_bits_weight,
-        'num_bits_grad': args.num_bits_grad,
-        'biprecision': args.biprecision,
-        'predictive_forward': args.predictive_forward,
-        'predictive_backward': args.predictive_backward,
-        'msb_bits': args.msb_bits,
-        'msb_bits_weight': args.msb_bits_weight,
-        'msb_bits_grad': args.msb_bits_grad,
-        'threshold': args.threshold,
-        'sparsify': args.sparsify,
-        'sign': args.sign,
-        'writer': None,
-    }
-
     # create model
-    model = models.__dict__[args.arch](args.pretrained, **signsgd_config)
+    model = models.get_model(args.arch)(args.pretrained, **signsgd_config(args))
     model.install_gate()
+    gate_costs(model)
     model = torch.nn.DataParallel(model).cuda()
 
     if args.resume:
@@ -450,6 +931,9 @@ def test_model(args):
             ))
         else:
             logging.info('=> no checkpoint found at `{}`'.format(args.resume))
+    if args.precision_schedule:
+        # evaluate at the precision the checkpoint was trained with last
+        PrecisionSchedule.from_file(args.precision_schedule).update(model.module, args.start_iter)
     cudnn.benchmark = False
     test_loader = prepare_test_data(dataset=args.dataset,
                                     batch_size=args.batch_size,
@@ -457,15 +941,38 @@ def test_model(args):
                                     num_workers=args.workers)
     criterion = nn.CrossEntropyLoss().cuda()
 
-    validate(args, test_loader, model, criterion)
-
-
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        save_path = os.path.dirname(filename)
-        shutil.copyfile(filename, os.path.join(save_path,
-                                               'model_best_eic.pth.tar'))
+    prec1 = validate(args, test_loader, model, criterion)
+    if args.eval_num_bits:
+        eval_num_bits(args, test_loader, model.module, model, criterion, prec1)
+
+
+def eval_num_bits(args, test_loader, net, model, criterion, prec1):
+    """Accuracy with the activations of all the predictive layers at each
+    of `--eval-num-bits`, with the scales of the checkpoint"""
+    layers = predictive_layers(net)
+    base = [(m, m.num_bits, m.msb_bits) for _, m in layers]
+    results = {'checkpoint': prec1}
+    try:
+        for num_bits in sorted(int(b) for b in args.eval_num_bits.split(',')):
+            for m, _, msb_bits in base:
+                fields = {'num_bits': num_bits}
+                if msb_bits is not None:
+                    # the MSB part can't be wider than the whole
+                    fields['msb_bits'] = min(msb_bits, num_bits)
+                set_precision(m, **fields)
+            logging.info('=> activations at {} bits'.format(num_bits))
+            results[num_bits] = validate(args, test_loader, model, criterion)
+    finally:
+        for m, num_bits, msb_bits in base:
+            set_precision(m, num_bits=num_bits, msb_bits=msb_bits)
+
+    logging.info('{:>10s} {:>8s}  ({} activation scales)'.format(
+        'num_bits', 'Prec@1', 'per channel' if args.per_channel_act else 'per tensor'))
+    for num_bits, prec in results.items():
+        logging.info('{:>10s} {:>8.3f}'.format(str(num_bits), prec))
+    with open(os.path.join(args.save_path, 'eval_num_bits.json'), 'w') as f:
+        json.dump({str(k): v for k, v in results.items()}, f, indent=2)
+    return results
 
 
 class AverageMeter(object):
@@ -1,3 +1,6 @@
+import threading
+import queue
+
 import torch
 
 
@@ -100,4 +103,64 @@ class AccuracyMeter(object):
 
     @property
     def avg_error(self):
-        return {n: 100. - meter.avg for (n, meter) in self._meters.items()}
\ No newline at end of file
+        return {n: 100. - meter.avg for (n, meter) in self._meters.items()}
+
+
+class AsyncScalarWriter(object):
+    """Writes scalars to a SummaryWriter from a background thread.
+
+    Device tensors are copied to pinned host memory with a non-blocking copy
+    and a CUDA event; the thread waits on the event, so neither the copy nor
+    the file I/O stalls the training loop. When `max_pending` batches are
+    queued, new ones are dropped instead of blocking.
+    """
+
+    def __init__(self, writer, max_pending=64):
+        self.writer = writer
+        self.dropped = 0
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def add_scalar(self, tag, value, step):
+        self._put(([tag], [float(value)], step, None))
+
+    def add_scalars(self, tags, values, step):
+        """Queue `values[i]` under `tags[i]`; `values` is a 1-D tensor"""
+        if values is None:
+            return
+        event = None
+        if values.is_cuda:
+            host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+            host.copy_(values, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            values = host
+        else:
+            values = values.clone()
+        self._put((tags, values, step, event))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            tags, values, step, event = item
+            if event is not None:
+                event.synchronize()
+            if isinstance(values, torch.Tensor):
+                values = values.tolist()
+            for tag, value in zip(tags, values):
+                self.writer.add_scalar(tag, value, step)
+
+    def close(self):
+        """Write out everything still queued and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.flush()
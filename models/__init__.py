@@ -1,3 +1,44 @@
-# from .new_densenet import *
-# from .new_resnet import *
-from .efficient_resnet import *
+"""Registry of the trainable architectures.
+
+The model modules are only imported when one of their factories is
+requested, so that importing `models` (e.g. for `main_all.py --help`) does
+not pay for torch and every model definition.
+"""
+
+import importlib
+
+# architecture name -> module (relative to this package) defining its factory
+_ARCHS = {
+    'cifar10_rnn_gate_18': 'efficient_resnet',
+    'cifar10_rnn_gate_38': 'efficient_resnet',
+    'cifar10_rnn_gate_74': 'efficient_resnet',
+    'cifar10_rnn_gate_110': 'efficient_resnet',
+    'cifar10_rnn_gate_152': 'efficient_resnet',
+    'cifar100_rnn_gate_38': 'efficient_resnet',
+    'cifar100_rnn_gate_74': 'efficient_resnet',
+    'cifar100_rnn_gate_110': 'efficient_resnet',
+    'cifar100_rnn_gate_152': 'efficient_resnet',
+    'cifar10_rnn_gate_densenet100': 'new_densenet',
+    'cifar100_rnn_gate_densenet100': 'new_densenet',
+}
+
+
+def model_names():
+    return sorted(_ARCHS)
+
+
+def get_model(name):
+    """Return the factory of architecture `name`"""
+    module = importlib.import_module('.' + _ARCHS[name], __name__)
+    return getattr(module, name)
+
+
+def __getattr__(name):
+    if name in _ARCHS:
+        return get_model(name)
+    # everything else `from .efficient_resnet import *` used to export
+    if not name.startswith('__'):
+        module = importlib.import_module('.efficient_resnet', __name__)
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -13,12 +13,13 @@ from models.quantize import calculate_qparams, quantize, quantize_grad, Quantize
 from models.predictive import mixing_output, quant_weight
 
 
-def conv2d_biprec(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, num_bits_grad=None):
+def conv2d_biprec(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, num_bits_grad=None,
+                  stochastic_grad=False):
     out1 = F.conv2d(input.detach(), weight, bias,
                     stride, padding, dilation, groups)
     out2 = F.conv2d(input, weight.detach(), bias.detach() if bias is not None else None,
                     stride, padding, dilation, groups)
-    out2 = quantize_grad(out2, num_bits=num_bits_grad)
+    out2 = quantize_grad(out2, num_bits=num_bits_grad, stochastic=stochastic_grad)
     return out1 + out2 - out1.detach()
 
 
@@ -30,7 +31,8 @@ class PredictiveConv2d(Conv2d):
                  biprecision=True, input_signed=False,
                  predictive_forward=True, predictive_backward=True,
                  msb_bits=4, msb_bits_weight=4, msb_bits_grad=16,
-                 threshold=5e-5, sparsify=False, sign=False,
+                 threshold=5e-5, sparsify=False, sign=False, sparse_backward=False,
+                 pack_saved=False, stochastic_grad=False, per_channel_act=False,
                  writer=None, writer_prefix=""):
         kernel_size = _pair(kernel_size)
         stride = _pair(stride)
@@ -53,14 +55,24 @@ class PredictiveConv2d(Conv2d):
         self.threshold = threshold
         self.sparsify = sparsify
         self.sign = sign
+        # round the quantized gradients stochastically (unbiased)
+        self.stochastic_grad = stochastic_grad
+        if sparse_backward:
+            raise ValueError('sparse_backward is only implemented in models.conv_efficient')
+        if pack_saved:
+            raise ValueError('pack_saved is only implemented in models.conv_efficient')
         self.writer = writer
         self.writer_prefix = writer_prefix
-        self.counter = 0
+        # MSB usage ratio and sign agreement rate of the last backward pass,
+        # kept on device and read out by `log_grad_stats` outside of autograd
+        self.register_buffer('grad_stats', torch.zeros(2), persistent=False)
 
-        self.quant_input = Quantize(num_bits=self.num_bits, shape_measure=(1,1,1,1,),
+        self.per_channel_act = per_channel_act
+        self.quant_input = Quantize(num_bits=self.num_bits,
+                                    shape_measure=(1,in_channels,1,1,) if per_channel_act else (1,1,1,1,),
                                     flatten_dims=(1,-1), dequantize=True,
                                     input_signed=self.input_signed,
-                                    stochastic=False, momentum=0.1)
+                                    stochastic=False, momentum=0.1, per_channel=per_channel_act)
 
         if not self.predictive_backward:
             self.msb_bits_grad = None
@@ -97,11 +109,9 @@ class PredictiveConv2d(Conv2d):
         weights = quant_weight(
             self.weight, num_bits_weight=self.num_bits_weight,
             msb_bits_weight=self.msb_bits_weight, threshold=self.threshold,
-            sparsify=self.sparsify, sign=self.sign,
-            writer=self.writer, writer_prefix=self.writer_prefix, counter=self.counter)
+            sparsify=self.sparsify, sign=self.sign, grad_stats=self.grad_stats)
         q_weight = weights[0]
         msb_weight = weights[1] if len(weights) > 1 else None
-        self.counter += 1
 
         # No bias for CONV layers
         q_bias = None
@@ -112,11 +122,13 @@ class PredictiveConv2d(Conv2d):
                                 padding=self.padding, dilation=self.dilation, groups=self.groups)
             if self.num_bits_grad is not None and self.num_bits_grad < 32:
                 q_output = quantize_grad(
-                    q_output, num_bits=self.num_bits_grad, flatten_dims=(1,-1))
+                    q_output, num_bits=self.num_bits_grad, flatten_dims=(1,-1),
+                    stochastic=self.stochastic_grad)
         else:
             q_output = conv2d_biprec(q_input, q_weight, q_bias, self.stride,
                                      self.padding, self.dilation, self.groups,
-                                     num_bits_grad=self.num_bits_grad)
+                                     num_bits_grad=self.num_bits_grad,
+                                     stochastic_grad=self.stochastic_grad)
 
         # MSB-branch
         if msb_input is not None or msb_weight is not None:
@@ -124,7 +136,8 @@ class PredictiveConv2d(Conv2d):
                                   padding=self.padding, dilation=self.dilation, groups=self.groups)
             if self.predictive_backward:
                 msb_output = quantize_grad(
-                    msb_output, num_bits=self.msb_bits_grad, flatten_dims=(1,-1))
+                    msb_output, num_bits=self.msb_bits_grad, flatten_dims=(1,-1),
+                    stochastic=self.stochastic_grad)
         else:
             msb_output = None
 
@@ -1,6 +1,8 @@
 """
 """
 
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,14 +14,17 @@ from torch.autograd import Function
 from models.quantize import quantize, quantize_grad, Quantize
 from models.quantize import efficient_quantize, EfficientQuantize
 from models.predictive import mixing_output, quant_weight, efficient_quant_weight
+from models.predictive import sparse_predictive_conv2d
+from models.profiling import phase
 
 
-def conv2d_biprec(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, num_bits_grad=None):
+def conv2d_biprec(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, num_bits_grad=None,
+                  stochastic_grad=False):
     out1 = F.conv2d(input.detach(), weight, bias,
                     stride, padding, dilation, groups)
     out2 = F.conv2d(input, weight.detach(), bias.detach() if bias is not None else None,
                     stride, padding, dilation, groups)
-    out2 = quantize_grad(out2, num_bits=num_bits_grad)
+    out2 = quantize_grad(out2, num_bits=num_bits_grad, stochastic=stochastic_grad)
     return out1 + out2 - out1.detach()
 
 
@@ -31,7 +36,8 @@ class PredictiveConv2d(Conv2d):
                  biprecision=True, input_signed=False,
                  predictive_forward=True, predictive_backward=True,
                  msb_bits=4, msb_bits_weight=4, msb_bits_grad=16,
-                 threshold=5e-5, sparsify=False, sign=False,
+                 threshold=5e-5, sparsify=False, sign=False, sparse_backward=False,
+                 pack_saved=False, stochastic_grad=False, per_channel_act=False,
                  writer=None, writer_prefix=""):
         kernel_size = _pair(kernel_size)
         stride = _pair(stride)
@@ -54,16 +60,26 @@ class PredictiveConv2d(Conv2d):
         self.threshold = threshold
         self.sparsify = sparsify
         self.sign = sign
+        # round the quantized gradients stochastically (unbiased)
+        self.stochastic_grad = stochastic_grad
+        self.sparse_backward = sparse_backward
+        # keep the quantized inputs for backward as integer codes
+        self.pack_saved = pack_saved
+        # one activation scale per input channel instead of per tensor
+        self.per_channel_act = per_channel_act
         self.writer = writer
         self.writer_prefix = writer_prefix
-        self.counter = 0
+        # MSB usage ratio and sign agreement rate of the last backward pass,
+        # kept on device and read out by `log_grad_stats` outside of autograd
+        self.register_buffer('grad_stats', torch.zeros(2), persistent=False)
 
         assert self.predictive_backward and self.msb_bits is not None
 
         self.quant_input = EfficientQuantize(
             num_bits=self.num_bits, msb_bits=self.msb_bits,
-            shape_measure=(1,1,1,1,), flatten_dims=(1,-1), dequantize=True,
-            input_signed=self.input_signed, stochastic=False, momentum=0.1)
+            shape_measure=(1,in_channels,1,1,) if per_channel_act else (1,1,1,1,),
+            flatten_dims=(1,-1), dequantize=True, input_signed=self.input_signed,
+            stochastic=False, momentum=0.1, per_channel=per_channel_act)
 
         # if not self.predictive_backward:
         #     self.msb_bits_grad = None
@@ -74,9 +90,12 @@ class PredictiveConv2d(Conv2d):
         # else:
         #     assert self.msb_bits is not None and self.msb_bits_weight is not None
 
-    def forward(self, input):
+    def forward(self, input, out_channels=None, in_channels=None):
+        """`out_channels`/`in_channels` (index tensors) restrict the layer to
+        those filters and input channels; `input` then only holds the latter"""
         # Quantize `input` to `q_input`
-        q_input, msb_input = self.quant_input(input)
+        with phase('quantization'):
+            q_input, msb_input = self.quant_input(input, channels=in_channels)
 
         # Quantize `q_input` to get `msb_input`
         # if self.msb_bits is not None:
@@ -86,48 +105,91 @@ class PredictiveConv2d(Conv2d):
         # else:
         #     msb_input = None
 
+        # the sparse weight gradient doesn't support slicing (channel gating
+        # with `sparse_backward` is rejected by `ResNetRecurrentGateSP`)
+        sliced = out_channels is not None or in_channels is not None
+        if self.sparse_backward and self.training and not sliced:
+            return self._forward_sparse_backward(q_input, msb_input)
+
         # Quantize weight
-        q_weight, msb_weight = efficient_quant_weight(
-            self.weight, num_bits_weight=self.num_bits_weight,
-            msb_bits_weight=self.msb_bits_weight, threshold=self.threshold,
-            sparsify=self.sparsify, sign=self.sign,
-            writer=self.writer, writer_prefix=self.writer_prefix, counter=self.counter)
+        with phase('quantization'):
+            q_weight, msb_weight = efficient_quant_weight(
+                self.weight, num_bits_weight=self.num_bits_weight,
+                msb_bits_weight=self.msb_bits_weight, threshold=self.threshold,
+                sparsify=self.sparsify, sign=self.sign, grad_stats=self.grad_stats)
         # weights = quant_weight(
         #     self.weight, num_bits_weight=self.num_bits_weight,
         #     msb_bits_weight=self.msb_bits_weight, threshold=self.threshold,
-        #     sparsify=self.sparsify, sign=self.sign,
-        #     writer=self.writer, writer_prefix=self.writer_prefix, counter=self.counter)
+        #     sparsify=self.sparsify, sign=self.sign, grad_stats=self.grad_stats)
         # q_weight = weights[0]
         # msb_weight = weights[1] if len(weights) > 1 else None
-        self.counter += 1
+        if out_channels is not None:
+            q_weight = q_weight.index_select(0, out_channels)
+            msb_weight = msb_weight.index_select(0, out_channels)
+        if in_channels is not None:
+            q_weight = q_weight.index_select(1, in_channels)
+            msb_weight = msb_weight.index_select(1, in_channels)
 
         # No bias for CONV layers
         q_bias = None
 
-        # Q-branch
-        if not self.biprecision or self.num_bits_grad is None or self.num_bits_grad >= 32:
-            q_output = F.conv2d(q_input, q_weight, bias=q_bias, stride=self.stride,
-                                padding=self.padding, dilation=self.dilation, groups=self.groups)
-            if self.num_bits_grad is not None and self.num_bits_grad < 32:
-                q_output = quantize_grad(
-                    q_output, num_bits=self.num_bits_grad, flatten_dims=(1,-1))
-        else:
-            q_output = conv2d_biprec(q_input, q_weight, q_bias, self.stride,
-                                     self.padding, self.dilation, self.groups,
-                                     num_bits_grad=self.num_bits_grad)
-
-        # MSB-branch
-        if msb_input is not None or msb_weight is not None:
-            msb_output = F.conv2d(msb_input, msb_weight, bias=q_bias, stride=self.stride,
-                                  padding=self.padding, dilation=self.dilation, groups=self.groups)
-            if self.predictive_backward:
-                msb_output = quantize_grad(
-                    msb_output, num_bits=self.msb_bits_grad, flatten_dims=(1,-1))
-        else:
-            msb_output = None
+        with self._saved_inputs(q_input, msb_input):
+            # Q-branch
+            if not self.biprecision or self.num_bits_grad is None or self.num_bits_grad >= 32:
+                q_output = F.conv2d(q_input, q_weight, bias=q_bias, stride=self.stride,
+                                    padding=self.padding, dilation=self.dilation, groups=self.groups)
+                if self.num_bits_grad is not None and self.num_bits_grad < 32:
+                    q_output = quantize_grad(
+                        q_output, num_bits=self.num_bits_grad, flatten_dims=(1,-1),
+                        stochastic=self.stochastic_grad)
+            else:
+                q_output = conv2d_biprec(q_input, q_weight, q_bias, self.stride,
+                                         self.padding, self.dilation, self.groups,
+                                         num_bits_grad=self.num_bits_grad,
+                                         stochastic_grad=self.stochastic_grad)
+
+            # MSB-branch
+            if msb_input is not None or msb_weight is not None:
+                with phase('msb_branch'):
+                    msb_output = F.conv2d(msb_input, msb_weight, bias=q_bias, stride=self.stride,
+                                          padding=self.padding, dilation=self.dilation,
+                                          groups=self.groups)
+                    if self.predictive_backward:
+                        msb_output = quantize_grad(
+                            msb_output, num_bits=self.msb_bits_grad, flatten_dims=(1,-1),
+                            stochastic=self.stochastic_grad)
+            else:
+                msb_output = None
 
         # Mixing `q_output` and `msb_output`
         output = mixing_output(
             q_output, msb_output, self.predictive_forward, self.predictive_backward)
 
         return output
+
+    def _saved_inputs(self, q_input, msb_input):
+        if self.pack_saved and self.training:
+            return self.quant_input.saved_as_codes(q_input, msb_input)
+        return contextlib.nullcontext()
+
+    def _forward_sparse_backward(self, q_input, msb_input):
+        """Same output as `forward`, the weight gradient skips the filters
+        that don't need the full precision one"""
+        with torch.no_grad(), phase('quantization'):
+            if ((self.num_bits_weight is None or self.num_bits_weight >= 32) and
+                (self.msb_bits_weight is None or self.msb_bits_weight >= 32)):
+                q_weight = msb_weight = self.weight.detach()
+            else:
+                q_weight, msb_weight = efficient_quantize(
+                    self.weight, num_bits=self.num_bits_weight, msb_bits=self.msb_bits_weight,
+                    flatten_dims=(1,-1), reduce_dim=None, signed=True)
+        with self._saved_inputs(q_input, msb_input):
+            q_output, msb_output = sparse_predictive_conv2d(
+                self.weight, q_input, msb_input, q_weight, msb_weight,
+                self.stride, self.padding, self.dilation, self.groups,
+                num_bits_grad=self.num_bits_grad, biprecision=self.biprecision,
+                msb_bits_grad=self.msb_bits_grad, threshold=self.threshold,
+                sparsify=self.sparsify, sign=self.sign, grad_stats=self.grad_stats,
+                stochastic_grad=self.stochastic_grad)
+        return mixing_output(
+            q_output, msb_output, self.predictive_forward, self.predictive_backward)
@@ -1,77 +1,67 @@
+import logging
+import re
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 from torch.autograd import Variable
 import torch.autograd as autograd
-import numpy as np
-import scipy.misc
 
 from models.conv_efficient import PredictiveConv2d
+from models.new_linear import PredictiveLinear
+from models.precision import predictive_layers
+from models.profiling import phase
+from models.quantize import QuantConfig, quant_config
 
-NUM_BITS = 8
-NUM_BITS_WEIGHT = 8
-NUM_BITS_GRAD = None,
 
-BIPRECISION = False
-PREDICTIVE_FORWARD = False
-PREDICTIVE_BACKWARD = True
-MSB_BITS = 4
-MSB_BITS_WEIGHT = 4
-MSB_BITS_GRAD = 16
-
-THRESHOLD = 5e-5
-SPARSIFY = False
-SIGN = True
-WRITER = None
-
-WRITER_PREFIX_COUNTER = 0
-
-
-def conv1x1(in_planes, out_planes, stride=1,
-            input_signed=True, predictive_forward=True, writer_prefix=""):
+def conv1x1(in_planes, out_planes, stride=1, input_signed=True,
+            predictive_forward=True, writer_prefix="", config=QuantConfig()):
     "1x1 convolution with no padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
+    config = config._replace(predictive_forward=config.predictive_forward and predictive_forward)
     return PredictiveConv2d(
         in_planes, out_planes, kernel_size=1, stride=stride, padding=0, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
+        input_signed=input_signed, writer_prefix=writer_prefix, **config._asdict())
 
 
-def conv3x3(in_planes, out_planes, stride=1,
-            input_signed=False, predictive_forward=True, writer_prefix=""):
+def linear(in_features, out_features, input_signed=False, bias=True, writer_prefix="",
+           config=QuantConfig()):
+    "quantized linear layer, without the forward prediction"
+    config = config._replace(predictive_forward=False)
+    return PredictiveLinear(in_features, out_features, bias=bias, input_signed=input_signed,
+                            writer_prefix=writer_prefix, **config._asdict())
+
+
+def conv3x3(in_planes, out_planes, stride=1, input_signed=False,
+            predictive_forward=True, writer_prefix="", config=QuantConfig()):
     "3x3 convolution with padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
+    config = config._replace(predictive_forward=config.predictive_forward and predictive_forward)
     return PredictiveConv2d(
         in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
+        input_signed=input_signed, writer_prefix=writer_prefix, **config._asdict())
 
 
 class BasicBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, inplanes, planes, stride=1, downsample=None, writer_prefix=""):
+    def __init__(self, inplanes, planes, stride=1, downsample=None, writer_prefix="",
+                 config=QuantConfig()):
         super(BasicBlock, self).__init__()
-        self.conv1 = conv3x3(inplanes, planes, stride, input_signed=True,
-                             predictive_forward=False, writer_prefix=writer_prefix+'_conv1')
+        self.conv1 = conv3x3(inplanes, planes, stride, input_signed=True, predictive_forward=False,
+                             writer_prefix=writer_prefix+'_conv1', config=config)
         self.bn1 = nn.BatchNorm2d(planes)
         self.relu = nn.ReLU(inplace=True)
-        self.conv2 = conv3x3(planes, planes, input_signed=False,
-                             predictive_forward=False, writer_prefix=writer_prefix+'_conv2')
+        self.conv2 = conv3x3(planes, planes, input_signed=False, predictive_forward=False,
+                             writer_prefix=writer_prefix+'_conv2', config=config)
         self.bn2 = nn.BatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
 
-    def forward(self, x):
-        residual = x
+    def forward(self, x, group_mask=None, residual=None):
+        """`residual` is the shortcut of `x` when the caller computed it already"""
+        if group_mask is not None:
+            return self._forward_channel_groups(x, group_mask, residual)
+        if residual is None:
+            residual = x if self.downsample is None else self.downsample(x)
 
         out = self.conv1(x)
         out = self.bn1(out)
@@ -80,13 +70,115 @@ class BasicBlock(nn.Module):
         out = self.conv2(out)
         out = self.bn2(out)
 
-        if self.downsample is not None:
-            residual = self.downsample(x)
-
         out += residual
         out = self.relu(out)
         return out
 
+    def _forward_channel_groups(self, x, group_mask, residual=None):
+        """Block with its channels gated in groups by `group_mask` [batch, groups, 1, 1].
+
+        Both convolutions only compute the filter groups some sample of the
+        batch keeps; the mask also gates the hidden channels, so that the
+        second convolution only reads the active ones. The channels of the
+        other groups are zero before the residual is added.
+        """
+        if residual is None:
+            residual = x if self.downsample is None else self.downsample(x)
+        planes = self.bn2.num_features
+        group_size = planes // group_mask.size(1)
+        active = (group_mask.detach().view(group_mask.size(0), -1) > 0).any(0)
+        index = active.nonzero().view(-1, 1) * group_size + \
+            torch.arange(group_size, device=x.device)
+        index = index.view(-1)
+        if index.numel() == 0:
+            return F.relu(residual)
+        if index.numel() == planes:
+            index = None
+
+        out = self.conv1(x, out_channels=index)
+        out = _batch_norm_channels(self.bn1, out, index)
+        out = self.relu(out)
+        channel_mask = group_mask.repeat_interleave(group_size, dim=1)
+        if index is not None:
+            channel_mask = channel_mask.index_select(1, index)
+        out = out * channel_mask
+
+        out = self.conv2(out, out_channels=index, in_channels=index)
+        out = _batch_norm_channels(self.bn2, out, index)
+        if index is not None:
+            out = out.new_zeros(residual.size()).index_copy(1, index, out)
+
+        out = out + residual
+        return self.relu(out)
+
+
+def _batch_norm_channels(bn, x, index):
+    """`bn` applied to the channels `index` of its input only"""
+    if index is None:
+        return bn(x)
+    running_mean = running_var = None
+    if bn.track_running_stats:
+        running_mean = bn.running_mean.index_select(0, index)
+        running_var = bn.running_var.index_select(0, index)
+    out = F.batch_norm(x, running_mean, running_var,
+                       bn.weight.index_select(0, index), bn.bias.index_select(0, index),
+                       bn.training, bn.momentum, bn.eps)
+    if bn.training and bn.track_running_stats:
+        # F.batch_norm updated the selected copies
+        with torch.no_grad():
+            bn.running_mean.index_copy_(0, index, running_mean)
+            bn.running_var.index_copy_(0, index, running_var)
+    return out
+
+class GateHead(nn.Module):
+    """Embedding of a feature map for the recurrent gate: a global mean and
+    a small matmul, i.e. the former `Sequential(AvgPool2d, conv1x1)` head
+    without the convolution machinery. Quantized like the other layers
+    when given a `config`. Loads the weights of the former head."""
+    def __init__(self, in_channels, embed_dim, input_signed=True, writer_prefix="", config=None):
+        super(GateHead, self).__init__()
+        self.in_channels = in_channels
+        self.embed_dim = embed_dim
+        if config is not None:
+            self.embed = linear(in_channels, embed_dim, input_signed=input_signed, bias=False,
+                                writer_prefix=writer_prefix, config=config)
+        else:
+            self.embed = None
+            self.weight = nn.Parameter(torch.Tensor(embed_dim, in_channels))
+        self.reset_parameters()
+        self._register_load_state_dict_pre_hook(self._translate_conv_keys)
+
+    def reset_parameters(self):
+        # same as the 1x1 convolution
+        weight = self.weight if self.embed is None else self.embed.weight
+        weight.data.normal_(0, math.sqrt(2. / self.embed_dim))
+
+    def forward(self, x):
+        return self.project(x.mean((2, 3)))
+
+    def project(self, pooled):
+        """The embedding of already pooled features [batch, in_channels]"""
+        if self.embed is not None:
+            return self.embed(pooled)
+        return F.linear(pooled, self.weight)
+
+    def _translate_conv_keys(self, state_dict, prefix, *args):
+        """Map `1.*` keys of the former head onto this one"""
+        for key in list(state_dict.keys()):
+            if not key.startswith(prefix + '1.'):
+                continue
+            value = state_dict.pop(key)
+            name = key[len(prefix) + 2:]
+            if self.embed is not None:
+                new_key = prefix + 'embed.' + name
+            elif name == 'weight':
+                new_key = prefix + 'weight'
+            else:
+                continue  # statistics of the input quantizer
+            if value.dim() == 4:
+                value = value.view(value.size(0), value.size(1))
+            state_dict[new_key] = value
+
 ########################################
 # SkipNet+SP with Recurrent Gate       #
 ########################################
@@ -97,20 +189,24 @@ def repackage_hidden(h):
     """ to reduce memory usage"""
     if h is None:
         return None
-    if isinstance(h, Variable):
-        return Variable(h.data)
+    if isinstance(h, torch.Tensor):
+        return h.detach()
     else:
         return tuple(repackage_hidden(v) for v in h)
 
 
 class RNNGate(nn.Module):
     """Recurrent Gate definition.
-    Input is already passed through average pooling and embedding."""
-    def __init__(self, input_dim, hidden_dim, rnn_type='lstm', output_channel=1):
+    Input is already passed through average pooling and embedding.
+    With `unroll=True` the single LSTM step is written out with plain tensor
+    ops on the same parameters, so that the gate can be graph-captured."""
+    def __init__(self, input_dim, hidden_dim, rnn_type='lstm', output_channel=1,
+                 unroll=False, config=None):
         super(RNNGate, self).__init__()
         self.rnn_type = rnn_type
         self.input_dim = input_dim
         self.hidden_dim = hidden_dim
+        self.unroll = unroll
 
         if self.rnn_type == 'lstm':
             self.rnn = nn.LSTM(input_dim, hidden_dim)
@@ -118,37 +214,60 @@ class RNNGate(nn.Module):
             self.rnn = None
         self.hidden = None
 
-        # reduce dim
-        self.proj = nn.Linear(hidden_dim, output_channel)
+        # reduce dim, quantized if given a `config`
+        if config is not None:
+            self.proj = linear(hidden_dim, output_channel, input_signed=True,
+                               writer_prefix='gate_proj', config=config)
+        else:
+            self.proj = nn.Linear(hidden_dim, output_channel)
         self.prob = nn.Sigmoid()
 
     def init_hidden(self, batch_size):
         # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda(), requires_grad=True),
-                autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda(), requires_grad=True))
+        weight = self.proj.weight
+        return (weight.new_zeros(1, batch_size, self.hidden_dim),
+                weight.new_zeros(1, batch_size, self.hidden_dim))
 
     def repackage_hidden(self):
         self.hidden = repackage_hidden(self.hidden)
 
+    def _lstm_step(self, x, hidden):
+        """One LSTM time step, equivalent to `self.rnn` on a length-1 sequence"""
+        h, c = hidden
+        gates = F.linear(x, self.rnn.weight_ih_l0, self.rnn.bias_ih_l0) + \
+                F.linear(h[0], self.rnn.weight_hh_l0, self.rnn.bias_hh_l0)
+        i, f, g, o = gates.chunk(4, 1)
+        c = torch.sigmoid(f) * c[0] + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        h, c = h.unsqueeze(0), c.unsqueeze(0)
+        return h, (h, c)
+
     def forward(self, x):
+        with phase('rnn_gate'):
+            return self._forward(x)
+
+    def _forward(self, x):
         # Take the convolution output of each step
         batch_size = x.size(0)
-        self.rnn.flatten_parameters()
-        out, self.hidden = self.rnn(x.view(1, batch_size, -1), self.hidden)
+        if self.unroll:
+            out, self.hidden = self._lstm_step(x.view(batch_size, -1), self.hidden)
+        else:
+            self.rnn.flatten_parameters()
+            out, self.hidden = self.rnn(x.view(1, batch_size, -1), self.hidden)
 
         proj = self.proj(out.squeeze())
         prob = self.prob(proj)
 
         # prob = nn.functional.relu(prob - 0.1)
 
-        tmp = torch.rand_like(prob)
-        disc_prob = (prob > tmp).float().detach() - \
-                    prob.detach() + prob
-
+        disc_prob = self.discretize(prob)
         disc_prob = disc_prob.view(batch_size, -1, 1, 1)
         return disc_prob, prob
+
+    def discretize(self, prob):
+        """Sample the hard gate decision, with the gradient of `prob`"""
+        tmp = torch.rand_like(prob)
+        return (prob > tmp).float().detach() - prob.detach() + prob
     #
     # def forward(self, x, jump):
     #     # Take the convolution output of each step
@@ -171,13 +290,34 @@ class RNNGate(nn.Module):
 class ResNetRecurrentGateSP(nn.Module):
     """SkipNet with Recurrent Gate Model"""
     def __init__(self, block, layers, num_classes=10, embed_dim=10,
-                 hidden_dim=10, gate_type='rnn', in_planes=64):
+                 hidden_dim=10, gate_type='rnn', in_planes=16, config=QuantConfig(),
+                 predictive_fc=False, predictive_gate=False, gate_groups=1):
         self.inplanes = in_planes
         super(ResNetRecurrentGateSP, self).__init__()
 
+        self.config = config
+        # the gate skips whole blocks (1) or groups of their output channels
+        self.gate_groups = gate_groups
+        if in_planes % gate_groups:
+            raise ValueError('gate_groups={} does not divide {} channels'.format(
+                gate_groups, in_planes))
+        if gate_groups > 1 and config.sparse_backward:
+            # the channel groups slice the convolutions, which the sparse
+            # weight gradient doesn't support
+            raise ValueError('sparse_backward is not implemented with gate_groups > 1')
+        self.predictive_gate = predictive_gate
         self.num_layers = layers
+        # blocks are kept in flat module lists in execution order so that
+        # `forward` needs no string lookups; `block_ids[k]` is the legacy
+        # (group_id, index) pair of block `k`
+        self.block_ids = []
+        self.downsamples = nn.ModuleList()
+        self.layers = nn.ModuleList()
+        self.gates = nn.ModuleList()
+        self._register_load_state_dict_pre_hook(self._translate_legacy_keys)
         # self.conv1 = conv3x3(3, 16, input_signed=True, predictive_forward=False, writer_prefix='conv1')
-        self.conv1 = conv3x3(3, in_planes, input_signed=True, predictive_forward=False, writer_prefix='conv1')
+        self.conv1 = conv3x3(3, in_planes, input_signed=True, predictive_forward=False,
+                             writer_prefix='conv1', config=config)
         # self.bn1 = nn.BatchNorm2d(16)
         self.bn1 = nn.BatchNorm2d(in_planes)
         self.relu = nn.ReLU(inplace=True)
@@ -205,9 +345,12 @@ class ResNetRecurrentGateSP(nn.Module):
         # define recurrent gating module
         # self.avgpool = nn.AvgPool2d(8)
         self.avgpool = nn.AvgPool2d(final_pool_size)
-        print(num_classes)
         # self.fc = nn.Linear(64 * block.expansion, num_classes)
-        self.fc = nn.Linear(final_channel_number * block.expansion, num_classes)
+        if predictive_fc:
+            self.fc = linear(final_channel_number * block.expansion, num_classes,
+                             writer_prefix='fc', config=config)
+        else:
+            self.fc = nn.Linear(final_channel_number * block.expansion, num_classes)
 
         for m in self.modules():
             if isinstance(m, (nn.Conv2d, PredictiveConv2d)):
@@ -219,9 +362,24 @@ class ResNetRecurrentGateSP(nn.Module):
             elif isinstance(m, nn.Linear):
                 n = m.weight.size(0) * m.weight.size(1)
                 m.weight.data.normal_(0, math.sqrt(2. / n))
-
-    def install_gate(self):
-        self.control = RNNGate(self.embed_dim, self.hidden_dim, rnn_type='lstm', output_channel=1)
+        for gate in self.gates:
+            gate.reset_parameters()
+
+    def install_gate(self, unroll_lstm=False):
+        self.control = RNNGate(self.embed_dim, self.hidden_dim, rnn_type='lstm',
+                               output_channel=self.gate_groups, unroll=unroll_lstm,
+                               config=self.config if self.predictive_gate else None)
+
+    def _translate_legacy_keys(self, state_dict, prefix, *args):
+        """Rename `group{g}_{layer,gate,ds}{i}` keys of old checkpoints"""
+        pattern = re.compile(r'^' + re.escape(prefix) + r'group(\d+)_(layer|gate|ds)(\d+)\.(.*)$')
+        kinds = {'layer': 'layers', 'gate': 'gates', 'ds': 'downsamples'}
+        for key in list(state_dict.keys()):
+            res = pattern.match(key)
+            if res:
+                k = self.block_ids.index((int(res.group(1)), int(res.group(3))))
+                new_key = '{}{}.{}.{}'.format(prefix, kinds[res.group(2)], k, res.group(4))
+                state_dict[new_key] = state_dict.pop(key)
 
     def _make_group(self, block, planes, layers, group_id=1, pool_size=16, writer_prefix=''):
         """ Create the whole group"""
@@ -234,9 +392,10 @@ class ResNetRecurrentGateSP(nn.Module):
             meta = self._make_layer_v2(block, planes, stride=stride,
                                        pool_size=pool_size, writer_prefix=writer_prefix+'_layer%d'%i)
 
-            setattr(self, 'group{}_ds{}'.format(group_id, i), meta[0])
-            setattr(self, 'group{}_layer{}'.format(group_id, i), meta[1])
-            setattr(self, 'group{}_gate{}'.format(group_id, i), meta[2])
+            self.block_ids.append((group_id, i))
+            self.downsamples.append(meta[0])
+            self.layers.append(meta[1])
+            self.gates.append(meta[2])
 
     def _make_layer_v2(self, block, planes, stride=1, pool_size=16, writer_prefix=''):
         """ create one block and optional a gate module """
@@ -244,24 +403,20 @@ class ResNetRecurrentGateSP(nn.Module):
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
                 conv1x1(self.inplanes, planes * block.expansion, stride=stride,
-                        input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_downsample'),
+                        input_signed=True, predictive_forward=False,
+                        writer_prefix=writer_prefix+'_downsample', config=self.config),
                 # nn.Conv2d(self.inplanes, planes * block.expansion,
                 #           kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(planes * block.expansion),
             )
-        layer = block(self.inplanes, planes, stride, downsample, writer_prefix=writer_prefix)
+        layer = block(self.inplanes, planes, stride, downsample, writer_prefix=writer_prefix,
+                      config=self.config)
 
         self.inplanes = planes * block.expansion
 
-        gate_layer = nn.Sequential(
-            nn.AvgPool2d(pool_size),
-            conv1x1(planes * block.expansion, self.embed_dim, stride=stride,
-                    input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_gate')
-        )
-            # nn.Conv2d(in_channels=planes * block.expansion,
-            #           out_channels=self.embed_dim,
-            #           kernel_size=1,
-            #           stride=1))
+        gate_layer = GateHead(planes * block.expansion, self.embed_dim, input_signed=True,
+                              writer_prefix=writer_prefix+'_gate',
+                              config=self.config if self.predictive_gate else None)
         if downsample:
             return downsample, layer, gate_layer
         else:
@@ -269,9 +424,6 @@ class ResNetRecurrentGateSP(nn.Module):
 
     def forward(self, x):
 
-        img_list = []
-
-
         batch_size = x.size(0)
         x = self.conv1(x)
         x = self.bn1(x)
@@ -285,46 +437,43 @@ class ResNetRecurrentGateSP(nn.Module):
         gprobs = []
         has_ds = []
         # must pass through the first layer in first group
-        x = getattr(self, 'group1_layer0')(x)
+        with phase('forward_blocks'):
+            x = self.layers[0](x)
         # gate takes the output of the current layer
 
-        gate_feature = getattr(self, 'group1_gate0')(x)
-        mask, gprob = self.control(gate_feature)
+        with phase('forward_gates'):
+            gate_feature = self.gates[0](x)
+            mask, gprob = self.control(gate_feature)
         gprobs.append(gprob)
         masks.append(mask.squeeze())
         has_ds.append(False)
         prev = x  # input of next layer
 
-        # for g in range(3):
-        for g in range(len(self.num_layers)):
-            for i in range(0 + int(g == 0), self.num_layers[g]):
-                if getattr(self, 'group{}_ds{}'.format(g+1, i)) is not None:
-                    prev = getattr(self, 'group{}_ds{}'.format(g+1, i))(prev)
+        for k in range(1, len(self.layers)):
+            # `prev` is `x`: one projection serves as the residual of the
+            # block and as the shortcut of the samples skipping it
+            with phase('forward_blocks'):
+                downsample = self.downsamples[k]
+                if downsample is not None:
+                    prev = downsample(prev)
                     has_ds.append(True)
                 else:
                     has_ds.append(False)
 
-                # if g == 0 and i == 6:
-                #     for j in range(16):
-                #         img_list.append(x[99][j].cpu().detach().numpy())
-                #         new_img = img_list[j]
-                #         new_img = (new_img - new_img.min()) / (new_img.max() - new_img.min()) * 255
-                #         scipy.misc.imsave('/home/yw68/skipnet/cifar/images_fm/{}_no_test.png'.format(j), new_img)
-
-                x = getattr(self, 'group{}_layer{}'.format(g+1, i))(x)
+                if self.gate_groups > 1:
+                    x = self.layers[k](x, group_mask=mask, residual=prev)
+                    mask = mask.repeat_interleave(x.size(1) // self.gate_groups, dim=1)
+                else:
+                    x = self.layers[k](x, residual=prev)
                 # new mask is taking the current output
                 prev = x = mask.expand_as(x) * x \
                            + (1 - mask).expand_as(prev) * prev
 
-                gate_feature = getattr(self, 'group{}_gate{}'.format(g+1, i))(x)
-                # control = getattr(self, 'control{}'.format(min(3, g + 1 + (i == self.num_layers[g] - 1))))
+            with phase('forward_gates'):
+                gate_feature = self.gates[k](x)
                 mask, gprob = self.control(gate_feature)
-                # if i == self.num_layers[g] - 1 and g != 2:
-                #     mask, grob = self.control(gate_feature, int(64 / (2**(g+5))))
-                # else:
-                #     mask, grob = self.control(gate_feature, int(64 / (2**(g+4))))
-                gprobs.append(gprob)
-                masks.append(mask.squeeze())
+            gprobs.append(gprob)
+            masks.append(mask.squeeze())
 
         # last block doesn't have gate module
         del masks[-1]
@@ -335,172 +484,136 @@ class ResNetRecurrentGateSP(nn.Module):
 
         return x, masks, gprobs, has_ds
 
+    def gated_layers(self):
+        """For each entry of the `masks` of `forward`: the names of the
+        predictive layers it skips, and of those that run regardless (the
+        downsample projection of the block)"""
+        layers = []
+        for k in range(1, len(self.layers)):
+            always = []
+            if self.downsamples[k] is not None:
+                always = [name for name, _ in predictive_layers(self.downsamples[k])]
+            # the block holds its downsample too, but doesn't run it
+            gated = [name for name, _ in predictive_layers(self.layers[k]) if name not in always]
+            layers.append((gated, always))
+        return layers
+
+    @torch.no_grad()
+    def gated_inference(self, x, regroup=True):
+        """Inference with hard gate decisions (`prob > 0.5`), for serving.
+
+        With `regroup=True` each block only runs on the samples that execute
+        it. The batch is kept sorted so that these form a prefix: after each
+        gate it is stably re-sorted by the new decision (together with the
+        gate state), unless it already is, so samples with the same gate
+        pattern stay contiguous and most blocks need no gather. Skipped
+        samples only go through the downsample projection, when there is one.
+        With `regroup=False` every block runs on the whole batch and the
+        outputs are blended, as in `forward`.
+
+        Returns the logits in input order and the fraction of the batch
+        that executed each gated block.
+        """
+        if self.gate_groups > 1:
+            raise ValueError('regrouped inference needs whole-block gates')
+        batch_size = x.size(0)
+        x = self.relu(self.bn1(self.conv1(x)))
+        self.control.hidden = self.control.init_hidden(batch_size)
+        x = self.layers[0](x)
+        # order[j]: input index of the sample at position j
+        order = torch.arange(batch_size, device=x.device)
+        executed = []
+        for k in range(1, len(self.layers)):
+            _, gprob = self.control(self.gates[k - 1](x))
+            mask = (gprob.view(-1) > 0.5).float()
+            downsample = self.downsamples[k]
+            if not regroup:
+                prev = x if downsample is None else downsample(x)
+                mask = mask.view(-1, 1, 1, 1)
+                x = mask * self.layers[k](x, residual=prev) + (1 - mask) * prev
+                executed.append(mask.mean().item())
+                continue
+            if bool((mask[1:] > mask[:-1]).any()):
+                # executing samples first, previous order kept within each side
+                perm = torch.sort(1 - mask, stable=True)[1]
+                x, mask, order = x[perm], mask[perm], order[perm]
+                self.control.hidden = tuple(h.index_select(1, perm)
+                                            for h in self.control.hidden)
+            n = int(mask.sum().item())
+            executed.append(n / batch_size)
+            if n == batch_size:
+                x = self.layers[k](x)
+            elif n == 0:
+                x = x if downsample is None else downsample(x)
+            else:
+                skipped = x[n:] if downsample is None else downsample(x[n:])
+                x = torch.cat([self.layers[k](x[:n]), skipped])
+
+        x = self.fc(self.avgpool(x).view(batch_size, -1))
+        if regroup:
+            x = x.new_empty(x.size()).index_copy_(0, order, x)
+        return x, executed
+
+
+def _quant_config(kwargs):
+    config = quant_config(kwargs)
+    logging.debug('quantization config: %s', config)
+    return config
+
+
+def _gate_groups(kwargs):
+    return kwargs.get('gate_groups', 1)
+
+
+def _head_options(kwargs):
+    """Whether the classifier and the gate (embedding and projection) are quantized too"""
+    return {'predictive_fc': kwargs.get('predictive_fc', False),
+            'predictive_gate': kwargs.get('predictive_gate', False)}
+
 
 # For CIFAR-10
 def cifar10_rnn_gate_18(pretrained=False, **kwargs):
     """SkipNet-18 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
-    # assert 0
-
     model = ResNetRecurrentGateSP(BasicBlock, [2,2,2,2], num_classes=10,
-                                  embed_dim=10, hidden_dim=10, in_planes=64)
+                                  embed_dim=10, hidden_dim=10, in_planes=64,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
+
 def cifar10_rnn_gate_38(pretrained=False, **kwargs):
     """SkipNet-38 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [6, 6, 6], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
 def cifar10_rnn_gate_74(pretrained=False, **kwargs):
     """SkipNet-74 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
-    # assert 0
-
     model = ResNetRecurrentGateSP(BasicBlock, [12, 12, 12], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
-def cifar10_rnn_gate_110(pretrained=False,  **kwargs):
+def cifar10_rnn_gate_110(pretrained=False, **kwargs):
     """SkipNet-110 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
     model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
-def cifar10_rnn_gate_152(pretrained=False,  **kwargs):
+def cifar10_rnn_gate_152(pretrained=False, **kwargs):
     """SkipNet-152 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [25, 25, 25], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
@@ -508,70 +621,34 @@ def cifar10_rnn_gate_152(pretrained=False,  **kwargs):
 def cifar100_rnn_gate_38(pretrained=False, **kwargs):
     """SkipNet-38 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [6, 6, 6], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
 def cifar100_rnn_gate_74(pretrained=False, **kwargs):
     """SkipNet-74 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [12, 12, 12], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
 def cifar100_rnn_gate_110(pretrained=False, **kwargs):
-    """SkipNet-110 with Recurrent Gate """
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
+    """SkipNet-110 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
 
 
 def cifar100_rnn_gate_152(pretrained=False, **kwargs):
     """SkipNet-152 with Recurrent Gate"""
     model = ResNetRecurrentGateSP(BasicBlock, [25, 25, 25], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  gate_groups=_gate_groups(kwargs),
+                                  config=_quant_config(kwargs), **_head_options(kwargs))
     return model
-
@@ -0,0 +1,118 @@
+"""Activation memory of a training forward pass, per predictive layer.
+
+`SavedTensorReport` intercepts every tensor autograd saves for backward
+(including `ctx.save_for_backward` of the custom Functions) and attributes
+its storage to the predictive layer running at the time and to the branch
+of that layer:
+
+- `quantization`: the input and weight quantizers,
+- `msb_branch`: the MSB convolution and its gradient quantizer,
+- `q_branch`: everything else in the layer (full precision convolution,
+  mixing of the two outputs).
+
+Tensors saved outside of the predictive layers (batch norms, ReLUs, the
+blending of skipped blocks, the gates) are attributed to the model phase
+(`forward_blocks`, `forward_gates`, ...). Storages are counted once, by
+whoever saves them first; parameters are not counted.
+"""
+
+import collections
+import logging
+
+import torch
+
+from models import profiling
+from models.precision import predictive_layers
+
+BRANCHES = ('q_branch', 'quantization', 'msb_branch')
+
+
+class SavedTensorReport(object):
+    """Context manager recording the bytes saved for backward inside it"""
+
+    def __init__(self, model):
+        self.model = model
+        # layer -> branch -> bytes, layers in order of execution
+        self.bytes = collections.OrderedDict()
+        self._seen = set()
+        self._layers = []
+        self._hooks = []
+
+    def __enter__(self):
+        self._seen = {p.untyped_storage().data_ptr() for p in self.model.parameters()}
+        for name, m in predictive_layers(self.model):
+            self._hooks.append(m.register_forward_pre_hook(
+                lambda m, args, name=name: self._layers.append(name)))
+            self._hooks.append(m.register_forward_hook(
+                lambda m, args, output: self._layers.pop()))
+        self._tracked = profiling.track(True)
+        self._saved_hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        self._saved_hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._saved_hooks.__exit__(*exc)
+        profiling.track(self._tracked)
+        for h in self._hooks:
+            h.remove()
+        self._hooks = []
+        return False
+
+    def _pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() in self._seen:
+            return tensor
+        self._seen.add(storage.data_ptr())
+        phase = profiling.current_phase()
+        if self._layers:
+            layer = self._layers[-1]
+            branch = phase if phase in BRANCHES else 'q_branch'
+        else:
+            layer = '({})'.format(phase or 'other')
+            branch = 'q_branch'
+        branches = self.bytes.setdefault(layer, collections.OrderedDict())
+        branches[branch] = branches.get(branch, 0) + storage.nbytes()
+        return tensor
+
+    def total(self, branch=None):
+        return sum(b for branches in self.bytes.values()
+                   for name, b in branches.items() if branch is None or name == branch)
+
+    def as_dict(self):
+        return {layer: dict(branches) for layer, branches in self.bytes.items()}
+
+    def log(self, logger=logging):
+        mb = 2. ** 20
+        header = '{:<32s}' + ' {:>12s}' * (len(BRANCHES) + 1)
+        row = '{:<32s}' + ' {:>12.2f}' * (len(BRANCHES) + 1)
+        logger.info(header.format('saved for backward (MB)', *(BRANCHES + ('total',))))
+        for layer, branches in self.bytes.items():
+            values = [branches.get(b, 0) / mb for b in BRANCHES]
+            logger.info(row.format(layer, *(values + [sum(values)])))
+        totals = [self.total(b) / mb for b in BRANCHES]
+        logger.info(row.format('total', *(totals + [sum(totals)])))
+
+
+def saved_tensor_report(model, input):
+    """Attribute the tensors saved by one training forward of `model` on `input`.
+
+    Runs on the module itself: the hooks are thread local, so they would
+    not see the replicas of `DataParallel`. The running statistics the pass
+    updates are restored.
+    """
+    training = model.training
+    buffers = [(b, b.clone()) for b in model.buffers()]
+    model.train()
+    try:
+        with SavedTensorReport(model) as report:
+            output = model(input)
+        del output
+    finally:
+        model.train(training)
+        with torch.no_grad():
+            for b, saved in buffers:
+                b.copy_(saved)
+        if hasattr(model, 'control'):
+            # drop the graph the gate state still refers to
+            model.control.repackage_hidden()
+    return report
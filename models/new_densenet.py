@@ -1,34 +1,19 @@
-import sys
 import re
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.model_zoo as model_zoo
 from collections import OrderedDict
-import torch.autograd as autograd
-from torch.autograd import  Variable
-import numpy as np
-import scipy.misc
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
 
-from models.conv import PredictiveConv2d
+from models.conv_efficient import PredictiveConv2d
+from models.quantize import QuantConfig, quant_config
+from models import efficient_resnet
+from models.precision import predictive_layers
+from models.profiling import phase
 
-NUM_BITS = 8
-NUM_BITS_WEIGHT = 8
-NUM_BITS_GRAD = None,
-
-BIPRECISION = False
-PREDICTIVE_FORWARD = False
-PREDICTIVE_BACKWARD = True
-MSB_BITS = 4
-MSB_BITS_WEIGHT = 4
-MSB_BITS_GRAD = 16
-
-THRESHOLD = 5e-5
-SPARSIFY = False
-SIGN = True
-WRITER = None
-
-__all__ = ['DenseNet', 'new_densenet121', 'densenet169', 'densenet201', 'densenet161']
+__all__ = ['DenseNet', 'cifar10_rnn_gate_densenet100', 'cifar100_rnn_gate_densenet100',
+           'new_densenet121', 'densenet169', 'densenet201', 'densenet161']
 
 
 model_urls = {
@@ -38,97 +23,58 @@ model_urls = {
     'densenet161': 'https://download.pytorch.org/models/densenet161-8d451a50.pth',
 }
 
-def conv1x1(in_planes, out_planes, stride=1,
-            input_signed=True, predictive_forward=True, writer_prefix=""):
-    "1x1 convolution with no padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
-    return PredictiveConv2d(
-        in_planes, out_planes, kernel_size=1, stride=stride, padding=0, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
-
-
-def conv3x3(in_planes, out_planes, stride=1,
-            input_signed=False, predictive_forward=True, writer_prefix=""):
-    "3x3 convolution with padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
-    return PredictiveConv2d(
-        in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
+conv1x1 = efficient_resnet.conv1x1
+conv3x3 = efficient_resnet.conv3x3
+linear = efficient_resnet.linear
+GateHead = efficient_resnet.GateHead
+_quant_config = efficient_resnet._quant_config
+_head_options = efficient_resnet._head_options
+
+
+def _load_pretrained(model, name):
+    # imported here, `torch.hub` is slow to import
+    import torch.utils.model_zoo as model_zoo
+    # '.'s are no longer allowed in module names, but pervious _DenseLayer
+    # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
+    # They are also in the checkpoints in model_urls. This pattern is used
+    # to find such keys.
+    pattern = re.compile(
+        r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
+    state_dict = model_zoo.load_url(model_urls[name])
+    for key in list(state_dict.keys()):
+        res = pattern.match(key)
+        if res:
+            new_key = res.group(1) + res.group(2)
+            state_dict[new_key] = state_dict[key]
+            del state_dict[key]
+    model.load_state_dict(state_dict)
+
+
+# For CIFAR
+def cifar10_rnn_gate_densenet100(pretrained=False, **kwargs):
+    """DenseNet-BC-100 (k=12) with Recurrent Gate"""
+    model = DenseNet(num_init_features=24, growth_rate=12, block_config=(16, 16, 16),
+                     num_classes=10, config=_quant_config(kwargs), **_head_options(kwargs))
+    return model
+
+
+def cifar100_rnn_gate_densenet100(pretrained=False, **kwargs):
+    """DenseNet-BC-100 (k=12) with Recurrent Gate"""
+    model = DenseNet(num_init_features=24, growth_rate=12, block_config=(16, 16, 16),
+                     num_classes=100, config=_quant_config(kwargs), **_head_options(kwargs))
+    return model
 
-def new_densenet121(pretrained=False, **kwargs):
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = None
 
+def new_densenet121(pretrained=False, **kwargs):
     r"""Densenet-121 model from
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`_
     Args:
         pretrained (bool): If True, returns a model pre-trained on ImageNet
     """
     model = DenseNet(num_init_features=24, growth_rate=12, block_config=(6, 12, 24, 16),
-                     )
+                     config=_quant_config(kwargs), **_head_options(kwargs))
     if pretrained:
-        # '.'s are no longer allowed in module names, but pervious _DenseLayer
-        # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
-        # They are also in the checkpoints in model_urls. This pattern is used
-        # to find such keys.
-        pattern = re.compile(
-            r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
-        state_dict = model_zoo.load_url(model_urls['densenet121'])
-        for key in list(state_dict.keys()):
-            res = pattern.match(key)
-            if res:
-                new_key = res.group(1) + res.group(2)
-                state_dict[new_key] = state_dict[key]
-                del state_dict[key]
-        model.load_state_dict(state_dict)
+        _load_pretrained(model, 'densenet121')
     return model
 
 
@@ -139,53 +85,25 @@ def densenet169(pretrained=False, **kwargs):
         pretrained (bool): If True, returns a model pre-trained on ImageNet
     """
     model = DenseNet(num_init_features=64, growth_rate=32, block_config=(6, 12, 32, 32),
-                     **kwargs)
+                     config=_quant_config(kwargs), **_head_options(kwargs))
     if pretrained:
-        # '.'s are no longer allowed in module names, but pervious _DenseLayer
-        # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
-        # They are also in the checkpoints in model_urls. This pattern is used
-        # to find such keys.
-        pattern = re.compile(
-            r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
-        state_dict = model_zoo.load_url(model_urls['densenet169'])
-        for key in list(state_dict.keys()):
-            res = pattern.match(key)
-            if res:
-                new_key = res.group(1) + res.group(2)
-                state_dict[new_key] = state_dict[key]
-                del state_dict[key]
-        model.load_state_dict(state_dict)
+        _load_pretrained(model, 'densenet169')
     return model
 
 
 def densenet100(pretrained=False, **kwargs):
-    r"""Densenet-201 model from
+    r"""Densenet-100 model from
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`_
     Args:
         pretrained (bool): If True, returns a model pre-trained on ImageNet
     """
     model = DenseNet(num_init_features=24, growth_rate=12, block_config=(16, 16, 16),
-                     **kwargs)
+                     config=_quant_config(kwargs), **_head_options(kwargs))
     if pretrained:
-        # '.'s are no longer allowed in module names, but pervious _DenseLayer
-        # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
-        # They are also in the checkpoints in model_urls. This pattern is used
-        # to find such keys.
-        pattern = re.compile(
-            r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
-        state_dict = model_zoo.load_url(model_urls['densenet201'])
-        for key in list(state_dict.keys()):
-            res = pattern.match(key)
-            if res:
-                new_key = res.group(1) + res.group(2)
-                state_dict[new_key] = state_dict[key]
-                del state_dict[key]
-        model.load_state_dict(state_dict)
+        _load_pretrained(model, 'densenet201')
     return model
 
 
-
-
 def densenet201(pretrained=False, **kwargs):
     r"""Densenet-201 model from
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`_
@@ -193,22 +111,9 @@ def densenet201(pretrained=False, **kwargs):
         pretrained (bool): If True, returns a model pre-trained on ImageNet
     """
     model = DenseNet(num_init_features=64, growth_rate=32, block_config=(6, 12, 48, 32),
-                     **kwargs)
+                     config=_quant_config(kwargs), **_head_options(kwargs))
     if pretrained:
-        # '.'s are no longer allowed in module names, but pervious _DenseLayer
-        # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
-        # They are also in the checkpoints in model_urls. This pattern is used
-        # to find such keys.
-        pattern = re.compile(
-            r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
-        state_dict = model_zoo.load_url(model_urls['densenet201'])
-        for key in list(state_dict.keys()):
-            res = pattern.match(key)
-            if res:
-                new_key = res.group(1) + res.group(2)
-                state_dict[new_key] = state_dict[key]
-                del state_dict[key]
-        model.load_state_dict(state_dict)
+        _load_pretrained(model, 'densenet201')
     return model
 
 
@@ -219,37 +124,91 @@ def densenet161(pretrained=False, **kwargs):
         pretrained (bool): If True, returns a model pre-trained on ImageNet
     """
     model = DenseNet(num_init_features=96, growth_rate=48, block_config=(6, 12, 36, 24),
-                     **kwargs)
+                     config=_quant_config(kwargs), **_head_options(kwargs))
     if pretrained:
-        # '.'s are no longer allowed in module names, but pervious _DenseLayer
-        # has keys 'norm.1', 'relu.1', 'conv.1', 'norm.2', 'relu.2', 'conv.2'.
-        # They are also in the checkpoints in model_urls. This pattern is used
-        # to find such keys.
-        pattern = re.compile(
-            r'^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$')
-        state_dict = model_zoo.load_url(model_urls['densenet161'])
-        for key in list(state_dict.keys()):
-            res = pattern.match(key)
-            if res:
-                new_key = res.group(1) + res.group(2)
-                state_dict[new_key] = state_dict[key]
-                del state_dict[key]
-        model.load_state_dict(state_dict)
+        _load_pretrained(model, 'densenet161')
     return model
 
+
+class ConcatBuffer(object):
+    """Preallocated storage for the growing concatenation of a dense block.
+
+    `write` only copies the features that are not in the buffer yet, so each
+    feature map of a block is copied once instead of once per later layer.
+    """
+
+    def __init__(self, like, channels):
+        self.data = like.new_empty(like.size(0), channels, like.size(2), like.size(3))
+        # (id, version) of the features in the buffer, in channel order
+        self.written = []
+
+    def write(self, features):
+        with torch.no_grad():
+            k = offset = 0
+            while (k < len(self.written) and k < len(features) and
+                   self.written[k] == (id(features[k]), features[k]._version)):
+                offset += features[k].size(1)
+                k += 1
+            del self.written[k:]
+            for f in features[k:]:
+                self.data[:, offset:offset + f.size(1)].copy_(f)
+                offset += f.size(1)
+                self.written.append((id(f), f._version))
+        return self.data[:, :offset]
+
+
+class _SharedConcat(Function):
+    """`torch.cat(features, 1)` written into a `ConcatBuffer`.
+
+    The output aliases the buffer, which later layers write into; it may
+    only be consumed inside `shared_concat_apply`.
+    """
+
+    @staticmethod
+    def forward(ctx, buffer, *features):
+        ctx.sizes = [f.size(1) for f in features]
+        return buffer.write(features)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return (None,) + tuple(grad_output.split(ctx.sizes, 1))
+
+
+def shared_concat_apply(fn, buffer, features):
+    """`fn(torch.cat(features, 1))` with the concatenation kept in `buffer`.
+
+    When training, `fn` is checkpointed: nothing it computes from the
+    concatenation is kept for backward, it is recomputed from the buffer
+    instead, so the memory of a block is linear in its depth. Without a
+    buffer this is a plain `torch.cat`.
+    """
+    if buffer is None:
+        return fn(torch.cat(features, 1))
+
+    def run(*features):
+        return fn(_SharedConcat.apply(buffer, *features))
+
+    if torch.is_grad_enabled() and any(f.requires_grad for f in features):
+        return checkpoint(run, *features, use_reentrant=False)
+    return run(*features)
+
+
 class _DenseLayer(nn.Module):
-    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate):
+    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, writer_prefix="",
+                 config=QuantConfig()):
         super(_DenseLayer, self).__init__()
         self.num_input_features = num_input_features
         self.num_output_features = growth_rate
         self.dense_module = nn.Sequential(OrderedDict([('norm1', nn.BatchNorm2d(num_input_features)),
                       ('relu1', nn.ReLU()),
                       ('conv1', conv1x1(num_input_features, bn_size *
-                        growth_rate, stride=1, input_signed=False, predictive_forward=False)),
+                        growth_rate, stride=1, input_signed=False, predictive_forward=False,
+                        writer_prefix=writer_prefix+'_conv1', config=config)),
                       ('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
                       ('relu2', nn.ReLU()),
                       ('conv2', conv3x3(bn_size * growth_rate, growth_rate,
-                        input_signed=False, predictive_forward=False))])
+                        input_signed=False, predictive_forward=False,
+                        writer_prefix=writer_prefix+'_conv2', config=config))])
                        )
         self.drop_rate = drop_rate
 
@@ -259,45 +218,63 @@ class _DenseLayer(nn.Module):
             new_features = F.dropout(new_features, p=self.drop_rate, training=self.training)
         return new_features
 
+    def bottleneck(self, x):
+        m = self.dense_module
+        return m.conv1(m.relu1(m.norm1(x)))
+
+    def forward_features(self, features, buffer=None):
+        """`forward` on the concatenation of `features`, with the
+        BN-ReLU-conv1x1 bottleneck on the shared `buffer`"""
+        m = self.dense_module
+        out = shared_concat_apply(self.bottleneck, buffer, features)
+        new_features = m.conv2(m.relu2(m.norm2(out)))
+        if self.drop_rate > 0:
+            new_features = F.dropout(new_features, p=self.drop_rate, training=self.training)
+        return new_features
+
 
 class _Transition(nn.Module):
-    def __init__(self, num_input_features, num_output_features):
+    def __init__(self, num_input_features, num_output_features, writer_prefix="",
+                 config=QuantConfig()):
         super(_Transition, self).__init__()
         self.trans_module = nn.Sequential(OrderedDict([('norm', nn.BatchNorm2d(num_input_features)),
                        ('relu', nn.ReLU()),
                        ('conv', conv1x1(num_input_features, num_output_features,
-                                          stride=1, input_signed=False, predictive_forward=False)),
+                                        stride=1, input_signed=False, predictive_forward=False,
+                                        writer_prefix=writer_prefix, config=config)),
                        ('pool', nn.AvgPool2d(kernel_size=2, stride=2))]))
     def forward(self, x):
         return self.trans_module(x)
 
 
-
-
-
-
 class DenseNet(nn.Module):
     r"""Densenet-BC model class, based on
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`_
     Args:
         growth_rate (int) - how many filters to add each layer (`k` in paper)
-        block_config (list of 4 ints) - how many layers in each pooling block
+        block_config (list of ints) - how many layers in each pooling block (the first three are built)
         num_init_features (int) - the number of filters to learn in the first convolution layer
         bn_size (int) - multiplicative factor for number of bottle neck layers
           (i.e. bn_size * k features in the bottleneck layer)
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
+        config (QuantConfig) - precision of the predictive layers
     """
 
     def __init__(self, growth_rate=12, block_config=(16, 16, 16),
-                 num_init_features=24, bn_size=4, drop_rate=0, num_classes=1000, embed_dim = 10, hidden_dim = 10):
+                 num_init_features=24, bn_size=4, drop_rate=0, num_classes=1000, embed_dim = 10, hidden_dim = 10,
+                 memory_efficient=True, config=QuantConfig(), predictive_fc=False, predictive_gate=False):
 
         super(DenseNet, self).__init__()
 
         self.growth_rate = growth_rate
+        self.memory_efficient = memory_efficient
+        self.config = config
+        self.predictive_gate = predictive_gate
         # First convolution
 
-        self.base_layer = conv3x3(3, num_init_features, input_signed=False, predictive_forward=False)
+        self.base_layer = conv3x3(3, num_init_features, input_signed=False, predictive_forward=False,
+                                  writer_prefix='conv0', config=config)
 
         # self.base_layer = nn.Sequential(OrderedDict([
             # ('conv0', nn.Conv2d(3, num_init_features, kernel_size=3, stride=1, padding=1, bias=False)),
@@ -315,125 +292,35 @@ class DenseNet(nn.Module):
 
         self.avg_pool_two = nn.AvgPool2d(kernel_size=2, stride=2)
 
-        # self.control = RNNGate(embed_dim, hidden_dim, rnn_type = 'lstm')
-
-
-        # denseblock 0
-        for i in range(block_config[0]):
-            setattr(self, 'denseblock0_%s' % i, self._make_layer(i, i+1, num_features, growth_rate, bn_size, drop_rate))
+        # three dense blocks on 32x32, 16x16 and 8x8 feature maps
+        for b in range(3):
+            if b > 0:
+                setattr(self, 'trans{}'.format(b - 1), _Transition(
+                    num_input_features=num_features, num_output_features=num_features // 2,
+                    writer_prefix='trans{}'.format(b - 1), config=config))
+                num_features = num_features // 2
 
-            input_channels = num_features + i * growth_rate
+            for i in range(block_config[b]):
+                writer_prefix = 'block{}_layer{}'.format(b, i)
+                setattr(self, 'denseblock{}_{}'.format(b, i),
+                        self._make_layer(i, i+1, num_features, growth_rate, bn_size, drop_rate,
+                                         writer_prefix=writer_prefix))
 
+                gate_layer = GateHead(num_features + (i + 1) * growth_rate, self.embed_dim,
+                                      input_signed=False, writer_prefix=writer_prefix+'_gate',
+                                      config=config if predictive_gate else None)
+                setattr(self, 'denseblock{}_{}_gate'.format(b, i), gate_layer)
 
-            gate_layer = nn.Sequential(
-                nn.AvgPool2d(32),
-                conv1x1(in_planes = num_features + (i + 1) * growth_rate,
-                          out_planes = self.embed_dim,
-                          stride = 1,
-                          input_signed=False,
-                          predictive_forward=False))
-
-
-            setattr(self, 'denseblock0_%s_gate' % i, gate_layer)
-
-            if input_channels != growth_rate:
-                downsample = nn.Sequential(
-                    conv1x1(input_channels,growth_rate,
-                              stride = 1, input_signed=False, predictive_forward=False),
-                    nn.BatchNorm2d(growth_rate),
-
-                )
-
-                setattr(self, 'denseblock0_%s_ds' % i, downsample)
-
-
-
-        num_features = (num_features + block_config[0] * growth_rate)
-        self.trans0 = _Transition(num_input_features=num_features, num_output_features=num_features // 2)
-        num_features = num_features // 2
-
-
-        # denseblock 1
-        for i in range(block_config[1]):
-            setattr(self, 'denseblock1_%s' % i, self._make_layer(i, i+1, num_features, growth_rate, bn_size, drop_rate))
-
-            input_channels = num_features + i * growth_rate
-
-            gate_layer = nn.Sequential(
-                nn.AvgPool2d(16),
-                conv1x1(in_planes = num_features + (i + 1) * growth_rate,
-                          out_planes = self.embed_dim,
-                          stride = 1,
-                          input_signed=False,
-                          predictive_forward=False))
-
-
-            setattr(self, 'denseblock1_%s_gate' % i, gate_layer)
-
-
-            if input_channels != growth_rate:
-                downsample = nn.Sequential(
-                    conv1x1(input_channels,growth_rate,
-                              stride = 1, input_signed=False, predictive_forward=False),
-                    nn.BatchNorm2d(growth_rate),
-
-                )
-
-                setattr(self, 'denseblock1_%s_ds' % i, downsample)
-
-
-
-        num_features = (num_features + block_config[1] * growth_rate)
-        self.trans1 = _Transition(num_input_features=num_features, num_output_features=num_features // 2)
-        num_features = num_features // 2
-
-
-
-        # denseblock 2
-        for i in range(block_config[2]):
-            setattr(self, 'denseblock2_%s' % i, self._make_layer(i, i+1, num_features, growth_rate, bn_size, drop_rate))
-
-            input_channels = num_features + i * growth_rate
-
-            gate_layer = nn.Sequential(
-                nn.AvgPool2d(8),
-                conv1x1(in_planes = num_features + (i + 1) * growth_rate,
-                          out_planes = self.embed_dim,
-                          stride = 1,
-                          input_signed=False, predictive_forward=False))
-
-
-            setattr(self, 'denseblock2_%s_gate' % i, gate_layer)
-
-            if input_channels != growth_rate:
-                downsample = nn.Sequential(
-                    conv1x1(input_channels,growth_rate,
-                              stride = 1, input_signed = False, predictive_forward=False),
-                    nn.BatchNorm2d(growth_rate),
-
-                )
-
-                setattr(self, 'denseblock2_%s_ds' % i, downsample)
-
-
-        num_features = (num_features + block_config[2] * growth_rate)
-       # self.trans2 = _Transition(num_input_features=num_features, num_output_features=num_features // 2)
-       # num_features = num_features // 2
-
-
-        # denseblock 3
-       # for i in range(block_config[3]):
-           # setattr(self, 'denseblock3_%s' % i, self._make_layer(i, i+1, num_features, growth_rate, bn_size, drop_rate))
-       # num_features = (num_features + block_config[3] * growth_rate)
-
+            num_features = num_features + block_config[b] * growth_rate
 
         # Final batch norm
         self.bn_norm = nn.BatchNorm2d(num_features)
 
         # Linear layer
-        self.classifier = nn.Linear(num_features, num_classes)
-
-
+        if predictive_fc:
+            self.classifier = linear(num_features, num_classes, writer_prefix='fc', config=config)
+        else:
+            self.classifier = nn.Linear(num_features, num_classes)
 
         # Official init from torch repo.
         for m in self.modules():
@@ -442,19 +329,35 @@ class DenseNet(nn.Module):
             elif isinstance(m, nn.BatchNorm2d):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
-            elif isinstance(m, nn.Linear):
+            elif isinstance(m, nn.Linear) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
-    def _make_layer(self, front_layer_idx, back_layer_index, num_input_features, growth_rate, bn_size, drop_rate):
+    def _make_layer(self, front_layer_idx, back_layer_index, num_input_features, growth_rate, bn_size, drop_rate,
+                    writer_prefix=''):
         modules = []
         for i in range(front_layer_idx, back_layer_index):
-            layer = _DenseLayer(num_input_features + i * growth_rate, growth_rate, bn_size, drop_rate)
+            layer = _DenseLayer(num_input_features + i * growth_rate, growth_rate, bn_size, drop_rate,
+                                writer_prefix=writer_prefix, config=self.config)
             modules.extend([layer])
         return nn.Sequential(*modules)
 
-    def install_gate(self):
-        self.control = RNNGate(self.embed_dim, self.hidden_dim, rnn_type='lstm')
+    def gated_layers(self):
+        """For each entry of the `masks` of `forward`: the names of the
+        predictive layers it skips (the next dense layer), and of those that
+        run regardless (none)"""
+        layers = [getattr(self, 'denseblock{}_{}'.format(b, i))
+                  for b in range(3) for i in range(self.block_config[b])]
+        return [([name for name, _ in predictive_layers(layer)], []) for layer in layers[1:]]
 
+    def install_gate(self, unroll_lstm=False):
+        self.control = RNNGate(self.embed_dim, self.hidden_dim, rnn_type='lstm', unroll=unroll_lstm,
+                               config=self.config if self.predictive_gate else None)
+
+    def _head(self, features):
+        features = self.bn_norm(features)
+        out = F.relu(features, inplace=True)
+        out = F.avg_pool2d(out, kernel_size=8, stride=1).view(features.size(0), -1)
+        return out
 
     def forward(self, x):
 
@@ -466,152 +369,53 @@ class DenseNet(nn.Module):
 
         masks = []
         gprobs = []
-
-        new_features = getattr(self, 'denseblock0_0')(features)
-
-        prev_new_features = new_features
-
-        features = torch.cat([features, new_features], 1)
-
-        gate_feature = getattr(self, 'denseblock0_0_gate')(features)
-        mask,gprob = self.control(gate_feature)
-
-        gprobs.append(gprob)
-        masks.append(mask.squeeze())
-
-        prev = features
-
-        # loop for denseblock 0
-        for i in range(1, self.block_config[0]):
-
-            # if getattr(self, 'denseblock0_{}_ds'.format(i)) is not None:
-                # prev = getattr(self, 'denseblock0_{}_ds'.format(i))(prev)
-
-            new_features = getattr(self, 'denseblock0_{}'.format(i))(features)
-            new_features = mask.expand_as(new_features) * new_features + (1 - mask).expand_as(prev_new_features) * prev_new_features
-
-            prev_new_features = new_features
-
-            features = torch.cat([features, new_features], 1)
-
-            gate_feature = getattr(self, 'denseblock0_{}_gate'.format(i))(features)
-            mask, gprob = self.control(gate_feature)
-
-            gprobs.append(gprob)
-            masks.append(mask.squeeze())
-
-            prev = features
-
-
-
-        features = self.trans0(features)
-        prev = features
-
-        # new_features = getattr(self, 'denseblock1_0')(features)
-
-        # prev_new_features = new_features
-
-        # features = torch.cat([features, new_features], 1)
-
-        # gate_feature = getattr(self, 'denseblock1_0_gate')(features)
-        # mask,gprob = self.control(gate_feature)
-
-        # gprobs.append(gprob)
-        # masks.append(mask.squeeze())
-
-        # prev = features
-
-
-        # loop for denseblock 1
-        for i in range(self.block_config[1]):
-
-            if i == 0:
-                prev_new_features = self.avg_pool_one(prev_new_features)
-
-            # if getattr(self, 'denseblock1_{}_ds'.format(i)) is not None:
-                # prev = getattr(self, 'denseblock1_{}_ds'.format(i))(prev)
-
-            new_features = getattr(self, 'denseblock1_{}'.format(i))(features)
-
-            new_features = mask.expand_as(new_features) * new_features + (1 - mask).expand_as(prev_new_features) * prev_new_features
-
-            prev_new_features = new_features
-
-            features = torch.cat([features, new_features], 1)
-
-            # print('group_one')
-            # print(i)
-
-            gate_feature = getattr(self, 'denseblock1_{}_gate'.format(i))(features)
-            mask, gprob = self.control(gate_feature)
-
-            gprobs.append(gprob)
-            masks.append(mask.squeeze())
-
-            prev = features
-
-        features = self.trans1(features)
-        prev = features
-
-        # new_features = getattr(self, 'denseblock2_0')(features)
-
-        # prev_new_features = new_features
-
-        # features = torch.cat([features, new_features], 1)
-
-        # gate_feature = getattr(self, 'denseblock2_0_gate')(features)
-        # mask,gprob = self.control(gate_feature)
-
-        # gprobs.append(gprob)
-        # vmasks.append(mask.squeeze())
-
-        # vprev = features
-
-        # loop for denseblock 2
-        for i in range(self.block_config[2]):
-
-            # print('group_two')
-            # print(i)
-
-            # if getattr(self, 'denseblock2_{}_ds'.format(i)) is not None:
-                # prev = getattr(self, 'denseblock2_{}_ds'.format(i))(prev)
-
-            if i == 0:
-                prev_new_features = self.avg_pool_two(prev_new_features)
-
-            new_features = getattr(self, 'denseblock2_{}'.format(i))(features)
-            new_features = mask.expand_as(new_features) * new_features + (1 - mask).expand_as(prev_new_features) * prev_new_features
-
-            prev_new_features = new_features
-
-            features = torch.cat([features, new_features], 1)
-
-
-            gate_feature = getattr(self, 'denseblock2_{}_gate'.format(i))(features)
-            mask, gprob = self.control(gate_feature)
-
-            if i < self.block_config[2] - 1:
-
+        mask = prev_new_features = None
+        pools = [None, self.avg_pool_one, self.avg_pool_two]
+
+        # only the first three entries of `block_config` are built
+        blocks = self.block_config[:3]
+        for b, num_layers in enumerate(blocks):
+            if b > 0:
+                features = shared_concat_apply(getattr(self, 'trans{}'.format(b - 1)), buffer, block)
+                prev_new_features = pools[b](prev_new_features)
+
+            # the concatenation of the block grows into one preallocated buffer
+            # instead of a `torch.cat` per layer
+            buffer = None
+            if self.memory_efficient:
+                buffer = ConcatBuffer(features, features.size(1) + num_layers * self.growth_rate)
+            block = [features]
+            # the gates only need the channel means, pooled once per feature map
+            pooled = [features.mean((2, 3))]
+
+            for i in range(num_layers):
+                layer = getattr(self, 'denseblock{}_{}'.format(b, i))[0]
+                with phase('forward_blocks'):
+                    new_features = layer.forward_features(block, buffer)
+                    # the first layer of the network always runs
+                    if mask is not None:
+                        new_features = mask.expand_as(new_features) * new_features \
+                                       + (1 - mask).expand_as(prev_new_features) * prev_new_features
+                prev_new_features = new_features
+                block.append(new_features)
+                pooled.append(new_features.mean((2, 3)))
+
+                # the last layer has no gate
+                if b == len(blocks) - 1 and i == num_layers - 1:
+                    break
+                with phase('forward_gates'):
+                    gate_feature = getattr(self, 'denseblock{}_{}_gate'.format(b, i)).project(
+                        torch.cat(pooled, 1))
+                    mask, gprob = self.control(gate_feature)
                 gprobs.append(gprob)
                 masks.append(mask.squeeze())
 
-            prev = features
-       # features = self.trans2(features)
-
-        # loop for denseblock 3
-       # for i in range(self.block_config[3]):
-           # new_features = getattr(self, 'denseblock3_{}'.format(i))(features)
-           # features = torch.cat([features, new_features], 1)
-
-        features = self.bn_norm(features)
-        out = F.relu(features, inplace=True)
-        out = F.avg_pool2d(out, kernel_size=8, stride=1).view(features.size(0), -1)
+        out = shared_concat_apply(self._head, buffer, block)
         out = self.classifier(out)
 
-
-        return out, masks, gprobs
-
-
+        # dense layers have no downsampling shortcut
+        has_ds = [False] * (len(masks) + 1)
+        return out, masks, gprobs, has_ds
 
 
 
@@ -669,58 +473,8 @@ class FeedforwardGateII(nn.Module):
 # Recurrent Gate  Design
 # ======================
 
-def repackage_hidden(h):
-    if type(h) == Variable:
-        return Variable(h.data)
-    else:
-        return tuple(repackage_hidden(v) for v in h)
-
-
-class RNNGate(nn.Module):
-    """given the fixed input size, return a single layer lstm """
-    def __init__(self, input_dim, hidden_dim, rnn_type='lstm',output_channel=1):
-        super(RNNGate, self).__init__()
-        self.rnn_type = rnn_type
-        self.input_dim = input_dim
-        self.hidden_dim = hidden_dim
-
-        if self.rnn_type == 'lstm':
-            self.rnn = nn.LSTM(input_dim, hidden_dim)
-        else:
-            self.rnn = None
-        self.hidden = None
-
-        # reduce dim
-        self.proj = nn.Linear(hidden_dim, output_channel)
-        self.prob = nn.Sigmoid()
-
-    def init_hidden(self, batch_size):
-        # Before we've done anything, we dont have any hidden state.
-        # Refer to the Pytorch documentation to see exactly
-        # why they have this dimensionality.
-        # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()),
-                autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()))
-
-    def repackage_hidden(self):
-        self.hidden = repackage_hidden(self.hidden)
-
-    def forward(self, x):
-        batch_size = x.size(0)
-        self.rnn.flatten_parameters()
-
-        out, self.hidden = self.rnn(x.view(1, batch_size, -1), self.hidden)
-
-        out = out.squeeze()
-
-        proj = self.proj(out.squeeze())
-        prob = self.prob(proj)
-
-        disc_prob = (prob > 0.5).float().detach() - prob.detach() + prob
-        disc_prob = disc_prob.view(batch_size, 1, 1, 1)
-
-        return disc_prob, prob
-
+class RNNGate(efficient_resnet.RNNGate):
+    """The recurrent gate of the ResNets, with a deterministic decision"""
 
+    def discretize(self, prob):
+        return (prob > 0.5).float().detach() - prob.detach() + prob
@@ -1,14 +1,18 @@
 """
 """
 
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Linear
 from torch.autograd import Function
 
-from models.quantize import calculate_qparams, quantize, quantize_grad
-from models.predictive import mixing_output, quant_weight, quant_bias
+from models.quantize import quantize_grad, EfficientQuantize
+from models.quantize import efficient_quantize, quantize_grad_tensor
+from models.predictive import mixing_output, efficient_quant_weight, quant_bias
+from models.predictive import record_grad_stats
 
 # Inherit from Function
 class PredictiveLinearFunction(Function):
@@ -42,31 +46,136 @@ class PredictiveLinearFunction(Function):
         if ctx.needs_input_grad[0]:
             grad_input = F.linear(grad_output, torch.transpose(weight,0,1))
 
-        # Calculate gradients w.r.t. weight
+        # Calculate gradients w.r.t. weight; a single [out, in] matmul over
+        # all samples, not a [batch, out, in] outer product reduced afterwards
+        grad_output_2d = grad_output.reshape(-1, grad_output.size(-1))
         if ctx.needs_input_grad[1]:
-            grad_weight = torch.bmm(grad_output.unsqueeze(2), input.unsqueeze(1))
-            grad_weight = grad_weight.sum(dim=0).sign()
+            grad_weight = grad_output_2d.t().mm(input.reshape(-1, input.size(-1)))
+            grad_weight.sign_()
 
         # Calculate gradients w.r.t. bias, if needed
         if bias is not None and ctx.needs_input_grad[2]:
-            grad_bias = bias.new_ones(bias.shape) * torch.sum(grad_output, dim=0)
-            grad_bias.sign_()
+            grad_bias = grad_output_2d.sum(0).sign_()
 
         return grad_input, grad_weight, grad_bias
 
 
+class SparsePredictiveLinearFunction(Function):
+    """Both branches of a predictive linear layer, like
+    `models.predictive.SparsePredictiveConv2dFunction`.
+
+    Saves only the quantized inputs and weight; the weight gradients are
+    `grad_output.t() @ input` over all samples (leading dimensions are
+    flattened), and the full precision one is only computed for the rows
+    that have entries below the threshold.
+    """
+
+    @staticmethod
+    def forward(ctx, weight, q_input, msb_input, q_weight, msb_weight, q_bias, msb_bias,
+                num_bits_grad, biprecision, msb_bits_grad, threshold, sparsify, sign, grad_stats,
+                stochastic_grad=False):
+        ctx.num_bits_grad = num_bits_grad
+        ctx.stochastic_grad = stochastic_grad
+        ctx.biprecision = biprecision
+        ctx.msb_bits_grad = msb_bits_grad
+        ctx.threshold = threshold
+        ctx.sparsify = sparsify
+        ctx.sign = sign
+        ctx.grad_stats = grad_stats
+        ctx.has_bias = q_bias is not None
+        ctx.save_for_backward(q_input, msb_input, q_weight)
+
+        with torch.no_grad():
+            q_output = F.linear(q_input, q_weight, q_bias)
+            msb_output = F.linear(msb_input, msb_weight, msb_bias)
+        return q_output, msb_output
+
+    @staticmethod
+    def backward(ctx, grad_q_output, grad_msb_output):
+        q_input, msb_input, q_weight = ctx.saved_tensors
+        grad_input = grad_q_bias = grad_msb_bias = None
+
+        with torch.no_grad():
+            # `linear_biprec` only quantizes the gradient w.r.t. the input
+            if ctx.biprecision:
+                grad_q_output_input = quantize_grad_tensor(
+                    grad_q_output, num_bits=ctx.num_bits_grad, stochastic=ctx.stochastic_grad)
+            else:
+                grad_q_output = grad_q_output_input = quantize_grad_tensor(
+                    grad_q_output, num_bits=ctx.num_bits_grad, flatten_dims=(1,-1),
+                    stochastic=ctx.stochastic_grad)
+            grad_msb_output = quantize_grad_tensor(
+                grad_msb_output, num_bits=ctx.msb_bits_grad, flatten_dims=(1,-1),
+                stochastic=ctx.stochastic_grad)
+            if ctx.needs_input_grad[1]:
+                grad_input = grad_q_output_input.matmul(q_weight)
+
+            out_features = q_weight.size(0)
+            grad_q_output = grad_q_output.reshape(-1, out_features)
+            grad_msb_output = grad_msb_output.reshape(-1, out_features)
+            q_input = q_input.reshape(-1, q_input.size(-1))
+            msb_input = msb_input.reshape(-1, msb_input.size(-1))
+            if ctx.has_bias:
+                grad_q_bias = grad_q_output.sum(0)
+                grad_msb_bias = grad_msb_output.sum(0)
+
+            grad_msb_weight = grad_msb_output.t().mm(msb_input)
+            grad_msb_weight_abs = grad_msb_weight.abs()
+            threshold = ctx.threshold
+            if threshold < 0:
+                threshold = -1.0 * threshold * grad_msb_weight_abs.max()
+            large_locs = (grad_msb_weight_abs >= threshold).float()
+            grad_weight = large_locs * grad_msb_weight
+
+            grad_q_weight, grad_msb_computed = None, grad_msb_weight
+            if not ctx.sparsify:
+                rows = (large_locs < 1).any(1).nonzero().squeeze(1)
+                if len(rows) == out_features:
+                    grad_q_weight = grad_q_output.t().mm(q_input)
+                    grad_weight += (1 - large_locs) * grad_q_weight
+                elif len(rows):
+                    grad_q_weight = grad_q_output[:, rows].t().mm(q_input)
+                    grad_weight[rows] += (1 - large_locs[rows]) * grad_q_weight
+                    grad_msb_computed = grad_msb_weight[rows]
+
+            record_grad_stats(ctx.grad_stats, large_locs, grad_msb_computed, grad_q_weight)
+
+            if ctx.sign:
+                grad_weight.sign_()
+
+        return (grad_weight, grad_input, None, None, None, grad_q_bias, grad_msb_bias) + (None,) * 8
+
+
+def linear_biprec(input, weight, bias=None, num_bits_grad=None, stochastic_grad=False):
+    out1 = F.linear(input.detach(), weight, bias)
+    out2 = F.linear(input, weight.detach(), bias.detach() if bias is not None else None)
+    out2 = quantize_grad(out2, num_bits=num_bits_grad, stochastic=stochastic_grad)
+    return out1 + out2 - out1.detach()
+
+
 class PredictiveLinear(Linear):
-    def __init__(self, in_features, out_features, bias=True, # the above two lines are the same as Conv2d
-                 num_bits_weight=8, num_bits_bias=16, # weight and bias precision
-                 input_signed=False, # whether the input is signed or unsigned
+    """Linear counterpart of `models.conv_efficient.PredictiveConv2d`.
+
+    Takes the same precision arguments (`**QuantConfig._asdict()`); the bias
+    is kept at `num_bits_bias` and `msb_bits_bias`.
+    """
+    def __init__(self, in_features, out_features, bias=True,
+                 num_bits=8, num_bits_weight=8, num_bits_grad=8,
+                 biprecision=True, input_signed=False,
                  predictive_forward=True, predictive_backward=True,
-                 msb_bits=4, msb_bits_weight=4, msb_bits_bias=8, msb_bits_grad=16,
-                 threshold=5e-5, sparsify=False, sign=False, writer=None):
+                 msb_bits=4, msb_bits_weight=4, msb_bits_grad=16,
+                 threshold=5e-5, sparsify=False, sign=False, sparse_backward=False,
+                 pack_saved=False, stochastic_grad=False, per_channel_act=False,
+                 num_bits_bias=16, msb_bits_bias=8,
+                 writer=None, writer_prefix=""):
 
         super(PredictiveLinear, self).__init__(in_features, out_features, bias)
 
+        self.num_bits = num_bits
         self.num_bits_weight = num_bits_weight
+        self.num_bits_grad = num_bits_grad
         self.num_bits_bias = num_bits_bias
+        self.biprecision = biprecision
         self.input_signed = input_signed
         self.predictive_forward = predictive_forward
         self.predictive_backward = predictive_backward
@@ -77,66 +186,96 @@ class PredictiveLinear(Linear):
         self.threshold = threshold
         self.sparsify = sparsify
         self.sign = sign
+        self.sparse_backward = sparse_backward
+        self.pack_saved = pack_saved
+        self.stochastic_grad = stochastic_grad
+        # the inputs are features without spatial dimensions to take the
+        # maximum over, their scale stays per tensor
+        self.per_channel_act = False
+        self.writer = writer
+        self.writer_prefix = writer_prefix
+        # MSB usage ratio and sign agreement rate of the last backward pass
+        self.register_buffer('grad_stats', torch.zeros(2), persistent=False)
 
-        if not self.predictive_backward:
-            self.msb_bits_grad = None
-            if not self.predictive_forward:
-                self.msb_bits = self.msb_bits_weight = None
-            else:
-                assert self.msb_bits is not None and self.msb_bits_weight is not None
+        assert self.predictive_backward and self.msb_bits is not None
+
+        self.quant_input = EfficientQuantize(
+            num_bits=self.num_bits, msb_bits=self.msb_bits,
+            shape_measure=(1,1,), flatten_dims=(1,-1), dequantize=True,
+            input_signed=self.input_signed, stochastic=False, momentum=0.1)
 
     def forward(self, input):
-        # See the autograd section for explanation of what happens here.
+        # Quantize `input` to `q_input` and `msb_input` in one pass
+        q_input, msb_input = self.quant_input(input)
 
-        # Quantize `input` to get `msb_input`
-        if self.msb_bits is not None:
-            msb_input_qparams = calculate_qparams(input.detach(), num_bits=self.msb_bits,
-                                                  flatten_dims=(1,-1), reduce_dim=0)
-            msb_input = quantize(input, qparams=msb_input_qparams, signed=self.input_signed)
-        else:
-            msb_input = None
+        if self.sparse_backward and self.training:
+            return self._forward_sparse_backward(q_input, msb_input)
 
         # Quantize weight
-        weights = quant_weight(
+        q_weight, msb_weight = efficient_quant_weight(
             self.weight, num_bits_weight=self.num_bits_weight,
             msb_bits_weight=self.msb_bits_weight, threshold=self.threshold,
-            sparsify=self.sparsify, sign=self.sign)
-        q_weight = weights[0]
-        msb_weight = weights[1] if len(weights) > 1 else None
+            sparsify=self.sparsify, sign=self.sign, grad_stats=self.grad_stats)
 
         # Quantize bias
         if self.bias is not None:
-            biases = quant_bias(
+            q_bias, msb_bias = quant_bias(
                 self.bias, num_bits_bias=self.num_bits_bias,
                 msb_bits_bias=self.msb_bits_bias, threshold=self.threshold,
                 sparsify=self.sparsify, sign=self.sign)
-            q_bias = biases[0]
-            msb_bias = biases[1] if len(biases) > 1 else None
         else:
-            q_bias = None
+            q_bias = msb_bias = None
 
-        # Q-branch
-        q_output = F.linear(input, q_weight, q_bias)
-        # MSB-branch
-        if self.predictive_forward and msb_input is not None and msb_weight is not None and msb_bias is not None:
+        with self._saved_inputs(q_input, msb_input):
+            # Q-branch
+            if not self.biprecision or self.num_bits_grad is None or self.num_bits_grad >= 32:
+                q_output = F.linear(q_input, q_weight, q_bias)
+                if self.num_bits_grad is not None and self.num_bits_grad < 32:
+                    q_output = quantize_grad(
+                        q_output, num_bits=self.num_bits_grad, flatten_dims=(1,-1),
+                        stochastic=self.stochastic_grad)
+            else:
+                q_output = linear_biprec(q_input, q_weight, q_bias,
+                                         num_bits_grad=self.num_bits_grad,
+                                         stochastic_grad=self.stochastic_grad)
+
+            # MSB-branch
             msb_output = F.linear(msb_input, msb_weight, msb_bias)
-        else:
-            msb_output = None
+            msb_output = quantize_grad(
+                msb_output, num_bits=self.msb_bits_grad, flatten_dims=(1,-1),
+                stochastic=self.stochastic_grad)
 
         # Mixing `q_output` and `msb_output`
-        output = mixing_output(q_output, msb_output, self.msb_bits_grad)
-
-        return output
-
-        # Quantize weight
-        weight_qparams = calculate_qparams(self.weight, num_bits=self.num_bits_weight,
-                                           flatten_dims=(1,-1), reduce_dim=None)
-        qweight = quantize(self.weight, qparams=weight_qparams, signed=True)
-
+        return mixing_output(
+            q_output, msb_output, self.predictive_forward, self.predictive_backward)
 
+    def _saved_inputs(self, q_input, msb_input):
+        if self.pack_saved and self.training:
+            return self.quant_input.saved_as_codes(q_input, msb_input)
+        return contextlib.nullcontext()
 
-        # Calculate convolution with (quantized) input, quantized weight and bias.
-        # When performing backward(), we will use the predictive SignSGD algorithm.
-        # The algorithm will use the msb precision and a threshold to deside which
-        # gradient will be calculated accurately.
-        return PredictiveSignLinearFunction.apply(input, qweight, qbias)
+    def _forward_sparse_backward(self, q_input, msb_input):
+        """Same output as `forward`, the weight gradient skips the rows
+        that don't need the full precision one"""
+        with torch.no_grad():
+            if ((self.num_bits_weight is None or self.num_bits_weight >= 32) and
+                (self.msb_bits_weight is None or self.msb_bits_weight >= 32)):
+                q_weight = msb_weight = self.weight.detach()
+            else:
+                q_weight, msb_weight = efficient_quantize(
+                    self.weight, num_bits=self.num_bits_weight, msb_bits=self.msb_bits_weight,
+                    flatten_dims=(1,-1), reduce_dim=None, signed=True)
+        if self.bias is not None:
+            q_bias, msb_bias = quant_bias(
+                self.bias, num_bits_bias=self.num_bits_bias,
+                msb_bits_bias=self.msb_bits_bias, threshold=self.threshold,
+                sparsify=self.sparsify, sign=self.sign)
+        else:
+            q_bias = msb_bias = None
+        with self._saved_inputs(q_input, msb_input):
+            q_output, msb_output = SparsePredictiveLinearFunction.apply(
+                self.weight, q_input, msb_input, q_weight, msb_weight, q_bias, msb_bias,
+                self.num_bits_grad, self.biprecision, self.msb_bits_grad,
+                self.threshold, self.sparsify, self.sign, self.grad_stats, self.stochastic_grad)
+        return mixing_output(
+            q_output, msb_output, self.predictive_forward, self.predictive_backward)
@@ -5,63 +5,39 @@ from torch.autograd import Variable
 import torch.autograd as autograd
 
 from models.conv import PredictiveConv2d
+from models.quantize import QuantConfig, quant_config
 
-NUM_BITS = 8
-NUM_BITS_WEIGHT = 8
-NUM_BITS_GRAD = None,
 
-BIPRECISION = False
-PREDICTIVE_FORWARD = False
-PREDICTIVE_BACKWARD = True
-MSB_BITS = 4
-MSB_BITS_WEIGHT = 4
-MSB_BITS_GRAD = 16
-
-THRESHOLD = 5e-5
-SPARSIFY = False
-SIGN = True
-WRITER = None
-
-WRITER_PREFIX_COUNTER = 0
-
-
-def conv1x1(in_planes, out_planes, stride=1, input_signed=True, predictive_forward=True, writer_prefix=""):
+def conv1x1(in_planes, out_planes, stride=1, input_signed=True, predictive_forward=True, writer_prefix="",
+            config=QuantConfig()):
     "1x1 convolution with no padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
+    config = config._replace(predictive_forward=config.predictive_forward and predictive_forward)
     return PredictiveConv2d(
         in_planes, out_planes, kernel_size=1, stride=stride, padding=0, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
+        input_signed=input_signed, writer_prefix=writer_prefix, **config._asdict())
 
 
-def conv3x3(in_planes, out_planes, stride=1, input_signed=False, predictive_forward=True, writer_prefix=""):
+def conv3x3(in_planes, out_planes, stride=1, input_signed=False, predictive_forward=True, writer_prefix="",
+            config=QuantConfig()):
     "3x3 convolution with padding"
-    predictive_forward = PREDICTIVE_FORWARD and predictive_forward
+    config = config._replace(predictive_forward=config.predictive_forward and predictive_forward)
     return PredictiveConv2d(
         in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False,
-        num_bits=NUM_BITS, num_bits_weight=NUM_BITS_WEIGHT, num_bits_grad=NUM_BITS_GRAD,
-        biprecision=BIPRECISION, input_signed=input_signed,
-        predictive_forward=predictive_forward, predictive_backward=PREDICTIVE_BACKWARD,
-        msb_bits=MSB_BITS, msb_bits_weight=MSB_BITS_WEIGHT, msb_bits_grad=MSB_BITS_GRAD,
-        threshold=THRESHOLD, sparsify=SPARSIFY, sign=SIGN,
-        writer=WRITER, writer_prefix=writer_prefix)
+        input_signed=input_signed, writer_prefix=writer_prefix, **config._asdict())
 
 
 class BasicBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, inplanes, planes, stride=1, downsample=None, writer_prefix=""):
+    def __init__(self, inplanes, planes, stride=1, downsample=None, writer_prefix="",
+                 config=QuantConfig()):
         super(BasicBlock, self).__init__()
-        self.conv1 = conv3x3(inplanes, planes, stride, input_signed=True,
-                             predictive_forward=False, writer_prefix=writer_prefix+'_conv1')
+        self.conv1 = conv3x3(inplanes, planes, stride, input_signed=True, predictive_forward=False,
+                             writer_prefix=writer_prefix+'_conv1', config=config)
         self.bn1 = nn.BatchNorm2d(planes)
         self.relu = nn.ReLU(inplace=True)
-        self.conv2 = conv3x3(planes, planes, input_signed=False,
-                             predictive_forward=False, writer_prefix=writer_prefix+'_conv2')
+        self.conv2 = conv3x3(planes, planes, input_signed=False, predictive_forward=False,
+                             writer_prefix=writer_prefix+'_conv2', config=config)
         self.bn2 = nn.BatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
@@ -144,13 +120,16 @@ class RNNGate(nn.Module):
 
 class ResNetRecurrentGateSP(nn.Module):
     """SkipNet with Recurrent Gate Model"""
-    def __init__(self, block, layers, num_classes=10, embed_dim=10, hidden_dim=10, in_planes=16):
+    def __init__(self, block, layers, num_classes=10, embed_dim=10, hidden_dim=10, in_planes=16,
+                 config=QuantConfig()):
         self.inplanes = in_planes
         super(ResNetRecurrentGateSP, self).__init__()
 
+        self.config = config
         self.num_layers = layers
         # self.conv1 = conv3x3(3, 16, input_signed=True, predictive_forward=False, writer_prefix='conv1')
-        self.conv1 = conv3x3(3, in_planes, input_signed=True, predictive_forward=False, writer_prefix='conv1')
+        self.conv1 = conv3x3(3, in_planes, input_signed=True, predictive_forward=False, writer_prefix='conv1',
+                             config=config)
         # self.bn1 = nn.BatchNorm2d(16)
         self.bn1 = nn.BatchNorm2d(in_planes)
         self.relu = nn.ReLU(inplace=True)
@@ -214,17 +193,20 @@ class ResNetRecurrentGateSP(nn.Module):
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
                 conv1x1(self.inplanes, planes * block.expansion, stride=stride,
-                        input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_downsample'),
+                        input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_downsample',
+                        config=self.config),
                 nn.BatchNorm2d(planes * block.expansion),
             )
-        layer = block(self.inplanes, planes, stride, downsample, writer_prefix=writer_prefix)
+        layer = block(self.inplanes, planes, stride, downsample, writer_prefix=writer_prefix,
+                      config=self.config)
 
         self.inplanes = planes * block.expansion
 
         gate_layer = nn.Sequential(
             nn.AvgPool2d(pool_size),
             conv1x1(planes * block.expansion, self.embed_dim, stride=stride,
-                    input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_gate')
+                    input_signed=True, predictive_forward=False, writer_prefix=writer_prefix+'_gate',
+                    config=self.config)
         )
         if downsample:
             return downsample, layer, gate_layer
@@ -280,306 +262,42 @@ class ResNetRecurrentGateSP(nn.Module):
         return x, masks, gprobs
 
 
+def _quant_config(kwargs):
+    config = quant_config(kwargs)
+    for name, value in config._asdict().items():
+        print('{}:'.format(name), value)
+    return config
+
+
 # For CIFAR-10
 def cifar10_rnn_gate_74(**kwargs):
     """SkipNet-74 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
     model = ResNetRecurrentGateSP(BasicBlock, [12, 12, 12], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  config=_quant_config(kwargs))
     return model
 
 
 def cifar10_rnn_gate_110(**kwargs):
     """SkipNet-110 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
     model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  config=_quant_config(kwargs))
     return model
 
-# For CIFAR-100
-
 
+# For CIFAR-100
 def cifar100_rnn_gate_110(**kwargs):
     """SkipNet-110 with Recurrent Gate """
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
     model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10,
+                                  config=_quant_config(kwargs))
     return model
 
 
 def cifar10_rnn_gate_18(**kwargs):
     """SkipNet-18 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
     model = ResNetRecurrentGateSP(BasicBlock, [2,2,2,2], num_classes=10,
-                                  embed_dim=10, hidden_dim=10, in_planes=64)
-    return model
-
-
-def cifar10_rnn_gate_110(**kwargs):
-    """SkipNet-110 with Recurrent Gate"""
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
-    model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=10,
-                                  embed_dim=10, hidden_dim=10)
-    return model
-
-# For CIFAR-100
-
-
-def cifar100_rnn_gate_110(**kwargs):
-    """SkipNet-110 with Recurrent Gate """
-
-    global NUM_BITS
-    global NUM_BITS_WEIGHT
-    global NUM_BITS_GRAD
-    global BIPRECISION
-    global PREDICTIVE_FORWARD
-    global PREDICTIVE_BACKWARD
-    global MSB_BITS
-    global MSB_BITS_WEIGHT
-    global MSB_BITS_GRAD
-    global THRESHOLD
-    global SPARSIFY
-    global SIGN
-    global WRITER
-
-    print('num_bits:', kwargs['num_bits'])
-    print('num_bits_weight:', kwargs['num_bits_weight'])
-    print('num_bits_grad:', kwargs['num_bits_grad'])
-    print('biprecision:', kwargs['biprecision'])
-    print('predictive_forward:', kwargs['predictive_forward'])
-    print('predictive_backward:', kwargs['predictive_backward'])
-    print('msb_bits:', kwargs['msb_bits'])
-    print('msb_bits_weight:', kwargs['msb_bits_weight'])
-    print('msb_bits_grad:', kwargs['msb_bits_grad'])
-    print('threshold:', kwargs['threshold'])
-    print('sparsify:', kwargs['sparsify'])
-    print('sign:', kwargs['sign'])
-    print('writer:', kwargs['writer'])
-
-    NUM_BITS = kwargs.pop('num_bits', 8)
-    NUM_BITS_WEIGHT = kwargs.pop('num_bits_weight', 8)
-    NUM_BITS_GRAD = kwargs.pop('num_bits_grad', None)
-    BIPRECISION = kwargs.pop('biprecision', False)
-    PREDICTIVE_FORWARD = kwargs.pop('predictive_forward', False)
-    PREDICTIVE_BACKWARD = kwargs.pop('predictive_backward', True)
-    MSB_BITS = kwargs.pop('msb_bits', 4)
-    MSB_BITS_WEIGHT = kwargs.pop('msb_bits_weight', 4)
-    MSB_BITS_GRAD = kwargs.pop('msb_bits_grad', 16)
-    THRESHOLD = kwargs.pop('threshold', 5e-4)
-    SPARSIFY = kwargs.pop('sparsify', False)
-    SIGN = kwargs.pop('sign', True)
-    WRITER = kwargs.pop('writer', None)
-
-    model = ResNetRecurrentGateSP(BasicBlock, [18, 18, 18], num_classes=100,
-                                  embed_dim=10, hidden_dim=10)
+                                  embed_dim=10, hidden_dim=10, in_planes=64,
+                                  config=_quant_config(kwargs))
     return model
@@ -0,0 +1,271 @@
+"""Per-layer precision of the predictive layers, optionally changing over
+the course of training.
+
+A schedule is a list of rules, read from a JSON file::
+
+    [
+        {"layers": "conv1|.*_gate", "num_bits": 8, "msb_bits": 6},
+        {"layers": ".*", "until": 20000, "msb_bits": 3, "msb_bits_grad": 8},
+        {"layers": "group_3_.*", "from": 40000, "num_bits": 10}
+    ]
+
+`layers` is a regular expression matched against the whole `writer_prefix`
+of a layer (e.g. `group_3_layer5_conv2`); `from`/`until` bound the
+iterations a rule is active for (`until` excluded). The remaining keys set
+precision fields of the layer. Rules are applied in order, so later rules
+win; once no active rule sets a field any more, it goes back to the value
+the layer was built with.
+"""
+
+import json
+import logging
+import math
+import re
+
+import torch
+import torch.nn as nn
+
+from models.predictive import grad_stats_snapshot
+
+# fields of `PredictiveConv2d` a rule may set
+SCHEDULED_FIELDS = ('num_bits', 'num_bits_weight', 'num_bits_grad',
+                    'msb_bits', 'msb_bits_weight', 'msb_bits_grad', 'threshold')
+
+
+def predictive_layers(model):
+    """(writer_prefix, module) of every predictive layer of `model`"""
+    return [(m.writer_prefix, m) for m in model.modules() if hasattr(m, 'grad_stats')]
+
+
+class PrecisionSchedule(object):
+    """Sets the precision of each predictive layer by name and iteration"""
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for rule in rules:
+            rule = dict(rule)
+            pattern = re.compile(rule.pop('layers', '.*'))
+            start = rule.pop('from', 0)
+            end = rule.pop('until', None)
+            unknown = set(rule) - set(SCHEDULED_FIELDS)
+            if unknown:
+                raise ValueError('unknown precision fields {}'.format(sorted(unknown)))
+            self.rules.append((pattern, start, end, rule))
+        self._base = {}
+        self._touched = {}
+        self._active = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def active(self, iteration):
+        return tuple(k for k, (_, start, end, _) in enumerate(self.rules)
+                     if iteration >= start and (end is None or iteration < end))
+
+    def settings(self, name, iteration):
+        """The fields the rules active at `iteration` set for layer `name`"""
+        fields = {}
+        for k in self.active(iteration):
+            pattern, _, _, values = self.rules[k]
+            if pattern.fullmatch(name):
+                fields.update(values)
+        return fields
+
+    def update(self, model, iteration):
+        """Apply the rules active at `iteration` to `model`.
+
+        Cheap enough to call every iteration: the layers are only touched
+        when the set of active rules changes. Returns whether they were.
+        """
+        active = self.active(iteration)
+        if active == self._active:
+            return False
+        self._active = active
+        for name, m in predictive_layers(model):
+            base = self._base.setdefault(
+                id(m), {f: getattr(m, f) for f in SCHEDULED_FIELDS})
+            # never switch on a branch the layer was built without
+            fields = {f: v for f, v in self.settings(name, iteration).items()
+                      if base[f] is not None}
+            # fields a rule no longer sets go back to their initial value,
+            # fields no rule ever set are left alone (see `ThresholdController`)
+            reverted = {f: base[f] for f in self._touched.get(id(m), ())
+                        if f not in fields}
+            self._touched[id(m)] = set(fields)
+            reverted.update(fields)
+            set_precision(m, **reverted)
+        return True
+
+
+def set_precision(layer, **fields):
+    """Change precision fields of a predictive layer in place"""
+    for f, v in fields.items():
+        setattr(layer, f, v)
+    # the input quantizer keeps its own copy of the activation bit widths
+    quant_input = layer.quant_input
+    if 'num_bits' in fields:
+        quant_input.num_bits = fields['num_bits']
+    if 'msb_bits' in fields and hasattr(quant_input, 'msb_bits'):
+        quant_input.msb_bits = fields['msb_bits']
+
+
+def layer_macs(model, input_size=(2, 3, 32, 32)):
+    """Multiply-accumulates per sample of every predictive layer.
+
+    Runs one forward pass on zeros to find the output sizes.
+    """
+    macs, hooks = {}, []
+
+    def record(m, input, output):
+        if isinstance(m, nn.Linear):
+            fan_in = m.in_features
+            outputs = output[0].numel()
+        else:
+            kh, kw = m.kernel_size
+            fan_in = kh * kw * m.in_channels // m.groups
+            # all the filters, also when the channel gates sliced the layer
+            outputs = m.out_channels * output.size(-2) * output.size(-1)
+        # a layer called several times per forward (the gate) counts each call
+        macs[m.writer_prefix] = macs.get(m.writer_prefix, 0) + outputs * fan_in
+
+    for _, m in predictive_layers(model):
+        hooks.append(m.register_forward_hook(record))
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(*input_size, device=device))
+    finally:
+        model.train(training)
+        for h in hooks:
+            h.remove()
+    return macs
+
+
+def gate_costs(model):
+    """Relative cost of what the gates of `model` control.
+
+    One `(cost, always, groups)` per entry of the `masks` of its `forward`,
+    from `model.gated_layers()` and the MACs of `layer_macs`: the cost of
+    each of the `groups` equal parts of the gated layers, and of what runs
+    for every sample anyway. Scaled so that the largest gated layer costs 1.
+    Cached on the model, the architecture doesn't change.
+    """
+    model = getattr(model, 'module', model)
+    costs = getattr(model, '_gate_costs', None)
+    if costs is None:
+        macs = layer_macs(model)
+        groups = getattr(model, 'gate_groups', 1)
+        costs = [(sum(macs.get(name, 0) for name in gated), sum(macs.get(name, 0) for name in always))
+                 for gated, always in model.gated_layers()]
+        scale = max(cost for cost, _ in costs) or 1.
+        costs = [(cost / scale / groups, always / scale, groups) for cost, always in costs]
+        model._gate_costs = costs
+    return costs
+
+
+def layer_bit_ops(m):
+    """Bit operations per MAC of one training step of a predictive layer.
+
+    Forward runs the full precision and the MSB convolution. Backward
+    propagates the input gradient through the full precision branch, at
+    `num_bits_grad` against the quantized weight, and computes the weight
+    gradient at `msb_bits_grad` against the MSB input (the fraction falling
+    back to full precision is reported separately by `grad_stats`).
+    """
+    ops = (m.num_bits or 32) * (m.num_bits_weight or 32)
+    grad_bits = m.num_bits_grad or 32
+    ops += grad_bits * (m.num_bits_weight or 32)
+    if m.msb_bits is not None:
+        ops += m.msb_bits * (m.msb_bits_weight or 32)
+        ops += (m.msb_bits_grad or 32) * m.msb_bits
+    else:
+        ops += grad_bits * (m.num_bits or 32)
+    return ops
+
+
+def energy_report(model, macs, reference_bits=32):
+    """Per-layer cost of the current precision.
+
+    Returns `(name, macs, cost)` per predictive layer, where `cost` is the
+    bit operations relative to the same layer trained at `reference_bits`
+    for activations, weights and gradients (three convolutions).
+    """
+    reference = 3 * reference_bits * reference_bits
+    report = []
+    for name, m in predictive_layers(model):
+        report.append((name, macs.get(name, 0), layer_bit_ops(m) / reference))
+    return report
+
+
+def log_energy_report(report, logger=logging):
+    total_macs = sum(n for _, n, _ in report) or 1
+    logger.info('{:<32s} {:>10s} {:>8s}'.format('layer', 'MMACs', 'cost'))
+    for name, n, cost in report:
+        logger.info('{:<32s} {:>10.3f} {:>8.3f}'.format(name, n / 1e6, cost))
+    logger.info('{:<32s} {:>10.3f} {:>8.3f}'.format(
+        'total', total_macs / 1e6, sum(n * cost for _, n, cost in report) / total_macs))
+
+
+class ThresholdController(object):
+    """Adapts the gradient threshold of each predictive layer to a budget.
+
+    Weight gradients whose MSB prediction is below the threshold are
+    computed at full precision; `target` is the fraction of them a layer
+    should end up with (one minus its `ratio_grad_msb_used`). Every `step`
+    scales each threshold multiplicatively towards the target. A layer whose
+    MSB gradient agrees in sign with the full precision one less often than
+    `min_agreement` is not pushed to use the prediction more.
+    """
+
+    def __init__(self, model, target, macs=None, gain=0.5, min_agreement=0.5):
+        self.target = target
+        self.gain = gain
+        self.min_agreement = min_agreement
+        self.layers = [(name, m) for name, m in predictive_layers(model)
+                       if m.msb_bits_grad is not None]
+        # weight the budget by the work of each layer
+        if macs is None:
+            macs = {name: m.weight.numel() for name, m in self.layers}
+        self.macs = macs
+
+    def step(self, model):
+        """Update the thresholds from the last backward pass.
+
+        Copies the gradient statistics to the host once. Returns the
+        achieved fraction of full precision weight gradients, weighted by
+        the MACs of each layer, and the per-layer fractions.
+        """
+        _, values = grad_stats_snapshot(model)
+        if values is None:
+            return None, {}
+        stats = values.view(-1, 2).tolist()
+        stats = {name: s for (name, _), s in zip(predictive_layers(model), stats)}
+
+        ratios, work, total = {}, 0., 0.
+        for name, m in self.layers:
+            msb_used, agreement = stats[name]
+            if msb_used == 0 and agreement == 0:
+                continue  # no backward pass through this layer yet
+            ratio = 1. - msb_used
+            ratios[name] = ratio
+            work += self.macs.get(name, 0) * ratio
+            total += self.macs.get(name, 0)
+
+            error = ratio - self.target
+            if error > 0 and agreement < self.min_agreement:
+                continue
+            # a larger |threshold| sends more gradients to full precision
+            m.threshold *= math.exp(-self.gain * error)
+        return (work / total if total else None), ratios
+
+    def state_dict(self):
+        return {name: m.threshold for name, m in self.layers}
+
+    def load_state_dict(self, state):
+        for name, m in self.layers:
+            if name in state:
+                m.threshold = state[name]
@@ -6,7 +6,8 @@ from torch.nn.modules.utils import _pair
 from torch.autograd import Function
 
 from models.quantize import calculate_qparams, quantize, quantize_grad
-from models.quantize import efficient_quantize
+from models.quantize import efficient_quantize, quantize_grad_tensor
+from torch.nn.grad import conv2d_input, conv2d_weight
 
 
 # Inherit from Function
@@ -15,7 +16,8 @@ class PredictiveForwardMixingFunction(Function):
     # Note that both forward and backward are @staticmethods
     @staticmethod
     def forward(ctx, q_out, msb_out, predictive_forward, predictive_backward): # , msb_bits_grad):
-        ctx.save_for_backward(msb_out)
+        # backward only needs to know whether there is an MSB output
+        ctx.has_msb_out = msb_out is not None
         ctx.predictive_backward = predictive_backward
 
         if msb_out is None or not predictive_forward:
@@ -28,11 +30,10 @@ class PredictiveForwardMixingFunction(Function):
     # This function has only a single output, so it gets only one gradient
     @staticmethod
     def backward(ctx, grad_output):
-        msb_out = ctx.saved_tensors[0]
         grad_q_out = grad_output
         grad_msb_out = None
         with torch.no_grad():
-            if msb_out is not None and ctx.predictive_backward:
+            if ctx.has_msb_out and ctx.predictive_backward:
                 grad_msb_out = grad_output.clone()
 
         return grad_q_out, grad_msb_out, None, None
@@ -43,13 +44,11 @@ class PredictiveWeightQuantFunction(Function):
     # Note that both forward and backward are @staticmethods
     @staticmethod
     def forward(ctx, weight, num_bits_weight, msb_bits_weight,
-                threshold, sparsify, sign, writer, writer_prefix, counter):
+                threshold, sparsify, sign, grad_stats):
         ctx.threshold = threshold
         ctx.sparsify = sparsify
         ctx.sign = sign
-        ctx.writer = writer
-        ctx.writer_prefix = writer_prefix
-        ctx.counter = counter
+        ctx.grad_stats = grad_stats
 
         with torch.no_grad():
             # q_weight
@@ -76,13 +75,8 @@ class PredictiveWeightQuantFunction(Function):
     @staticmethod
     def backward(ctx, *grad_output):
         grad_weight = None
-        writer = ctx.writer
-        prefix = ctx.writer_prefix
-        counter = ctx.counter
         grad_q_weight = grad_output[0]
         grad_msb_weight = grad_output[1] if len(grad_output) > 1 else None
-        # if writer is not None and counter % 400 == 0:
-            # writer.add_scalar(prefix+'/grad_q_weight_max', grad_q_weight.abs().max(), counter)
 
         with torch.no_grad():
             if grad_msb_weight is not None:
@@ -95,11 +89,7 @@ class PredictiveWeightQuantFunction(Function):
                 else:
                     grad_weight = large_locs * grad_msb_weight + (1 - large_locs) * grad_q_weight
 
-                grad_msb_sign_correct_locs = (grad_msb_weight.sign() == grad_q_weight.sign()).float()
-                grad_msb_sign_wrong = grad_msb_weight * (1 - grad_msb_sign_correct_locs)
-                if writer is not None and counter % 100 == 0:
-                    writer.add_scalar(prefix+'/ratio_grad_msb_used', float(large_locs.sum()) / float(large_locs.numel()), counter)
-                    writer.add_scalar(prefix+'/grad_numel', float(large_locs.numel()), counter)
+                record_grad_stats(ctx.grad_stats, large_locs, grad_msb_weight, grad_q_weight)
             else:
                 grad_weight = grad_q_weight
 
@@ -108,7 +98,7 @@ class PredictiveWeightQuantFunction(Function):
                 # grad_weight = quantize(grad_weight, num_bits=you_set,
                 #                        flatten_dims=(1,-1), signed=True)
 
-            return grad_weight, None, None, None, None, None, None, None, None
+            return grad_weight, None, None, None, None, None, None
 
 
 class EfficientPredictiveWeightQuantFunction(Function):
@@ -116,13 +106,11 @@ class EfficientPredictiveWeightQuantFunction(Function):
     # Note that both forward and backward are @staticmethods
     @staticmethod
     def forward(ctx, weight, num_bits_weight, msb_bits_weight,
-                threshold, sparsify, sign, writer, writer_prefix, counter):
+                threshold, sparsify, sign, grad_stats):
         ctx.threshold = threshold
         ctx.sparsify = sparsify
         ctx.sign = sign
-        ctx.writer = writer
-        ctx.writer_prefix = writer_prefix
-        ctx.counter = counter
+        ctx.grad_stats = grad_stats
 
         with torch.no_grad():
             # q_weight
@@ -139,9 +127,6 @@ class EfficientPredictiveWeightQuantFunction(Function):
     @staticmethod
     def backward(ctx, *grad_output):
         grad_weight = None
-        writer = ctx.writer
-        prefix = ctx.writer_prefix
-        counter = ctx.counter
         grad_q_weight = grad_output[0]
         grad_msb_weight = grad_output[1] # if len(grad_output) > 1 else None
 
@@ -156,18 +141,105 @@ class EfficientPredictiveWeightQuantFunction(Function):
                 else:
                     grad_weight = large_locs * grad_msb_weight + (1 - large_locs) * grad_q_weight
 
-                if writer is not None and counter % 200 == 0:
-                    grad_msb_sign_correct_locs = (grad_msb_weight.sign() == grad_q_weight.sign()).float()
-                    grad_msb_sign_wrong = grad_msb_weight * (1 - grad_msb_sign_correct_locs)
-                    writer.add_scalar(prefix+'/ratio_grad_msb_used', float(large_locs.sum()) / float(large_locs.numel()), counter)
-                    writer.add_scalar(prefix+'/grad_numel', float(large_locs.numel()), counter)
+                record_grad_stats(ctx.grad_stats, large_locs, grad_msb_weight, grad_q_weight)
             else:
                 grad_weight = grad_q_weight
 
             if ctx.sign:
                 grad_weight.sign_()
 
-            return grad_weight, None, None, None, None, None, None, None, None
+            return grad_weight, None, None, None, None, None, None
+
+
+class SparsePredictiveConv2dFunction(Function):
+    """Both branches of a predictive convolution with a sparse weight gradient.
+
+    Autograd would compute the full precision weight gradient densely and
+    `EfficientPredictiveWeightQuantFunction` then drop the entries whose MSB
+    gradient is above the threshold. Here the MSB weight gradient comes
+    first, and the full precision one is only computed for the filters that
+    still have entries below the threshold (none with `sparsify`).
+    """
+
+    @staticmethod
+    def forward(ctx, weight, q_input, msb_input, q_weight, msb_weight, stride, padding,
+                dilation, groups, num_bits_grad, biprecision, msb_bits_grad,
+                threshold, sparsify, sign, grad_stats, stochastic_grad=False):
+        ctx.conv = (stride, padding, dilation, groups)
+        ctx.num_bits_grad = num_bits_grad
+        ctx.stochastic_grad = stochastic_grad
+        ctx.biprecision = biprecision
+        ctx.msb_bits_grad = msb_bits_grad
+        ctx.threshold = threshold
+        ctx.sparsify = sparsify
+        ctx.sign = sign
+        ctx.grad_stats = grad_stats
+        ctx.save_for_backward(q_input, msb_input, q_weight)
+        ctx.msb_weight_shape = msb_weight.shape
+
+        with torch.no_grad():
+            q_output = F.conv2d(q_input, q_weight, None, stride, padding, dilation, groups)
+            msb_output = F.conv2d(msb_input, msb_weight, None, stride, padding, dilation, groups)
+        return q_output, msb_output
+
+    @staticmethod
+    def backward(ctx, grad_q_output, grad_msb_output):
+        q_input, msb_input, q_weight = ctx.saved_tensors
+        stride, padding, dilation, groups = ctx.conv
+        grad_weight = grad_input = None
+
+        with torch.no_grad():
+            # `conv2d_biprec` only quantizes the gradient w.r.t. the input
+            if ctx.biprecision:
+                grad_q_output_input = quantize_grad_tensor(
+                    grad_q_output, num_bits=ctx.num_bits_grad, stochastic=ctx.stochastic_grad)
+            else:
+                grad_q_output = grad_q_output_input = quantize_grad_tensor(
+                    grad_q_output, num_bits=ctx.num_bits_grad, flatten_dims=(1,-1),
+                    stochastic=ctx.stochastic_grad)
+            if ctx.needs_input_grad[1]:
+                grad_input = conv2d_input(q_input.shape, q_weight, grad_q_output_input,
+                                          stride, padding, dilation, groups)
+
+            if grad_msb_output is None:
+                grad_weight = conv2d_weight(q_input, q_weight.shape, grad_q_output,
+                                            stride, padding, dilation, groups)
+            else:
+                grad_msb_output = quantize_grad_tensor(
+                    grad_msb_output, num_bits=ctx.msb_bits_grad, flatten_dims=(1,-1),
+                    stochastic=ctx.stochastic_grad)
+                grad_msb_weight = conv2d_weight(msb_input, ctx.msb_weight_shape, grad_msb_output,
+                                                stride, padding, dilation, groups)
+                grad_msb_weight_abs = grad_msb_weight.abs()
+                threshold = ctx.threshold
+                if threshold < 0:
+                    threshold = -1.0 * threshold * grad_msb_weight_abs.max()
+                large_locs = (grad_msb_weight_abs >= threshold).float()
+                grad_weight = large_locs * grad_msb_weight
+
+                # the sign agreement is measured where both gradients exist
+                grad_q_weight, grad_msb_computed = None, grad_msb_weight
+                if not ctx.sparsify:
+                    # filters with at least one entry the MSB gradient can't be trusted for
+                    filters = (large_locs.flatten(1) < 1).any(1).nonzero().squeeze(1)
+                    if groups == 1 and len(filters) < len(large_locs):
+                        if len(filters):
+                            shape = (len(filters),) + tuple(q_weight.shape[1:])
+                            grad_q_weight = conv2d_weight(q_input, shape, grad_q_output[:, filters],
+                                                          stride, padding, dilation, groups)
+                            grad_weight[filters] += (1 - large_locs[filters]) * grad_q_weight
+                            grad_msb_computed = grad_msb_weight[filters]
+                    else:
+                        grad_q_weight = conv2d_weight(q_input, q_weight.shape, grad_q_output,
+                                                      stride, padding, dilation, groups)
+                        grad_weight += (1 - large_locs) * grad_q_weight
+
+                record_grad_stats(ctx.grad_stats, large_locs, grad_msb_computed, grad_q_weight)
+
+            if ctx.sign:
+                grad_weight.sign_()
+
+        return (grad_weight, grad_input) + (None,) * 15
 
 
 class PredictiveBiasQuantFunction(Function):
@@ -207,7 +279,10 @@ class PredictiveBiasQuantFunction(Function):
 
         with torch.no_grad():
             if grad_msb_bias is not None:
-                large_locs = (grad_msb_bias.abs() >= ctx.threshold).detach().float()
+                grad_msb_bias_abs = grad_msb_bias.abs()
+                if ctx.threshold < 0:
+                    ctx.threshold = -1.0 * ctx.threshold * grad_msb_bias_abs.max()
+                large_locs = (grad_msb_bias_abs >= ctx.threshold).detach().float()
                 if ctx.sparsify:
                     grad_bias = large_locs * grad_msb_bias
                 else:
@@ -221,25 +296,67 @@ class PredictiveBiasQuantFunction(Function):
             return grad_bias, None, None, None, None, None
 
 
+def record_grad_stats(grad_stats, large_locs, grad_msb_weight, grad_q_weight):
+    """Write the MSB usage ratio and the sign agreement rate into `grad_stats`.
+
+    `grad_stats` is a 2-element buffer owned by the layer; the values stay on
+    device so that backward never syncs with the host. The agreement rate is
+    left as is when the full precision gradient was not computed.
+    """
+    if grad_stats is None:
+        return
+    grad_stats[0].copy_(large_locs.mean())
+    if grad_q_weight is not None and grad_q_weight.numel():
+        grad_stats[1].copy_((grad_msb_weight.sign() == grad_q_weight.sign()).float().mean())
+
+
+def grad_stats_snapshot(model):
+    """Stack the `grad_stats` buffers of all predictive layers of `model`.
+
+    Returns the TensorBoard tags and a 1-D tensor on the device of the model;
+    nothing is copied to the host here.
+    """
+    tags, buffers = [], []
+    for m in model.modules():
+        grad_stats = getattr(m, 'grad_stats', None)
+        if grad_stats is None:
+            continue
+        tags.append(m.writer_prefix+'/ratio_grad_msb_used')
+        tags.append(m.writer_prefix+'/grad_sign_agreement')
+        buffers.append(grad_stats)
+    if not buffers:
+        return tags, None
+    return tags, torch.cat(buffers)
+
+
 def mixing_output(q_out, msb_out, predictive_forward, predictive_backward): # , msb_bits_grad=16):
     return PredictiveForwardMixingFunction.apply(
         q_out, msb_out, predictive_forward, predictive_backward) # , msb_bits_grad)
 
 
 def quant_weight(weight, num_bits_weight=8, msb_bits_weight=4,
-                 threshold=5e-4, sparsify=False, sign=False,
-                 writer=None, writer_prefix="", counter=0):
+                 threshold=5e-4, sparsify=False, sign=False, grad_stats=None):
     return PredictiveWeightQuantFunction.apply(
         weight, num_bits_weight, msb_bits_weight, threshold, sparsify, sign,
-        writer, writer_prefix, counter)
+        grad_stats)
 
 
 def efficient_quant_weight(weight, num_bits_weight=8, msb_bits_weight=4,
-                           threshold=5e-4, sparsify=False, sign=False,
-                           writer=None, writer_prefix="", counter=0):
+                           threshold=5e-4, sparsify=False, sign=False, grad_stats=None):
     return EfficientPredictiveWeightQuantFunction.apply(
         weight, num_bits_weight, msb_bits_weight, threshold, sparsify, sign,
-        writer, writer_prefix, counter)
+        grad_stats)
+
+
+def sparse_predictive_conv2d(weight, q_input, msb_input, q_weight, msb_weight,
+                             stride=1, padding=0, dilation=1, groups=1,
+                             num_bits_grad=None, biprecision=False, msb_bits_grad=16,
+                             threshold=5e-4, sparsify=False, sign=False, grad_stats=None,
+                             stochastic_grad=False):
+    return SparsePredictiveConv2dFunction.apply(
+        weight, q_input, msb_input, q_weight, msb_weight, stride, padding, dilation, groups,
+        num_bits_grad, biprecision, msb_bits_grad, threshold, sparsify, sign, grad_stats,
+        stochastic_grad)
 
 
 def quant_bias(weight, num_bits_bias=16, msb_bits_bias=8,
@@ -0,0 +1,70 @@
+"""Opt-in `torch.profiler` ranges for the phases of a training step.
+
+A range costs a little even without an active profiler, so `phase` is a
+no-op until `enable()` is called (`--profile-every` of `main_all.py`).
+`track()` only keeps the stack of open phases, for `current_phase`
+(`models.memory`).
+"""
+
+import contextlib
+
+from torch.autograd.profiler import record_function
+
+# ranges opened by `phase`, in the order of a training step
+PHASES = ('data', 'h2d', 'forward_blocks', 'forward_gates', 'rnn_gate', 'quantization',
+          'msb_branch', 'loss_energy', 'backward', 'optimizer')
+
+_enabled = False
+_tracked = False
+_open = []
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def track(flag=True):
+    """Keep the stack of open phases; returns the previous setting"""
+    global _tracked
+    previous, _tracked = _tracked, flag
+    return previous
+
+
+def current_phase():
+    """Innermost open phase, when tracked"""
+    return _open[-1] if _open else None
+
+
+@contextlib.contextmanager
+def _phase(name):
+    _open.append(name)
+    try:
+        if _enabled:
+            with record_function(name):
+                yield
+        else:
+            yield
+    finally:
+        _open.pop()
+
+
+def phase(name):
+    """Context manager marking `name` in the profile, when enabled"""
+    if _enabled or _tracked:
+        return _phase(name)
+    return contextlib.nullcontext()
+
+
+def phase_table(prof):
+    """Time spent in each phase over the steps recorded by `prof`"""
+    events = {e.key: e for e in prof.key_averages()}
+    lines = ['{:<16s} {:>8s} {:>12s} {:>12s}'.format('phase', 'calls', 'CPU ms', 'device ms')]
+    for name in PHASES:
+        e = events.get(name)
+        if e is None:
+            continue
+        device = getattr(e, 'device_time_total', getattr(e, 'cuda_time_total', 0))
+        lines.append('{:<16s} {:>8d} {:>12.2f} {:>12.2f}'.format(
+            name, e.count, e.cpu_time_total / 1e3, device / 1e3))
+    return '\n'.join(lines)
@@ -1,4 +1,5 @@
 from collections import namedtuple
+import contextlib
 import math
 import torch
 import torch.nn as nn
@@ -8,8 +9,79 @@ from torch.autograd.function import InplaceFunction, Function
 QParams = namedtuple('QParams', ['max_values', 'num_bits'])
 EfficientQParams = namedtuple('QParams', ['max_values', 'num_bits', 'msb_bits'])
 
+# Precision and predictive sign SGD settings shared by the layers of a model.
+# Immutable, so that differently quantized models can live in one process.
+QuantConfig = namedtuple('QuantConfig', [
+    'num_bits', 'num_bits_weight', 'num_bits_grad', 'biprecision',
+    'predictive_forward', 'predictive_backward',
+    'msb_bits', 'msb_bits_weight', 'msb_bits_grad',
+    'threshold', 'sparsify', 'sign', 'sparse_backward', 'pack_saved', 'stochastic_grad',
+    'per_channel_act'],
+    defaults=(8, 8, None, False, False, True, 4, 4, 16, 5e-4, False, True, False, False, False,
+              False))
+
+
+def quant_config(kwargs):
+    """Build a `QuantConfig` from the keyword arguments of a model factory.
+
+    Either takes `kwargs['config']` as is, or picks the known fields (the
+    `signsgd_config` of `main_all.py`) and ignores the rest.
+    """
+    if kwargs.get('config') is not None:
+        return kwargs['config']
+    return QuantConfig(**{k: v for k, v in kwargs.items() if k in QuantConfig._fields})
+
 _DEFAULT_FLATTEN = (1, -1)
 _DEFAULT_FLATTEN_GRAD = (0, -1)
+# per channel activation scales: the maximum over the spatial dimensions
+_PER_CHANNEL_FLATTEN = (2, -1)
+# floor of the per channel scales, for channels that are all zeros
+_MIN_SCALE = 1e-8
+
+
+# generators of the stochastic rounding, one per device, see `set_rounding_seed`
+_rounding_seed = None
+_rounding_generators = {}
+
+
+def set_rounding_seed(seed):
+    """Make stochastic rounding reproducible: (re)seed its generators"""
+    global _rounding_seed
+    _rounding_seed = seed
+    _rounding_generators.clear()
+
+
+def rounding_generator(device):
+    """The generator of the stochastic rounding on `device`, or None (the
+    global torch generator) when no seed was set"""
+    if _rounding_seed is None:
+        return None
+    gen = _rounding_generators.get(device)
+    if gen is None:
+        gen = _rounding_generators[device] = torch.Generator(device=device)
+        gen.manual_seed(_rounding_seed)
+    return gen
+
+
+def rounding_state():
+    return {str(device): gen.get_state() for device, gen in _rounding_generators.items()}
+
+
+def set_rounding_state(state):
+    for device, gen_state in state.items():
+        device = torch.device(device)
+        gen = rounding_generator(device)
+        if gen is not None:
+            gen.set_state(gen_state)
+
+
+def _round_(x, stochastic):
+    """Round `x` (already clamped to the grid) in place; stochastically,
+    i.e. up with probability equal to the fractional part, if asked"""
+    if not stochastic:
+        return x.round_()
+    noise = torch.empty_like(x).uniform_(generator=rounding_generator(x.device))
+    return x.add_(noise).floor_()
 
 
 def _deflatten_as(x, x_full):
@@ -83,7 +155,7 @@ class FPQuantizeFunction(InplaceFunction):
         # delta = (max_values - min_values) / (2.**num_bits - 1)
         qmin, qmax = 0.0, 2.**num_bits - 1
         with torch.no_grad():
-            output.sub_(min_values).div_(delta).clamp_(qmin,qmax).round_()
+            _round_(output.sub_(min_values).div_(delta).clamp_(qmin,qmax), stochastic)
 
             if dequantize:
                 output.mul_(delta).add_(min_values)
@@ -153,7 +225,7 @@ class EfficientFPQuantizeFunction(Function):
         scale = 2.0 ** (num_bits - msb_bits)
         with torch.no_grad():
             if not only_quantize_msb:
-                q_output.sub_(min_values).div_(delta).clamp_(qmin,qmax).round_()
+                _round_(q_output.sub_(min_values).div_(delta).clamp_(qmin,qmax), stochastic)
                 msb_output = q_output.clone().div_(scale).round_().mul_(scale).clamp_(qmin, qmax)
             else:
                 delta = (max_values - min_values) / 2.**msb_bits
@@ -221,6 +293,19 @@ def quantize(x, num_bits=None, qparams=None,
         x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic, inplace)
 
 
+def quantize_grad_tensor(grad, num_bits=None, flatten_dims=_DEFAULT_FLATTEN_GRAD, reduce_dim=0,
+                         signed=True, stochastic=False):
+    """What `quantize_grad` does to the gradient, for use inside a backward"""
+    if num_bits is None or num_bits >= 32:
+        return grad
+    with torch.no_grad():
+        qparams = calculate_qparams(grad, num_bits=num_bits, flatten_dims=flatten_dims,
+                                    reduce_dim=reduce_dim, reduce_type='extreme')
+        return quantize(grad, num_bits=None, qparams=qparams, flatten_dims=flatten_dims,
+                        reduce_dim=reduce_dim, dequantize=True, signed=signed,
+                        stochastic=stochastic, inplace=False)
+
+
 def efficient_quantize(x, num_bits=None, msb_bits=None, qparams=None,
                        flatten_dims=_DEFAULT_FLATTEN, reduce_dim=0,
                        dequantize=True, signed=False, stochastic=False, inplace=False):
@@ -235,19 +320,53 @@ def quantize_grad(x, num_bits=None, qparams=None,
         x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic)
 
 
+def _update_running(running, max_values, momentum, channels=None):
+    """EMA of the scales, on device; only `channels` (an index tensor into
+    dimension 1) of a per channel `running` if given"""
+    with torch.no_grad():
+        if channels is None or running.numel() == 1:
+            running.mul_(momentum).add_(max_values * (1 - momentum))
+        else:
+            running.index_copy_(1, channels, running.index_select(1, channels).mul_(momentum)
+                                .add_(max_values * (1 - momentum)))
+
+
+def _running_scales(running, channels=None):
+    if channels is None or running.numel() == 1:
+        return running
+    return running.index_select(1, channels)
+
+
+def _expand_running_max(module, state_dict, prefix, *args):
+    """Load a per tensor `running_max_values` into a per channel quantizer"""
+    key = prefix + 'running_max_values'
+    value = state_dict.get(key)
+    if (value is not None and value.numel() == 1 and
+            module.running_max_values.numel() > 1):
+        state_dict[key] = value.reshape(1).expand_as(module.running_max_values).clone()
+
+
 class Quantize(nn.Module):
-    """docstring for Quantize"""
+    """Quantizes its input with the running maximum of the training batches.
+
+    With `per_channel`, the scales are per channel (dimension 1 of `input`,
+    `shape_measure` is then e.g. `(1, channels, 1, 1)`) instead of per
+    tensor. In eval mode the running scales are used as they are.
+    """
 
     def __init__(self, num_bits=8, shape_measure=(1,), flatten_dims=_DEFAULT_FLATTEN,
-                 dequantize=True, input_signed=False, stochastic=False, momentum=0.1):
+                 dequantize=True, input_signed=False, stochastic=False, momentum=0.1,
+                 per_channel=False):
         super(Quantize, self).__init__()
         self.register_buffer('running_max_values', torch.zeros(*shape_measure))
-        self.flatten_dims = flatten_dims
+        self.flatten_dims = _PER_CHANNEL_FLATTEN if per_channel else flatten_dims
         self.momentum = momentum
         self.dequantize = dequantize
         self.input_signed = input_signed
         self.stochastic = stochastic
         self.num_bits = num_bits
+        self.per_channel = per_channel
+        self._register_load_state_dict_pre_hook(_expand_running_max, with_module=True)
 
     def forward(self, input, qparams=None):
 
@@ -256,10 +375,11 @@ class Quantize(nn.Module):
             if self.training:
                 if qparams is None:
                     qparams = calculate_qparams(
-                        input, num_bits=self.num_bits, flatten_dims=self.flatten_dims, reduce_dim=0)
-                with torch.no_grad():
-                    self.running_max_values.mul_(self.momentum).add_(
-                        qparams.max_values * (1 - self.momentum))
+                        input, num_bits=self.num_bits, flatten_dims=self.flatten_dims,
+                        reduce_dim=0, keepdim=self.per_channel)
+                    if self.per_channel:
+                        qparams.max_values.clamp_(min=_MIN_SCALE)
+                _update_running(self.running_max_values, qparams.max_values, self.momentum)
             else:
                 qparams = QParams(max_values=self.running_max_values,
                                   num_bits=self.num_bits)
@@ -272,21 +392,28 @@ class Quantize(nn.Module):
 
 
 class EfficientQuantize(nn.Module):
-    """docstring for Quantize"""
+    """`Quantize` returning the MSB part of the quantized input as well.
+
+    `channels` of `forward` (an index tensor) says which channels of a per
+    channel quantizer `input` holds, when it only holds some.
+    """
 
     def __init__(self, num_bits=8, msb_bits=4, shape_measure=(1,), flatten_dims=_DEFAULT_FLATTEN,
-                 dequantize=True, input_signed=False, stochastic=False, momentum=0.1):
+                 dequantize=True, input_signed=False, stochastic=False, momentum=0.1,
+                 per_channel=False):
         super(EfficientQuantize, self).__init__()
         self.register_buffer('running_max_values', torch.zeros(*shape_measure))
-        self.flatten_dims = flatten_dims
+        self.flatten_dims = _PER_CHANNEL_FLATTEN if per_channel else flatten_dims
         self.momentum = momentum
         self.dequantize = dequantize
         self.input_signed = input_signed
         self.stochastic = stochastic
         self.num_bits = num_bits
         self.msb_bits = msb_bits
+        self.per_channel = per_channel
+        self._register_load_state_dict_pre_hook(_expand_running_max, with_module=True)
 
-    def forward(self, input, qparams=None):
+    def forward(self, input, qparams=None, channels=None):
 
         # Quantize input
         # if self.num_bits is not None:
@@ -294,21 +421,89 @@ class EfficientQuantize(nn.Module):
             if qparams is None:
                 qparams = calculate_qparams_efficient(
                     input, num_bits=self.num_bits, msb_bits=self.msb_bits,
-                    flatten_dims=self.flatten_dims, reduce_dim=0)
-            with torch.no_grad():
-                self.running_max_values.mul_(self.momentum).add_(
-                    qparams.max_values * (1 - self.momentum))
+                    flatten_dims=self.flatten_dims, reduce_dim=0, keepdim=self.per_channel)
+                if self.per_channel:
+                    qparams.max_values.clamp_(min=_MIN_SCALE)
+            _update_running(self.running_max_values, qparams.max_values, self.momentum, channels)
         else:
             qparams = EfficientQParams(
-                max_values=self.running_max_values, num_bits=self.num_bits, msb_bits=self.msb_bits)
+                max_values=_running_scales(self.running_max_values, channels),
+                num_bits=self.num_bits, msb_bits=self.msb_bits)
         q_input, msb_input = efficient_quantize(
             input, qparams=qparams, dequantize=self.dequantize,
             signed=self.input_signed, stochastic=self.stochastic, inplace=False)
         # else:
             # q_input = input
+        # of the last call, for `saved_as_codes`
+        self.qparams = qparams
 
         return q_input, msb_input
 
+    def saved_as_codes(self, *tensors):
+        """`saved_as_codes` for outputs of the last call, when they are codes"""
+        qparams = getattr(self, 'qparams', None)
+        if (not self.dequantize or qparams is None or qparams.num_bits is None
+                or qparams.num_bits > 8 or not torch.is_grad_enabled()):
+            return contextlib.nullcontext()
+        return saved_as_codes(qparams, self.input_signed, *tensors)
+
+
+def _codes_scale(qparams, signed):
+    """Offset and step of the grid `efficient_quantize` dequantizes to"""
+    max_values = qparams.max_values
+    min_values = (- 1. * max_values) if signed else 0.
+    delta = (max_values - min_values) / 2.**qparams.num_bits
+    return min_values, delta
+
+
+def pack_codes(x, qparams, signed):
+    """Integer codes of `x`, dequantized by `efficient_quantize` with
+    `qparams`: one byte each, two per byte at 4 bits or fewer"""
+    min_values, delta = _codes_scale(qparams, signed)
+    with torch.no_grad():
+        codes = (x - min_values).div_(delta).round_().to(torch.uint8).view(-1)
+        if qparams.num_bits <= 4:
+            if codes.numel() % 2:
+                codes = torch.cat([codes, codes.new_zeros(1)])
+            codes = codes[0::2] | (codes[1::2] << 4)
+    return codes, x.size(), x.dtype, qparams, signed
+
+
+def unpack_codes(packed):
+    """The tensor `pack_codes` was given, bit for bit"""
+    codes, size, dtype, qparams, signed = packed
+    if qparams.num_bits <= 4:
+        codes = torch.stack((codes & 15, codes >> 4), 1).view(-1)[:size.numel()]
+    min_values, delta = _codes_scale(qparams, signed)
+    # the same operations as the dequantization
+    return codes.view(size).to(dtype).mul_(delta).add_(min_values)
+
+
+@contextlib.contextmanager
+def saved_as_codes(qparams, signed, *tensors):
+    """Inside, autograd keeps `tensors` (outputs of `efficient_quantize`
+    with `qparams`) for backward as packed integer codes.
+
+    Both outputs are packed at the code width of `num_bits`: the MSB one
+    takes the values `k * 2**(num_bits - msb_bits)` and the top code, one
+    more than `msb_bits` can hold, so it isn't packed any narrower. With
+    the default 8/4 bits both are kept at one byte per value (4x smaller).
+    """
+    keys = {(t.data_ptr(), t.size(), t.stride()) for t in tensors if t is not None}
+
+    def pack(t):
+        if (t.data_ptr(), t.size(), t.stride()) in keys:
+            return pack_codes(t, qparams, signed)
+        return t
+
+    def unpack(packed):
+        if isinstance(packed, tuple):
+            return unpack_codes(packed)
+        return packed
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+        yield
+
 
 if __name__ == '__main__':
     x = torch.rand(2, 3)